@@ -117,7 +117,12 @@ SESSION_COOKIE_NAME = config.get_value('default', 'session.cookie.name', 'wps_se
 
 ACTIVE_USER_THRESHOLD = config.get_value('default', 'active.user.threshold', 5, int, lambda x: datetime.timedelta(days=x))
 INGRESS_ENABLED = config.get_value('default', 'ingress.enabled', False, bool)
+PREPROCESS_FUSED = config.get_value('default', 'preprocess.fused', False, bool)
 CERT_DOWNLOAD_ENABLED = config.get_value('default', 'cert.download.enabled', True, bool)
+CERT_REFRESH_CHECK = config.get_value('default', 'cert.refresh.check', 1, int, lambda x: datetime.timedelta(hours=x))
+CERT_REFRESH_WINDOW = config.get_value('default', 'cert.refresh.window', 12, int, lambda x: datetime.timedelta(hours=x))
+CERT_REFRESH_ACTIVE = config.get_value('default', 'cert.refresh.active', 7, int, lambda x: datetime.timedelta(days=x))
+CERT_DISCOVERY_TTL = config.get_value('default', 'cert.discovery.ttl', 3600, int)
 ESGF_SEARCH = config.get_value('default', 'esgf.search', 'esgf-node.llnl.gov')
 
 WORKER_CPU_COUNT = config.get_value('default', 'worker.cpu_count', 2, int)
@@ -126,6 +131,30 @@ WORKER_MEMORY = config.get_value('default', 'worker.memory', 8e6, int)
 WORKER_USER_PERCENT = config.get_value('default', 'worker.user_percent', 0.10,
                                        float)
 WORKER_PER_USER = int(((WORKER_CPU_COUNT*1000)/WORKER_CPU_UNITS)*WORKER_USER_PERCENT)
+WORKER_CHUNK_MIN_SIZE = config.get_value('default', 'worker.chunk_min_size', 1000000, int)
+WORKER_LATENCY_OVERHEAD = config.get_value('default', 'worker.latency_overhead', 0.10, float)
+WORKER_THROUGHPUT_HISTORY = config.get_value('default', 'worker.throughput_history', 20, int)
+WORKER_METADATA_THREADS = config.get_value('default', 'worker.metadata_threads', 8, int)
+WORKER_METADATA_HOST_LIMIT = config.get_value('default', 'worker.metadata_host_limit', 4, int)
+WORKER_METADATA_TIMEOUT = config.get_value('default', 'worker.metadata_timeout', 120, int)
+WORKER_CHUNK_QUEUE = config.get_value('default', 'worker.chunk_queue', True, bool)
+WORKER_QUEUE_TIMEOUT = config.get_value('default', 'worker.queue_timeout', 3600, int)
+WORKER_CLAIM_TIMEOUT = config.get_value('default', 'worker.claim_timeout', 1800, int)
+WORKER_ACCESS_TTL = config.get_value('default', 'worker.access_ttl', 60, int)
+WORKER_ACCESS_BACKOFF = config.get_value('default', 'worker.access_backoff', 5, int)
+WORKER_ACCESS_BACKOFF_MAX = config.get_value('default', 'worker.access_backoff_max', 300, int)
+WORKER_PREFETCH_DEPTH = config.get_value('default', 'worker.prefetch_depth', 2, int)
+WORKER_BREAKER_THRESHOLD = config.get_value('default', 'worker.breaker_threshold', 5, int)
+WORKER_BREAKER_RESET = config.get_value('default', 'worker.breaker_reset', 60, int)
+WORKER_RETRY_ATTEMPTS = config.get_value('default', 'worker.retry_attempts', 3, int)
+WORKER_RETRY_BACKOFF = config.get_value('default', 'worker.retry_backoff', 1, float)
+WORKER_RETRY_BACKOFF_MAX = config.get_value('default', 'worker.retry_backoff_max', 30, float)
+WORKER_HOST_SEMAPHORE = config.get_value('default', 'worker.host_semaphore', 'database')
+WORKER_HOST_LIMIT = config.get_value('default', 'worker.host_limit', 4, int)
+WORKER_HOST_LIMITS = config.get_value('default', 'worker.host_limits', [], list, lambda x: dict((y.split(':')[0].strip(), int(y.split(':')[1])) for y in x if ':' in y))
+WORKER_HOST_WAIT = config.get_value('default', 'worker.host_wait', 600, int)
+WORKER_HOST_LEASE = config.get_value('default', 'worker.host_lease', 600, int)
+WORKER_REGRID_CACHE_ENTRIES = config.get_value('default', 'worker.regrid_cache_entries', 32, int)
 
 # Application definition
 EMAIL_HOST = config.get_value('email', 'host')
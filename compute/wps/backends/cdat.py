@@ -103,19 +103,29 @@ class CDAT(backend.Backend):
 
         return process_chains
 
-    def execute_process(self, context, process_func):
+    def generate_preprocess(self, context):
         start = tasks.job_started.s(context).set(**helpers.DEFAULT_QUEUE)
 
+        if settings.PREPROCESS_FUSED:
+            fused = tasks.preprocess_inputs.s().set(**helpers.DEFAULT_QUEUE)
+
+            context.job.step_inc(2)
+
+            return start | fused
+
         units = tasks.base_units.s().set(**helpers.DEFAULT_QUEUE)
 
         merge = tasks.merge.s().set(**helpers.DEFAULT_QUEUE)
 
         preprocess_chains = self.generate_preprocess_chains(context)
 
-        preprocess = start | units | celery.group(preprocess_chains) | merge
-
         context.job.step_inc(3)
 
+        return start | units | celery.group(preprocess_chains) | merge
+
+    def execute_process(self, context, process_func):
+        preprocess = self.generate_preprocess(context)
+
         concat = tasks.concat.s().set(**helpers.DEFAULT_QUEUE)
 
         success = tasks.job_succeeded.s().set(**helpers.DEFAULT_QUEUE)
@@ -1,7 +1,12 @@
 import contextlib
 import collections
+import itertools
 import os
+import Queue
 import re
+import sys
+import threading
+import time
 import uuid
 import urlparse
 from collections import deque
@@ -9,11 +14,16 @@ from datetime import datetime
 
 import cdms2
 import cwt
+import numpy as np
 import requests
+from cdms2.grid import AbstractRectGrid
 from celery.utils.log import get_task_logger
+from django import db
 from django.conf import settings
 
 from wps import helpers
+from wps import hosts
+from wps import intermediate
 from wps import metrics
 from wps import models
 from wps import WPSError
@@ -21,6 +31,253 @@ from wps.tasks import credentials
 
 logger = get_task_logger('wps.context')
 
+# libnetcdf is not thread safe, calls into it are made one at a time
+NETCDF_LOCK = threading.RLock()
+
+# Seconds between checks whether the consumer of prefetched chunks stopped
+PREFETCH_POLL = 1
+
+PREFETCH_DONE = object()
+
+# Selector names matching the axes of a target grid
+GRID_AXES = {
+    'latitude': ('lat', 'latitude'),
+    'longitude': ('lon', 'longitude'),
+}
+
+# Number of generated target grids kept by each worker
+GRID_CACHE_SIZE = 32
+
+# Per process target grids shared by all threads of a worker
+GRIDS = collections.OrderedDict()
+
+GRIDS_LOCK = threading.Lock()
+
+# Multiple of a chunk's size needed in memory while an operation runs
+WORKING_SET_MULTIPLIER = {
+    'CDAT.subset': 2,
+    'CDAT.aggregate': 2,
+    'CDAT.regrid': 3,
+    'CDAT.average': 3,
+    # Deviations from the mean and their powers are held alongside the chunk
+    'CDAT.var': 4,
+    'CDAT.std': 4,
+    'CDAT.skewness': 5,
+    'CDAT.kurtosis': 5,
+}
+
+DEFAULT_WORKING_SET_MULTIPLIER = 2
+
+def working_set_multiplier(context):
+    """ Determines the working set multiplier for an operation.
+
+    Args:
+        context (OperationContext): Current context.
+
+    Returns:
+        An int multiple of a chunk's size needed in memory.
+    """
+    identifier = context.operation.identifier
+
+    multiplier = WORKING_SET_MULTIPLIER.get(identifier,
+                                            DEFAULT_WORKING_SET_MULTIPLIER)
+
+    # Regridding holds the source and target chunk in memory
+    if identifier != 'CDAT.regrid' and context.is_regrid:
+        multiplier += 1
+
+    return multiplier
+
+def prefetch(chunks, depth, host):
+    """ Reads chunks ahead of the consumer on a background thread.
+
+    Up to `depth` chunks are buffered while the consumer processes the
+    current one. The time the consumer waits for each chunk is recorded.
+
+    OPeNDAP reads hold NETCDF_LOCK for the whole transfer since libnetcdf
+    is not thread safe, any NetCDF call made by the consumer meanwhile waits
+    for the download. Prefetching only overlaps transfers with work that
+    does not touch the NetCDF library e.g. numpy processing, consumers
+    writing NetCDF files read without it.
+
+    Args:
+        chunks (generator): Generator yielding chunks.
+        depth (int): Number of chunks to read ahead, 0 disables prefetching.
+        host (str): Host the chunks are read from.
+
+    Returns:
+        A generator yielding the items of `chunks`.
+    """
+    if depth < 1:
+        for item in chunks:
+            yield item
+
+        return
+
+    buffer = Queue.Queue(depth)
+
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=PREFETCH_POLL)
+            except Queue.Full:
+                continue
+
+            return True
+
+        return False
+
+    def produce():
+        try:
+            for item in chunks:
+                if not put((item, None)):
+                    break
+            else:
+                put((PREFETCH_DONE, None))
+        except Exception:
+            put((PREFETCH_DONE, sys.exc_info()))
+        finally:
+            chunks.close()
+
+            db.connection.close()
+
+    thread = threading.Thread(target=produce)
+
+    thread.daemon = True
+
+    thread.start()
+
+    try:
+        while True:
+            start = time.time()
+
+            item, error = buffer.get()
+
+            metrics.WPS_CHUNK_WAIT.labels(host).observe(time.time() - start)
+
+            if item is PREFETCH_DONE:
+                if error is not None:
+                    raise error[0], error[1], error[2]
+
+                return
+
+            yield item
+    finally:
+        stop.set()
+
+        thread.join()
+
+def renew_claims(job, task_id, stop):
+    """ Renews the leases of a task's claimed chunks until stopped.
+
+    The leases are renewed every third of WORKER_CLAIM_TIMEOUT so chunks
+    taking longer than the timeout are not claimed by another worker.
+
+    Args:
+        job (wps.models.Job): Job the chunks belong to.
+        task_id (str): Id of the claiming task.
+        stop (threading.Event): Event set once the task is done.
+    """
+    interval = max(settings.WORKER_CLAIM_TIMEOUT / 3.0,
+                   models.JobChunk.CLAIM_POLL)
+
+    try:
+        while not stop.wait(interval):
+            models.JobChunk.renew(job, task_id)
+    finally:
+        # The thread has its own database connection
+        db.connection.close()
+
+@contextlib.contextmanager
+def claim_lease(job, task_id):
+    """ Keeps the leases of a task's claimed chunks while it runs.
+
+    Args:
+        job (wps.models.Job): Job the chunks belong to.
+        task_id (str): Id of the claiming task.
+    """
+    stop = threading.Event()
+
+    renewer = threading.Thread(target=renew_claims, args=(job, task_id, stop))
+
+    renewer.daemon = True
+
+    renewer.start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+
+def memoize_grid(key, func, *args):
+    """ Looks up a target grid, creating it on a miss.
+
+    Args:
+        key (tuple): Key of the grid.
+        func (function): Function creating the grid.
+
+    Returns:
+        A cdms2.grid.AbstractGrid or None if `func` returned None.
+    """
+    with GRIDS_LOCK:
+        grid = GRIDS.pop(key, None)
+
+        if grid is not None:
+            GRIDS[key] = grid
+
+            return grid
+
+    grid = func(*args)
+
+    if grid is not None:
+        with GRIDS_LOCK:
+            GRIDS[key] = grid
+
+            while len(GRIDS) > GRID_CACHE_SIZE:
+                GRIDS.popitem(last=False)
+
+    return grid
+
+def grid_selection(axis, selector, names):
+    """ Looks up the selection of a grid axis.
+
+    Args:
+        axis (cdms2.axis.AbstractAxis): Axis of the grid.
+        selector (dict): Axis names mapped to selections.
+        names (tuple): Other names selecting the axis.
+
+    Returns:
+        The selection or None if the axis is not selected.
+    """
+    for name in (axis.id,) + names:
+        if name in selector:
+            return selector[name]
+
+    return None
+
+def hashable(value):
+    if isinstance(value, slice):
+        return ('slice', value.start, value.stop, value.step)
+
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable(x) for x in value)
+
+    return value
+
+class LockedOutput(object):
+    """ Serializes writes to an output file with other NetCDF calls. """
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def write(self, *args, **kwargs):
+        with NETCDF_LOCK:
+            return self.outfile.write(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.outfile, name)
+
 class WorkflowOperationContext(object):
     def __init__(self, variable, domain, operation):
         self.variable = variable
@@ -214,6 +471,7 @@ class OperationContext(object):
         self.output_path = None
         self.grid = None
         self.gridder = None
+        self.chunk_queue = False
         self.ignore = ('grid', 'gridder')
 
     @classmethod
@@ -377,6 +635,37 @@ class OperationContext(object):
 
         return self.grid, self.gridder.tool, self.gridder.method
 
+    def load_manifest(self):
+        """ Loads the chunk outputs recorded in the job's chunk queue.
+
+        The outputs of each input are replaced by those in the manifest,
+        ordered by chunk index regardless of which worker handled them.
+
+        Raises:
+            WPSError: If a queued chunk is not done.
+        """
+        pending = models.JobChunk.pending(self.job)
+
+        if len(pending) > 0:
+            raise WPSError('Chunks were not completed {!r}', pending)
+
+        manifest = models.JobChunk.manifest(self.job)
+
+        for input_index, input in enumerate(self.sorted_inputs()):
+            if input_index not in manifest:
+                continue
+
+            stage, paths = manifest[input_index]
+
+            if len(paths) != len(input.chunk):
+                raise WPSError('Input {!r} has {!r} of {!r} chunks',
+                               input.filename, len(paths), len(input.chunk))
+
+            if stage == models.JobChunk.PROCESS:
+                input.process = paths
+            else:
+                input.ingress = paths
+
     def sorted_inputs(self):
         units = set(x.units for x in self.inputs)
 
@@ -403,8 +692,14 @@ class OperationContext(object):
         except OSError:
             pass
 
-        with cdms2.open(path, 'w') as outfile:
-            yield outfile
+        with NETCDF_LOCK:
+            outfile = cdms2.open(path, 'w')
+
+        try:
+            yield LockedOutput(outfile)
+        finally:
+            with NETCDF_LOCK:
+                outfile.close()
 
         stat = os.stat(path)
 
@@ -453,28 +748,139 @@ class OperationContext(object):
 
         return selector
 
+    def subset_axis(self, axis, value):
+        """ Subsets a grid axis.
+
+        Args:
+            axis (cdms2.axis.AbstractAxis): Axis to subset.
+            value: A slice of indices or a tuple of start and stop
+                coordinates.
+
+        Returns:
+            A tuple of the cdms2.axis.TransientAxis and numpy.ndarray of the
+            selected indices.
+
+        Raises:
+            WPSError: If the selection does not overlap the axis.
+        """
+        if isinstance(value, slice):
+            start, stop, step = value.indices(len(axis))
+        else:
+            if not isinstance(value, (list, tuple)):
+                value = (value, value)
+
+            interval = axis.mapInterval((value[0], value[1], 'cc'))
+
+            if interval is None:
+                raise WPSError('Selection {!r} does not overlap the target grid '
+                               'axis {!r}', value, axis.id)
+
+            start, stop = interval[:2]
+
+            step = interval[2] if len(interval) > 2 else 1
+
+        # Circular axes map intervals past their end
+        indices = np.arange(start, stop, step) % len(axis)
+
+        return axis.subAxis(start, stop, step), indices
+
     def subset_grid(self, grid, selector):
-        target = cdms2.MV2.ones(grid.shape)
+        """ Subsets a target grid.
+
+        The latitude and longitude axes are subset directly, no data is
+        allocated for the grid.
+
+        Args:
+            grid (cdms2.grid.AbstractGrid): Grid to subset.
+            selector (dict): Axis names mapped to slices of indices or tuples
+                of start and stop coordinates.
+
+        Returns:
+            A cdms2.grid.AbstractGrid.
+        """
+        if grid is None:
+            return None
 
-        target = target(**selector)
+        if not isinstance(grid, AbstractRectGrid):
+            logger.info('Using curvilinear target grid %r without subsetting',
+                        grid.shape)
 
-        target.setAxisList(grid.getAxisList())
+            return grid
 
-        return target.getGrid()
+        axes = {}
+
+        for name, axis in (('latitude', grid.getLatitude()),
+                           ('longitude', grid.getLongitude())):
+            value = grid_selection(axis, selector, GRID_AXES[name])
+
+            if value is None:
+                axes[name] = (axis, None)
+            else:
+                axes[name] = self.subset_axis(axis, value)
+
+        lat, lat_indices = axes['latitude']
+
+        lon, lon_indices = axes['longitude']
+
+        mask = grid.getMask()
+
+        if mask is not None:
+            if lat_indices is None:
+                lat_indices = np.arange(len(lat))
+
+            if lon_indices is None:
+                lon_indices = np.arange(len(lon))
+
+            if grid.getOrder() == 'yx':
+                mask = mask[np.ix_(lat_indices, lon_indices)]
+            else:
+                mask = mask[np.ix_(lon_indices, lat_indices)]
+
+        target = cdms2.createRectGrid(lat, lon, grid.getOrder(),
+                                      grid.getType(), mask)
+
+        logger.info('Subset target grid %r -> %r', grid.shape, target.shape)
+
+        return target
 
     def generate_grid(self, gridder, selector):
+        """ Generates the target grid of a regrid.
+
+        Uniform and gaussian grids are memoized per worker by their
+        definition and the selection of their axes.
+
+        Args:
+            gridder (cwt.Gridder): Gridder describing the target grid.
+            selector (dict): Axis names mapped to selections.
+
+        Returns:
+            A cdms2.grid.AbstractGrid or None if there is no gridder.
+        """
         try:
             if isinstance(gridder.grid, cwt.Variable):
                 grid = self.read_grid_from_file(gridder)
-            else:
-                grid = self.generate_user_defined_grid(gridder)
+
+                return self.subset_grid(grid, selector)
+
+            grid = memoize_grid((gridder.grid,),
+                                self.generate_user_defined_grid, gridder)
         except AttributeError:
             # Handle when gridder is None
             return None
 
-        grid = self.subset_grid(grid, selector)
+        if grid is None:
+            return None
 
-        return grid
+        names = [grid.getLatitude().id, grid.getLongitude().id]
+
+        for x in GRID_AXES.values():
+            names.extend(x)
+
+        selection = tuple(sorted((x, hashable(y)) for x, y in
+                                 selector.iteritems() if x in names))
+
+        return memoize_grid((gridder.grid, selection), self.subset_grid,
+                            grid, selector)
 
     def read_grid_from_file(gridder):
         url_validator = URLValidator(['https', 'http'])
@@ -536,16 +942,70 @@ class OperationContext(object):
 
         return grid
 
+class ChunkPlan(object):
+    """ Describes how a variable is split into chunks.
+
+    Each chunk is a dict of axis names to slices, it can be merged into a
+    mapped domain to select the portion of data for the chunk. Chunks are
+    ordered with the last axis in `axes` varying the fastest.
+    """
+    def __init__(self, axes=None, chunks=None, nbytes=None, sizes=None):
+        self.axes = axes or []
+        self.chunks = chunks or []
+        self.nbytes = nbytes
+        self.sizes = sizes or [0 for _ in self.chunks]
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return self.__dict__.copy()
+
+    @property
+    def axis(self):
+        """ Outer most axis the variable is split over. """
+        try:
+            return self.axes[0]
+        except IndexError:
+            return None
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, index):
+        return self.chunks[index]
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __eq__(self, other):
+        return isinstance(other, ChunkPlan) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ChunkPlan(axes={!r}, chunks={!r}, nbytes={!r})'.format(
+            self.axes, len(self.chunks), self.nbytes)
+
 class VariableContext(object):
     def __init__(self, variable):
         self.variable = variable
         self.first = None
         self.units = None
+        self.itemsize = None
+        self.storage_chunks = None
+        self.last_modified = None
+        self.dodsrc = None
+        self.nbytes = None
         self.mapped = {}
         self.mapped_order = []
+        self.spatial_axes = []
         self.cache = None
-        self.chunk = []
+        self.chunk = ChunkPlan()
         self.chunk_axis = None
+        self.workers = None
         self.ingress = []
         self.process = []
 
@@ -596,6 +1056,15 @@ class VariableContext(object):
 
         return parts.path.split('/')[-1]
 
+    @property
+    def hostname(self):
+        if self.variable is None:
+            raise WPSError('No variable set')
+
+        parts = urlparse.urlparse(self.variable.uri)
+
+        return parts.hostname
+
     @property
     def is_cached(self):
         return self.cache is not None
@@ -622,45 +1091,226 @@ class VariableContext(object):
 
         parts = urlparse.urlparse(url)
 
+        start = time.time()
+
         try:
-            response = requests.get(url, timeout=(2, 30), cert=cert,
-                                    verify=False)
+            response = hosts.session(parts.hostname, cert).get(
+                url, timeout=(2, 30), cert=cert, verify=False)
         except requests.ConnectTimeout:
             logger.exception('Timeout connecting to %r', parts.hostname)
 
-            metrics.WPS_DATA_ACCESS_FAILED.labels(parts.hostname).inc()
-
-            raise WPSError('Timeout connecting to {!r}', parts.hostname)
+            raise hosts.HostError('Timeout connecting to {!r}', parts.hostname)
         except requests.ReadTimeout:
             logger.exception('Timeout reading from %r', parts.hostname)
 
-            metrics.WPS_DATA_ACCESS_FAILED.labels(parts.hostname).inc()
+            raise hosts.HostError('Timeout reading from {!r}', parts.hostname)
+        except requests.ConnectionError:
+            logger.exception('Error connecting to %r', parts.hostname)
 
-            raise WPSError('Timeout reading from {!r}', parts.hostname)
+            raise hosts.HostError('Error connecting to {!r}', parts.hostname)
 
         if response.status_code == 200:
+            # The DDS response is small, its duration is mostly latency
+            hosts.record_transfer(parts.hostname, len(response.content),
+                                  time.time() - start)
+
+            self.last_modified = response.headers.get('Last-Modified', None)
+
+            hosts.cache_modified(self.variable.uri, self.last_modified)
+
             return True
 
         logger.info('Checking url failed with status code %r',
                     response.status_code)
 
+        if response.status_code >= 500:
+            raise hosts.HostError('Error accessing {!r} status code {!r}',
+                                  parts.hostname, response.status_code)
+
         metrics.WPS_DATA_ACCESS_FAILED.labels(parts.hostname).inc()
 
         return False
     
+    def cached_check_access(self, key, cert=None):
+        """ Checks access, reusing a recent result for the same key.
+
+        Args:
+            key (tuple): Key returned by hosts.access_key.
+            cert (str): Path to the certificate.
+
+        Returns:
+            A bool whether the file is accessible.
+        """
+        cached = hosts.cached_access(key)
+
+        if cached is not None:
+            result, error = cached
+
+            if error is not None:
+                raise WPSError('{}', error)
+
+            return result
+
+        try:
+            result = hosts.retry(self.hostname, self.check_access, cert)
+        except WPSError as e:
+            hosts.cache_access(key, False, str(e))
+
+            raise
+
+        hosts.cache_access(key, result)
+
+        return result
+
+    def access(self, user):
+        if user is None:
+            return
+
+        if self.cached_check_access(hosts.access_key(self.variable.uri)):
+            self.dodsrc = None
+
+            return
+
+        cert_path = credentials.load_certificate(user)
+
+        self.dodsrc = credentials.dodsrc_path(user)
+
+        key = hosts.access_key(self.hostname, user.id, user.auth.cert)
+
+        if not self.cached_check_access(key, cert_path):
+            pass
+
+    def remote_last_modified(self, user):
+        """ Retrieves the Last-Modified of the remote file.
+
+        The value recorded by a recent access check of the file is used,
+        otherwise it is read from a HEAD request of the file's DDS.
+
+        Args:
+            user (User): User accessing the file.
+
+        Returns:
+            The Last-Modified of the file or None if the host does not send
+            it.
+        """
+        cached, value = hosts.cached_modified(self.variable.uri)
+
+        if cached:
+            return value
+
+        if user is not None and self.dodsrc is not None:
+            cert = credentials.load_certificate(user)
+        else:
+            cert = None
+
+        url = '{}.dds'.format(self.variable.uri)
+
+        parts = urlparse.urlparse(url)
+
+        try:
+            response = hosts.session(parts.hostname, cert).head(
+                url, timeout=(2, 30), cert=cert, verify=False,
+                allow_redirects=True)
+        except requests.RequestException:
+            logger.exception('Failed to retrieve Last-Modified of %r',
+                             self.variable.uri)
+
+            return None
+
+        if response.status_code == 200:
+            value = response.headers.get('Last-Modified', None)
+        else:
+            value = None
+
+        hosts.cache_modified(self.variable.uri, value)
+
+        return value
+
+    def metadata(self, user, cancelled=None):
+        """ Retrieves the axis metadata of the variable.
+
+        The metadata is read from the axis metadata index, the file is only
+        opened when it is missing or the file has been modified since it was
+        recorded. The Last-Modified of remote files is looked up even when
+        their access check is skipped.
+
+        Args:
+            user (User): User accessing the file.
+            cancelled (threading.Event): Set when the caller no longer waits
+                for the metadata, the file is not opened once it is set.
+
+        Returns:
+            A wps.models.AxisMetadata.
+
+        Raises:
+            WPSError: If cancelled before the file is opened.
+        """
+        self.access(user)
+
+        parts = urlparse.urlparse(self.variable.uri)
+
+        if parts.scheme in ('', 'file'):
+            if os.path.exists(parts.path):
+                self.last_modified = str(os.stat(parts.path).st_mtime)
+        else:
+            self.last_modified = self.remote_last_modified(user)
+
+        entry = models.AxisMetadata.lookup(self.variable.uri,
+                                           self.variable.var_name,
+                                           self.last_modified)
+
+        if entry is None:
+            with NETCDF_LOCK:
+                # Abandoned probes give up the lock rather than opening files
+                if cancelled is not None and cancelled.is_set():
+                    raise WPSError('Cancelled retrieving metadata for {!r}',
+                                   self.variable.uri)
+
+                with self.open_remote() as variable:
+                    entry = models.AxisMetadata.from_variable(
+                        self.variable.uri, variable, self.last_modified)
+
+        return entry
+
     @contextlib.contextmanager
     def open(self, user):
-        if user is not None and not self.check_access():
-            cert_path = credentials.load_certificate(user)
+        self.access(user)
 
-            if not self.check_access(cert_path):
-                pass
+        with self.open_remote() as variable:
+            yield variable
 
+    def open_file(self):
+        """ Opens the file over OPeNDAP.
+
+        Returns:
+            A cdms2.dataset.CdmsFile.
+        """
+        try:
+            # The DAP library reads the .dodsrc when the file is opened
+            with NETCDF_LOCK, credentials.dap_config(self.dodsrc):
+                return cdms2.open(self.variable.uri)
+        except Exception as e:
+            logger.exception('Failed to open file %r', self.variable.uri)
+
+            if hosts.transport_error(e):
+                raise hosts.HostError('Failed to access file {!r}',
+                                      self.variable.uri)
+
+            raise WPSError('Failed to open file {!r}: {!s}', self.variable.uri,
+                           e)
+
+    @contextlib.contextmanager
+    def open_remote(self):
         try:
-            with cdms2.open(self.variable.uri) as infile:
+            infile = hosts.retry(self.hostname, self.open_file)
+
+            try:
                 logger.info('Opened %r', infile.id)
 
                 yield infile[self.variable.var_name]
+            finally:
+                with NETCDF_LOCK:
+                    infile.close()
         except WPSError:
             raise
         except Exception:
@@ -677,10 +1327,37 @@ class VariableContext(object):
         with cdms2.open(file_path) as infile:
             yield infile[self.variable.var_name]
 
-    def generate_chunks(self, index):
+    def prefetch_depth(self, multiplier):
+        """ Number of remote chunks that can be read ahead.
+
+        The chunk being processed needs `multiplier` times its size, the
+        remaining worker memory is used for read ahead chunks. The reader
+        holds one more chunk while it waits for room in the buffer.
+
+        Args:
+            multiplier (int): Working set multiplier of the operation.
+
+        Returns:
+            An int number of chunks.
+        """
+        if not self.chunk.nbytes:
+            return 0
+
+        free = settings.WORKER_MEMORY - multiplier * self.chunk.nbytes
+
+        return max(min(settings.WORKER_PREFETCH_DEPTH,
+                       int(free / self.chunk.nbytes) - 1), 0)
+
+    def generate_chunks(self, index, indices=None):
+        if indices is not None:
+            return indices
+
         if index is None:
             return [x for x in range(len(self.chunk))]
 
+        if self.workers is not None:
+            return [x for x, y in enumerate(self.workers) if y == index]
+
         return [x for x in range(index, len(self.chunk),
                                  settings.WORKER_PER_USER)]
 
@@ -691,19 +1368,54 @@ class VariableContext(object):
         if index is None:
             index = 0
 
-        ingress_filename = '{}_{:08}_{:08}.nc'.format(str(context.job.id), input_index, index)
+        ingress_filename = '{}_{:08}_{:08}{}'.format(str(context.job.id),
+                                                     input_index, index,
+                                                     intermediate.EXTENSION)
 
         ingress_path = context.gen_ingress_path(ingress_filename)
 
-        with cdms2.open(ingress_path, 'w') as outfile:
-            outfile.write(data, id=self.variable.var_name)
+        intermediate.write(ingress_path, data)
 
         self.ingress.append(ingress_path)
 
-    def chunks_remote(self, input_index, index, context):
+    def read_chunk(self, variable, mapped):
+        """ Reads a chunk of a remote variable.
+
+        Args:
+            variable (cdms2.tvariable.TransientVariable): Variable to read.
+            mapped (dict): Axis names mapped to slices.
+
+        Returns:
+            A cdms2.tvariable.TransientVariable.
+        """
+        try:
+            with hosts.download_slot(self.hostname):
+                # OPeNDAP reads hold the lock for the whole transfer
+                with NETCDF_LOCK:
+                    start = time.time()
+
+                    data = variable(**mapped)
+
+                    elapsed = time.time() - start
+
+            # Only the transfer is timed, not waits for the slot or lock
+            hosts.record_transfer(self.hostname, data.nbytes, elapsed)
+
+            return data
+        except WPSError:
+            raise
+        except Exception as e:
+            logger.exception('Failed to read %r %r', self.variable.uri, mapped)
+
+            if hosts.transport_error(e):
+                raise hosts.HostError('Failed to read {!r}', self.variable.uri)
+
+            raise WPSError('Failed to read {!r}: {!s}', self.variable.uri, e)
+
+    def chunks_remote(self, input_index, index, context, indices=None):
         mapped = self.mapped.copy()
 
-        indices = self.generate_chunks(index)
+        indices = self.generate_chunks(index, indices)
 
         logger.info('Generating remote chunks for %r', index)
 
@@ -713,12 +1425,13 @@ class VariableContext(object):
 
         with self.open(context.user) as variable:
             for chunk_index in indices:
-                mapped.update({ self.chunk_axis: self.chunk[chunk_index] })
+                mapped.update(self.chunk[chunk_index])
 
                 logger.info('Reading %r %r', mapped, self.chunk[chunk_index])
 
                 with metrics.WPS_DATA_DOWNLOAD.labels(parts.hostname).time():
-                    data = variable(**mapped)
+                    data = hosts.retry(parts.hostname, self.read_chunk,
+                                       variable, mapped)
 
                 metrics.WPS_DATA_DOWNLOAD_BYTES.labels(parts.hostname,
                                                        self.variable.var_name).inc(data.nbytes)
@@ -728,10 +1441,10 @@ class VariableContext(object):
 
                 yield self.variable.uri, chunk_index, data
 
-    def chunks_cache(self, index):
+    def chunks_cache(self, index, indices=None):
         mapped = self.cache_mapped()
 
-        indices = self.generate_chunks(index)
+        indices = self.generate_chunks(index, indices)
 
         logger.info('Generating cached chunks for %r', index)
 
@@ -739,7 +1452,7 @@ class VariableContext(object):
 
         with self.open_local(self.cache.local_path) as variable:
             for chunk_index in indices:
-                mapped.update({ self.chunk_axis: self.chunk[chunk_index] })
+                mapped.update(self.chunk[chunk_index])
 
                 logger.info('Reading %r %r', mapped, self.chunk[chunk_index])
 
@@ -757,8 +1470,7 @@ class VariableContext(object):
         logger.info('Generating ingressed chunks')
 
         for chunk_index, ingress_path in enumerate(ingress):
-            with self.open_local(ingress_path) as variable:
-                yield ingress_path, chunk_index, variable()
+            yield ingress_path, chunk_index, intermediate.read(ingress_path)
 
     def chunks_process(self):
         process = sorted(self.process)
@@ -766,10 +1478,190 @@ class VariableContext(object):
         logger.info('Generating procesed chunks')
 
         for index, process_path in enumerate(process):
-            with self.open_local(process_path) as variable:
-                yield process_path, index, variable()
+            yield process_path, index, intermediate.read(process_path)
+
+    def combine_chunks(self, chunks, axes):
+        """ Concatenates chunks over the split axes.
+
+        Args:
+            chunks (list): List of (path, chunk index, data) tuples.
+            axes (list): Axis names to concatenate over, outer most first.
+
+        Returns:
+            A cdms2.TransientVariable.
+        """
+        if len(axes) == 0:
+            return chunks[0][2]
+
+        key = lambda x: self.chunk[x[1]][axes[0]]
+
+        data = [self.combine_chunks(list(x), axes[1:]) for _, x in
+                itertools.groupby(chunks, key)]
+
+        if len(data) == 1:
+            return data[0]
+
+        return cdms2.MV2.concatenate(data, axis=data[0].getAxisIndex(axes[0]))
+
+    def merge_split_chunks(self, chunks):
+        """ Merges chunks split over multiple axes.
+
+        Chunks sharing a slice of the outer most axis are concatenated over
+        the remaining split axes, each yielded chunk covers a complete slab
+        of the outer axis.
+
+        Args:
+            chunks (generator): Generator returned by `chunks`.
+
+        Returns:
+            A generator yielding (path, chunk index, data) tuples.
+        """
+        if len(self.chunk.axes) <= 1:
+            for item in chunks:
+                yield item
+
+            return
+
+        group = []
+
+        for item in chunks:
+            if (len(group) > 0 and self.chunk[group[0][1]][self.chunk.axis] !=
+                    self.chunk[item[1]][self.chunk.axis]):
+                yield group[0][0], group[0][1], self.combine_chunks(group, self.chunk.axes[1:])
+
+                group = []
+
+            group.append(item)
+
+        if len(group) > 0:
+            yield group[0][0], group[0][1], self.combine_chunks(group, self.chunk.axes[1:])
+
+    def source_axes(self, indices, context):
+        """ Reads the axes of chunks from the cache or remote file.
+
+        Only the coordinates are read.
+
+        Args:
+            indices (list): Indices of the chunks.
+            context (OperationContext): Current context.
+
+        Returns:
+            A generator yielding (chunk index, axes) tuples.
+        """
+        if self.cache is not None:
+            mapped = self.cache_mapped()
+
+            infile = self.open_local(self.cache.local_path)
+        else:
+            mapped = self.mapped.copy()
+
+            infile = self.open(context.user)
+
+        with infile as variable:
+            with NETCDF_LOCK:
+                file_axes = variable.getAxisList()
 
-    def chunks(self, input_index=None, index=None, context=None):
+            for chunk_index in indices:
+                selector = mapped.copy()
+
+                selector.update(self.chunk[chunk_index])
+
+                axes = []
+
+                for axis in file_axes:
+                    value = selector.get(axis.id, slice(None))
+
+                    with NETCDF_LOCK:
+                        axes.append(axis.subAxis(
+                            value.start or 0,
+                            len(axis) if value.stop is None else value.stop,
+                            value.step or 1))
+
+                yield chunk_index, axes
+
+    def chunk_axes(self, context=None):
+        """ Axes of the chunks generated by `chunks` without their data.
+
+        Args:
+            context (OperationContext): Current context.
+
+        Returns:
+            A generator yielding (chunk index, axes) tuples.
+        """
+        if len(self.process) > 0:
+            return self.paths_axes(self.process)
+        elif len(self.ingress) > 0:
+            return self.paths_axes(self.ingress)
+
+        return self.source_axes(self.generate_chunks(None), context)
+
+    def paths_axes(self, paths):
+        """ Axes of intermediate chunks without their data.
+
+        Args:
+            paths (list): Paths of the chunks.
+
+        Returns:
+            A generator yielding (chunk index, axes) tuples.
+        """
+        paths = sorted(paths)
+
+        for chunk_index, path in enumerate(paths):
+            yield chunk_index, intermediate.read_axes(path)
+
+    def chunks_queue(self, input_index, context, stage, task_id):
+        """ Generates the chunks claimed from the job's chunk queue.
+
+        Chunks that have been ingressed are read from their ingress file,
+        otherwise they are read from the cache or remote file.
+
+        Args:
+            input_index (int): Index of the input in the sorted inputs.
+            context (OperationContext): Current context.
+            stage (str): Stage to claim chunks for.
+            task_id (str): Id of the claiming task.
+
+        Returns:
+            A generator yielding (path, chunk index, data) tuples.
+        """
+        ingressed = (stage == models.JobChunk.PROCESS and
+                     settings.INGRESS_ENABLED and self.cache is None)
+
+        claimed = models.JobChunk.claims(context.job, stage, input_index,
+                                         task_id)
+
+        if ingressed:
+            for chunk in claimed:
+                yield chunk.path, chunk.chunk_index, intermediate.read(
+                    chunk.path)
+        else:
+            indices = (x.chunk_index for x in claimed)
+
+            if self.cache is not None:
+                gen = self.chunks_cache(None, indices)
+            else:
+                gen = prefetch(self.chunks_remote(input_index, None, context,
+                                                  indices),
+                               self.prefetch_depth(
+                                   working_set_multiplier(context)),
+                               self.hostname)
+
+            for item in gen:
+                yield item
+
+    def chunks(self, input_index=None, index=None, context=None,
+               read_ahead=True):
+        """ Generates the chunks of the variable.
+
+        Args:
+            input_index (int): Index of the input in the sorted inputs.
+            index (int): Worker index used to determine the chunks.
+            context (OperationContext): Current context.
+            read_ahead (bool): Whether remote chunks are prefetched.
+
+        Returns:
+            A generator yielding (path, chunk index, data) tuples.
+        """
         if len(self.process) > 0:
             gen = self.chunks_process()
         elif len(self.ingress) > 0:
@@ -777,6 +1669,12 @@ class VariableContext(object):
         elif self.cache is not None:
             gen = self.chunks_cache(index)
         else:
-            gen = self.chunks_remote(input_index, index, context)
+            depth = 0
+
+            if read_ahead:
+                depth = self.prefetch_depth(working_set_multiplier(context))
+
+            gen = prefetch(self.chunks_remote(input_index, index, context),
+                           depth, self.hostname)
 
         return gen
@@ -66,6 +66,7 @@ def determine_queue(process, estimate_size):
 DATETIME_FMT = '%Y-%m-%d %H:%M:%S.%f'
 
 def default(obj):
+    from wps.context import ChunkPlan
     from wps.context import OperationContext
     from wps.context import WorkflowOperationContext
 
@@ -113,6 +114,11 @@ def default(obj):
             },
             '__type': 'function',
         }
+    elif isinstance(obj, ChunkPlan):
+        data = {
+            'data': obj.to_dict(),
+            '__type': 'chunk_plan',
+        }
     elif isinstance(obj, OperationContext):
         data = {
             'data': obj.to_dict(),
@@ -129,6 +135,7 @@ def default(obj):
     return data
 
 def object_hook(obj):
+    from wps.context import ChunkPlan
     from wps.context import OperationContext
     from wps.context import WorkflowOperationContext
 
@@ -157,6 +164,8 @@ def object_hook(obj):
         data = importlib.import_module(obj['data']['module'])
 
         data = getattr(data, obj['data']['name'])
+    elif obj['__type'] == 'chunk_plan':
+        data = ChunkPlan.from_dict(obj['data'])
     elif obj['__type'] == 'operation_context':
         data = OperationContext.from_dict(obj['data'])
     elif obj['__type'] == 'workflow_operation_context':
@@ -0,0 +1,600 @@
+#! /usr/bin/env python
+
+import contextlib
+import cookielib
+import hashlib
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+import requests
+from django import db
+from django.conf import settings
+
+from wps import metrics
+from wps import models
+from wps import WPSError
+
+logger = logging.getLogger('wps.hosts')
+
+THROUGHPUT_TIMEOUT = 24*60*60
+
+CLOSED = models.HostBreaker.CLOSED
+HALF_OPEN = models.HostBreaker.HALF_OPEN
+OPEN = models.HostBreaker.OPEN
+
+BREAKER_STATES = {
+    CLOSED: 0,
+    HALF_OPEN: 1,
+    OPEN: 2,
+}
+
+class HostError(WPSError):
+    """ Transient failure accessing a host. """
+    pass
+
+class HostUnavailableError(WPSError):
+    """ Host is failing, it is not accessed until it recovers. """
+    pass
+
+# Errors of the NetCDF and DAP libraries caused by the network or the server,
+# authorization failures are left out since they are specific to a user
+TRANSPORT_ERRORS = re.compile(r'DAP failure|DAP server error|I/O failure|'
+                              r'curl|timed out|timeout|connection', re.I)
+
+# Per process state shared by all threads of a worker
+SESSIONS = {}
+
+ACCESS = {}
+
+MODIFIED = {}
+
+LOCK = threading.Lock()
+
+# Seconds between attempts to acquire a download slot
+SLOT_POLL = 0.5
+
+def record_transfer(host, nbytes, seconds):
+    """ Records a request made to a host.
+
+    A rolling history of requests shared by all workers is kept in the
+    database, each request is appended as its own row.
+
+    Args:
+        host (str): Host the request was made to.
+        nbytes (int): Number of bytes transferred.
+        seconds (float): Duration of the request.
+    """
+    models.HostTransfer.record(host, nbytes, seconds,
+                               settings.WORKER_THROUGHPUT_HISTORY, time.time())
+
+def estimate_throughput(host):
+    """ Estimates the latency and transfer rate of a host.
+
+    Fits seconds = latency + nbytes / rate over the request history.
+
+    Args:
+        host (str): Host to estimate.
+
+    Returns:
+        A tuple of latency in seconds and rate in bytes per second or None
+        if there is not enough history.
+    """
+    history = models.HostTransfer.history(host,
+                                          settings.WORKER_THROUGHPUT_HISTORY,
+                                          time.time() - THROUGHPUT_TIMEOUT)
+
+    if len(history) < 2:
+        return None
+
+    mean_x = sum(float(x) for x, _ in history) / len(history)
+
+    mean_y = sum(float(y) for _, y in history) / len(history)
+
+    sxx = sum((x - mean_x)**2 for x, _ in history)
+
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in history)
+
+    if sxx == 0 or sxy <= 0:
+        return None
+
+    slope = sxy / sxx
+
+    latency = max(mean_y - slope * mean_x, 0.0)
+
+    return latency, 1.0 / slope
+
+def chunk_size(host, budget):
+    """ Determines the chunk size for requests to a host.
+
+    Chunks are never smaller than the budget or WORKER_CHUNK_MIN_SIZE, every
+    request pays the host's latency and smaller chunks only add requests.
+    Hosts whose latency is more than WORKER_LATENCY_OVERHEAD of a request
+    of that size are logged, larger chunks would need a larger memory
+    budget.
+
+    Args:
+        host (str): Host the data will be read from.
+        budget (float): Maximum number of bytes per chunk.
+
+    Returns:
+        A float number of bytes per chunk.
+    """
+    size = max(budget, settings.WORKER_CHUNK_MIN_SIZE)
+
+    estimate = estimate_throughput(host)
+
+    if estimate is None:
+        return size
+
+    latency, rate = estimate
+
+    overhead = settings.WORKER_LATENCY_OVERHEAD
+
+    target = rate * latency * (1.0 - overhead) / overhead
+
+    if target > size:
+        logger.warning('Host %r latency %r rate %r dominates chunks of %r,'
+                       ' chunks of %r are needed', host, latency, rate, size,
+                       target)
+    else:
+        logger.info('Host %r latency %r rate %r chunk size %r', host, latency,
+                    rate, size)
+
+    return size
+
+def session(host, cert=None):
+    """ Session used for requests to a host.
+
+    Sessions are kept per process for each host and certificate,
+    connections are kept alive and reused between requests with the same
+    credentials. Cookies are never kept between requests so a session
+    cookie set for one user is not sent with another user's requests.
+
+    Args:
+        host (str): Host the requests are made to.
+        cert (str): Path to the certificate the requests are made with.
+
+    Returns:
+        A requests.Session.
+    """
+    key = (host, cert)
+
+    with LOCK:
+        if key not in SESSIONS:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=settings.WORKER_METADATA_HOST_LIMIT)
+
+            SESSIONS[key] = requests.Session()
+
+            SESSIONS[key].cookies.set_policy(
+                cookielib.DefaultCookiePolicy(allowed_domains=[]))
+
+            SESSIONS[key].mount('http://', adapter)
+
+            SESSIONS[key].mount('https://', adapter)
+
+            logger.info('Created session for %r', host)
+
+        return SESSIONS[key]
+
+def access_key(host, user=None, cert=None):
+    """ Key of an access check result.
+
+    Anonymous access is checked for each file, restricted files may be
+    served by a host that serves others publicly.
+
+    Args:
+        host (str): Host being accessed, the URL of the file for anonymous
+            access.
+        user (int): Id of the user accessing the host.
+        cert (str): Certificate used to access the host.
+
+    Returns:
+        A tuple of host, user and certificate fingerprint.
+    """
+    if cert is not None:
+        cert = hashlib.sha1(cert.encode('utf-8')).hexdigest()
+
+    return host, user, cert
+
+def cached_access(key):
+    """ Looks up a cached access check result.
+
+    Args:
+        key (tuple): Key returned by access_key.
+
+    Returns:
+        A tuple of the result and error message of the check or None if
+        there is no result or it has expired.
+    """
+    with LOCK:
+        entry = ACCESS.get(key)
+
+    if entry is None or entry['expires'] < time.time():
+        return None
+
+    return entry['result'], entry['error']
+
+def cache_access(key, result, error=None):
+    """ Caches an access check result.
+
+    Successful checks are cached for WORKER_ACCESS_TTL seconds, failed
+    checks are cached for WORKER_ACCESS_BACKOFF seconds doubling with each
+    consecutive failure up to WORKER_ACCESS_BACKOFF_MAX.
+
+    Args:
+        key (tuple): Key returned by access_key.
+        result (bool): Whether the host was accessible.
+        error (str): Error raised by the check.
+    """
+    with LOCK:
+        if result:
+            failures = 0
+
+            ttl = settings.WORKER_ACCESS_TTL
+        else:
+            failures = ACCESS.get(key, {}).get('failures', 0) + 1
+
+            ttl = min(settings.WORKER_ACCESS_BACKOFF * 2**(failures-1),
+                      settings.WORKER_ACCESS_BACKOFF_MAX)
+
+        ACCESS[key] = {
+            'result': result,
+            'error': error,
+            'failures': failures,
+            'expires': time.time() + ttl,
+        }
+
+    logger.info('Cached access %r for %r for %r seconds', result, key, ttl)
+
+def cached_modified(url):
+    """ Looks up the cached Last-Modified of a file.
+
+    Args:
+        url (str): Url of the file.
+
+    Returns:
+        A tuple of whether the value is cached and the Last-Modified of the
+        file.
+    """
+    with LOCK:
+        entry = MODIFIED.get(url)
+
+    if entry is None or entry['expires'] < time.time():
+        return False, None
+
+    return True, entry['value']
+
+def cache_modified(url, value):
+    """ Caches the Last-Modified of a file for WORKER_ACCESS_TTL seconds.
+
+    Args:
+        url (str): Url of the file.
+        value (str): Last-Modified of the file, None if the host did not
+            send it.
+    """
+    with LOCK:
+        MODIFIED[url] = {
+            'value': value,
+            'expires': time.time() + settings.WORKER_ACCESS_TTL,
+        }
+
+def transport_error(e):
+    """ Whether an exception was caused by the network or the host.
+
+    Only these errors are retried and counted by the host's breaker, other
+    errors e.g. invalid selections, memory errors or authorization failures
+    would otherwise trip the breaker for every user.
+
+    Args:
+        e (Exception): Exception raised accessing a host.
+
+    Returns:
+        A bool.
+    """
+    if isinstance(e, (requests.ConnectionError, requests.Timeout,
+                      socket.error)):
+        return True
+
+    if isinstance(e, (MemoryError, WPSError)):
+        return False
+
+    return TRANSPORT_ERRORS.search(str(e)) is not None
+
+def breaker(host):
+    """ Current circuit breaker of a host.
+
+    The breaker is shared by all workers through the database. A closed
+    breaker lets requests through, after WORKER_BREAKER_THRESHOLD
+    consecutive failures it opens and requests fail fast. After
+    WORKER_BREAKER_RESET seconds it is half open and a single trial
+    request decides whether it closes or opens again.
+
+    Args:
+        host (str): Host to look up.
+
+    Returns:
+        A dict with the state, number of consecutive failures and the time
+        of the last state change.
+    """
+    entry = models.HostBreaker.get(host)
+
+    metrics.WPS_HOST_BREAKER.labels(host).set(BREAKER_STATES[entry.state])
+
+    return {
+        'state': entry.state,
+        'failures': entry.failures,
+        'changed': entry.changed,
+    }
+
+def set_breaker(host, state, failures):
+    models.HostBreaker.objects.update_or_create(host=host, defaults={
+        'state': state,
+        'failures': failures,
+        'changed': time.time(),
+    })
+
+    metrics.WPS_HOST_BREAKER.labels(host).set(BREAKER_STATES[state])
+
+def check_breaker(host):
+    """ Checks whether a host can be accessed.
+
+    Args:
+        host (str): Host to check.
+
+    Raises:
+        HostUnavailableError: If the breaker of the host is open or a trial
+            request is in progress.
+    """
+    entry = breaker(host)
+
+    if entry['state'] == CLOSED:
+        return
+
+    now = time.time()
+
+    elapsed = now - entry['changed']
+
+    if elapsed < settings.WORKER_BREAKER_RESET:
+        raise HostUnavailableError('Host {!r} is unavailable, retrying in {!r}'
+                                   ' seconds', host,
+                                   int(settings.WORKER_BREAKER_RESET - elapsed))
+
+    # Only one worker makes the trial request, others fail fast until it
+    # finishes
+    if not models.HostBreaker.trial(host, now - settings.WORKER_BREAKER_RESET,
+                                    now):
+        raise HostUnavailableError('Host {!r} is unavailable, a trial request '
+                                   'is in progress', host)
+
+    logger.info('Trial request to %r', host)
+
+    metrics.WPS_HOST_BREAKER.labels(host).set(BREAKER_STATES[HALF_OPEN])
+
+def record_success(host):
+    """ Records a successful request to a host, closing its breaker.
+
+    Args:
+        host (str): Host the request was made to.
+    """
+    if models.HostBreaker.close(host, time.time()):
+        logger.info('Closed breaker of %r', host)
+
+        metrics.WPS_HOST_BREAKER.labels(host).set(BREAKER_STATES[CLOSED])
+
+def record_failure(host):
+    """ Records a failed request to a host.
+
+    Args:
+        host (str): Host the request was made to.
+
+    Returns:
+        A bool whether the breaker of the host is open.
+    """
+    metrics.WPS_DATA_ACCESS_FAILED.labels(host).inc()
+
+    entry = models.HostBreaker.fail(host, settings.WORKER_BREAKER_THRESHOLD,
+                                    time.time())
+
+    metrics.WPS_HOST_BREAKER.labels(host).set(BREAKER_STATES[entry.state])
+
+    if entry.state == OPEN:
+        logger.info('Breaker of %r is open after %r failures', host,
+                    entry.failures)
+
+        return True
+
+    return False
+
+def retry(host, func, *args, **kwargs):
+    """ Calls a function accessing a host, retrying transient failures.
+
+    Retries wait a random time of up to WORKER_RETRY_BACKOFF seconds
+    doubling with each attempt, capped at WORKER_RETRY_BACKOFF_MAX.
+
+    Args:
+        host (str): Host accessed by the function.
+        func (function): Function to call, raises HostError on transient
+            failures.
+
+    Returns:
+        The result of the function.
+
+    Raises:
+        HostUnavailableError: If the breaker of the host is open.
+        HostError: If the last attempt failed.
+    """
+    attempt = 0
+
+    while True:
+        check_breaker(host)
+
+        try:
+            result = func(*args, **kwargs)
+        except HostError as e:
+            attempt += 1
+
+            opened = record_failure(host)
+
+            if opened or attempt >= settings.WORKER_RETRY_ATTEMPTS:
+                raise
+
+            delay = random.uniform(0, min(settings.WORKER_RETRY_BACKOFF *
+                                          2**(attempt-1),
+                                          settings.WORKER_RETRY_BACKOFF_MAX))
+
+            logger.info('Attempt %r accessing %r failed %r, retrying in %r '
+                        'seconds', attempt, host, e, delay)
+
+            time.sleep(delay)
+        else:
+            record_success(host)
+
+            return result
+
+class LocalSemaphore(object):
+    """ Download slots shared by the threads of a single process. """
+    leased = False
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.held = {}
+
+    def acquire(self, host, limit, timeout):
+        deadline = time.time() + timeout
+
+        with self.condition:
+            while self.held.get(host, 0) >= limit:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    return None
+
+                self.condition.wait(remaining)
+
+            self.held[host] = self.held.get(host, 0) + 1
+
+        return host
+
+    def release(self, host, token):
+        with self.condition:
+            self.held[host] -= 1
+
+            self.condition.notify_all()
+
+class DatabaseSemaphore(object):
+    """ Download slots shared by all workers through the database. """
+    leased = True
+
+    def acquire(self, host, limit, timeout):
+        deadline = time.time() + timeout
+
+        token = uuid.uuid4().hex
+
+        while not models.HostSlot.acquire(host, limit, token,
+                                          settings.WORKER_HOST_LEASE):
+            if time.time() >= deadline:
+                return None
+
+            time.sleep(random.uniform(0, 2 * SLOT_POLL))
+
+        return token
+
+    def renew(self, host, token, lease):
+        return models.HostSlot.renew(host, token, lease)
+
+    def release(self, host, token):
+        models.HostSlot.release(host, token)
+
+SEMAPHORES = {
+    'local': LocalSemaphore(),
+    'database': DatabaseSemaphore(),
+}
+
+def renew_slot(semaphore, host, token, stop):
+    """ Renews the lease of a download slot until stopped.
+
+    The lease is renewed every third of WORKER_HOST_LEASE so downloads
+    taking longer than the lease keep their slot.
+
+    Args:
+        semaphore (DatabaseSemaphore): Semaphore the slot belongs to.
+        host (str): Host the slot belongs to.
+        token (str): Token identifying the holder.
+        stop (threading.Event): Event set once the slot is released.
+    """
+    interval = max(settings.WORKER_HOST_LEASE / 3.0, SLOT_POLL)
+
+    try:
+        while not stop.wait(interval):
+            if not semaphore.renew(host, token, settings.WORKER_HOST_LEASE):
+                logger.warning('Lost download slot of %r', host)
+
+                return
+    finally:
+        # The thread has its own database connection
+        db.connection.close()
+
+def host_limit(host):
+    """ Number of concurrent downloads allowed from a host.
+
+    Args:
+        host (str): Host to look up.
+
+    Returns:
+        An int number of downloads, 0 if there is no limit.
+    """
+    return settings.WORKER_HOST_LIMITS.get(host, settings.WORKER_HOST_LIMIT)
+
+@contextlib.contextmanager
+def download_slot(host):
+    """ Holds one of a host's download slots.
+
+    Waits until fewer than host_limit(host) downloads from the host are in
+    progress across all workers.
+
+    Args:
+        host (str): Host the download is made from.
+
+    Raises:
+        WPSError: If no slot was freed within WORKER_HOST_WAIT seconds.
+    """
+    limit = host_limit(host)
+
+    if limit < 1:
+        yield
+
+        return
+
+    semaphore = SEMAPHORES[settings.WORKER_HOST_SEMAPHORE]
+
+    start = time.time()
+
+    token = semaphore.acquire(host, limit, settings.WORKER_HOST_WAIT)
+
+    metrics.WPS_HOST_WAIT.labels(host).observe(time.time() - start)
+
+    if token is None:
+        raise WPSError('Timed out waiting to download from {!r}', host)
+
+    stop = threading.Event()
+
+    if semaphore.leased:
+        renewer = threading.Thread(target=renew_slot,
+                                   args=(semaphore, host, token, stop))
+
+        renewer.daemon = True
+
+        renewer.start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+
+        semaphore.release(host, token)
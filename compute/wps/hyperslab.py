@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+
+import logging
+import threading
+
+import cdms2
+import numpy as np
+
+from wps import WPSError
+
+logger = logging.getLogger('wps.hyperslab')
+
+def slice_key(value):
+    return value.start, value.stop, value.step
+
+def copy_axis(axis, values=None, bounds=None):
+    """ Creates a transient copy of an axis.
+
+    Args:
+        axis (cdms2.axis.AbstractAxis): Axis to copy.
+        values (numpy.ndarray): Values replacing those of the axis.
+        bounds (numpy.ndarray): Bounds replacing those of the axis.
+
+    Returns:
+        A cdms2.axis.TransientAxis.
+    """
+    if values is None:
+        values = axis[:]
+
+        bounds = axis.getBounds()
+
+    copy = cdms2.createAxis(np.array(values), bounds, id=axis.id)
+
+    for name, value in axis.attributes.iteritems():
+        setattr(copy, name, value)
+
+    return copy
+
+def concat_axes(axes):
+    """ Concatenates axes.
+
+    Args:
+        axes (list): List of cdms2.axis.AbstractAxis with the same id.
+
+    Returns:
+        A cdms2.axis.TransientAxis.
+    """
+    if len(axes) == 1:
+        return copy_axis(axes[0])
+
+    values = np.concatenate([x[:] for x in axes])
+
+    bounds = [x.getBounds() for x in axes]
+
+    if any(x is None for x in bounds):
+        bounds = None
+    else:
+        bounds = np.concatenate(bounds)
+
+    return copy_axis(axes[0], values, bounds)
+
+class HyperslabWriter(object):
+    """ Writes a variable to an output file one chunk at a time.
+
+    The axes of every chunk are registered before any data is read. The
+    output variable is created with its final shape and each chunk is
+    written directly to its hyperslab, only the chunk being written is held
+    in memory.
+
+    Inputs are concatenated over the time axis in the order they are
+    added, the chunks of an input are placed by their slices in the input's
+    chunk plan.
+    """
+    def __init__(self, outfile, var_name, lock=None):
+        self.outfile = outfile
+        self.var_name = var_name
+        self.lock = lock or threading.RLock()
+        self.axes = None
+        self.time_index = None
+        self.time_axes = []
+        self.inputs = []
+        self.variable = None
+        self.fill_value = None
+
+    def add_input(self, plan, chunk_axes, split):
+        """ Registers the chunks of an input.
+
+        Args:
+            plan (wps.context.ChunkPlan): Chunk plan of the input.
+            chunk_axes (list): List of (chunk index, axes) tuples.
+            split (list): Names of the axes chunks are placed along.
+
+        Returns:
+            An int index of the input.
+        """
+        if len(chunk_axes) == 0:
+            raise WPSError('Input has no chunks')
+
+        first = chunk_axes[0][1]
+
+        names = [x.id for x in first]
+
+        split = [x for x in split if x in names]
+
+        segments = dict((x, {}) for x in split)
+
+        for chunk_index, axes in chunk_axes:
+            for axis in axes:
+                if axis.id in segments:
+                    key = slice_key(plan[chunk_index][axis.id])
+
+                    segments[axis.id][key] = axis
+
+        positions = {}
+
+        axes = []
+
+        for axis in first:
+            if axis.id not in segments:
+                axes.append(axis)
+
+                continue
+
+            keys = sorted(segments[axis.id])
+
+            position = 0
+
+            for key in keys:
+                positions[(axis.id, key)] = position
+
+                position += len(segments[axis.id][key])
+
+            axes.append(concat_axes([segments[axis.id][x] for x in keys]))
+
+        offsets = {}
+
+        for chunk_index, _ in chunk_axes:
+            offsets[chunk_index] = [
+                positions.get((x, slice_key(plan[chunk_index][x])), 0)
+                if x in segments else 0 for x in names
+            ]
+
+        time_index = [x for x, y in enumerate(axes) if y.isTime()]
+
+        if self.axes is None:
+            self.axes = axes
+
+            self.time_index = time_index[0] if len(time_index) > 0 else None
+        elif self.time_index is None:
+            raise WPSError('Unable to concatenate inputs without a time axis')
+        elif [x.id for x in axes] != [x.id for x in self.axes]:
+            raise WPSError('Unable to concatenate inputs with axes {!r} and '
+                           '{!r}', [x.id for x in self.axes],
+                           [x.id for x in axes])
+
+        if self.time_index is None:
+            base = 0
+        else:
+            base = sum(len(x) for x in self.time_axes)
+
+            self.time_axes.append(axes[self.time_index])
+
+        self.inputs.append((base, offsets))
+
+        return len(self.inputs) - 1
+
+    def output_axes(self):
+        axes = list(self.axes)
+
+        if self.time_index is not None:
+            axes[self.time_index] = concat_axes(self.time_axes)
+
+        return axes
+
+    def create(self, template):
+        axes = self.output_axes()
+
+        self.fill_value = template.fill_value
+
+        with self.lock:
+            file_axes = [self.outfile.copyAxis(x) for x in axes]
+
+            self.variable = self.outfile.createVariable(
+                self.var_name, template.dtype.char, file_axes,
+                fill_value=self.fill_value)
+
+            for name, value in template.attributes.iteritems():
+                if name in ('id', 'name', '_FillValue'):
+                    continue
+
+                setattr(self.variable, name, value)
+
+        logger.info('Created %r with shape %r', self.var_name,
+                    self.variable.shape)
+
+    def write(self, input_index, chunk_index, data):
+        """ Writes a chunk to its hyperslab.
+
+        Args:
+            input_index (int): Index returned by add_input.
+            chunk_index (int): Index of the chunk, None if the data covers
+                the whole input.
+            data (cdms2.tvariable.TransientVariable): Data of the chunk.
+        """
+        if self.variable is None:
+            self.create(data)
+
+        base, offsets = self.inputs[input_index]
+
+        if chunk_index is None:
+            offset = [0 for _ in data.shape]
+        else:
+            offset = list(offsets[chunk_index])
+
+        if self.time_index is not None:
+            offset[self.time_index] += base
+
+        index = tuple(slice(x, x + y) for x, y in zip(offset, data.shape))
+
+        logger.info('Writing %r to %r', data.shape, index)
+
+        values = np.ma.filled(data, self.fill_value)
+
+        with self.lock:
+            self.variable[index] = values
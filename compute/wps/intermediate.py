@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+
+import json
+import logging
+import os
+
+import cdms2
+import numpy as np
+
+from wps import metrics
+
+logger = logging.getLogger('wps.intermediate')
+
+EXTENSION = '.npy'
+
+MASK_EXTENSION = '.mask'
+
+SIDECAR_EXTENSION = '.json'
+
+def paths(path):
+    """ Paths of the files storing an intermediate chunk.
+
+    Args:
+        path (str): Path of the data file.
+
+    Returns:
+        A tuple of the data, mask and sidecar paths.
+    """
+    base, _ = os.path.splitext(path)
+
+    return path, base + MASK_EXTENSION, base + SIDECAR_EXTENSION
+
+def jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+def describe_axis(axis):
+    bounds = axis.getBounds()
+
+    return {
+        'id': axis.id,
+        'values': axis[:].tolist(),
+        'bounds': bounds.tolist() if bounds is not None else None,
+        'attributes': dict((x, jsonable(y)) for x, y in
+                           axis.attributes.iteritems()),
+    }
+
+def create_axis(description):
+    bounds = description['bounds']
+
+    if bounds is not None:
+        bounds = np.array(bounds)
+
+    axis = cdms2.createAxis(np.array(description['values']), bounds,
+                            id=str(description['id']))
+
+    for name, value in description['attributes'].iteritems():
+        setattr(axis, str(name), value)
+
+    return axis
+
+def write(path, variable):
+    """ Writes an intermediate chunk.
+
+    The data is stored as a raw .npy file. The mask is stored as a packed
+    bitmap when any value is masked. The axes and attributes are stored in
+    a JSON sidecar.
+
+    Args:
+        path (str): Path of the data file.
+        variable (cdms2.tvariable.TransientVariable): Chunk to write.
+
+    Returns:
+        An int number of bytes written.
+    """
+    data_path, mask_path, sidecar_path = paths(path)
+
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+
+    mask = np.ma.getmaskarray(variable)
+
+    masked = bool(mask.any())
+
+    np.save(data_path, np.ma.getdata(variable))
+
+    if masked:
+        with open(mask_path, 'wb') as outfile:
+            outfile.write(np.packbits(mask.ravel()).tostring())
+
+    sidecar = {
+        'id': variable.id,
+        'masked': masked,
+        'fill_value': jsonable(variable.fill_value),
+        'attributes': dict((x, jsonable(y)) for x, y in
+                           variable.attributes.iteritems()),
+        'axes': [describe_axis(x) for x in variable.getAxisList()],
+    }
+
+    with open(sidecar_path, 'w') as outfile:
+        json.dump(sidecar, outfile)
+
+    nbytes = sum(os.stat(x).st_size for x in (data_path, mask_path,
+                                              sidecar_path)
+                 if os.path.exists(x))
+
+    metrics.WPS_DATA_OUTPUT.inc(nbytes)
+
+    return nbytes
+
+def read_sidecar(sidecar_path):
+    with open(sidecar_path) as infile:
+        return json.load(infile)
+
+def read_axes(path):
+    """ Reads the axes of an intermediate chunk without its data.
+
+    Args:
+        path (str): Path of the data file.
+
+    Returns:
+        A list of cdms2.axis.TransientAxis.
+    """
+    _, _, sidecar_path = paths(path)
+
+    return [create_axis(x) for x in read_sidecar(sidecar_path)['axes']]
+
+def read(path):
+    """ Reads an intermediate chunk.
+
+    The data is memory mapped copy on write, it is only read from disk as
+    it is accessed.
+
+    Args:
+        path (str): Path of the data file.
+
+    Returns:
+        A cdms2.tvariable.TransientVariable.
+    """
+    data_path, mask_path, sidecar_path = paths(path)
+
+    sidecar = read_sidecar(sidecar_path)
+
+    data = np.load(data_path, mmap_mode='c')
+
+    mask = np.ma.nomask
+
+    if sidecar['masked']:
+        bits = np.fromfile(mask_path, dtype=np.uint8)
+
+        mask = np.unpackbits(bits)[:data.size].reshape(data.shape).astype(bool)
+
+    axes = [create_axis(x) for x in sidecar['axes']]
+
+    attributes = dict((str(x), y) for x, y in
+                      sidecar['attributes'].iteritems())
+
+    return cdms2.createVariable(data, mask=mask, axes=axes,
+                                id=str(sidecar['id']),
+                                fill_value=sidecar['fill_value'],
+                                attributes=attributes, copy=0)
+
+def remove(path):
+    """ Removes the files of an intermediate chunk.
+
+    Args:
+        path (str): Path of the data file.
+    """
+    for file_path in paths(path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
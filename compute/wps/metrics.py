@@ -75,11 +75,20 @@ else:
 WPS_REGRID = Counter('wps_regrid_total', 'Number of times specific regridding'
                      ' is requested', ['tool', 'method', 'grid'])
 
+WPS_REGRID_WEIGHTS = Counter('wps_regrid_weights_total', 'Number of regridding'
+                             ' weight lookups by where the weights were found',
+                             ['source'])
+
 WPS_DOMAIN_CRS = Counter('wps_domain_crs_total', 'Number of times a specific'
                          ' CRS is used', ['crs'])
 
 WPS_DATA_DOWNLOAD = Summary('wps_data_download_seconds', 'Number of seconds'
                             ' spent downloading remote data', ['host'])
+WPS_CHUNK_WAIT = Summary('wps_chunk_wait_seconds', 'Number of seconds'
+                         ' spent waiting for prefetched chunks', ['host'])
+WPS_HOST_WAIT = Summary('wps_host_wait_seconds', 'Number of seconds spent'
+                        ' waiting for a download slot of a remote site',
+                        ['host'])
 WPS_DATA_DOWNLOAD_BYTES = Counter('wps_data_download_bytes', 'Number of bytes'
                                   ' read remotely', ['host', 'variable'])
 
@@ -87,6 +96,10 @@ WPS_DATA_ACCESS_FAILED = Counter('wps_data_access_failed_total', 'Number'
                                    ' of times remote sites are inaccesible',
                                    ['host'])
 
+WPS_HOST_BREAKER = Gauge('wps_host_breaker_state', 'Circuit breaker state'
+                         ' of remote sites (0 closed, 1 half open, 2 open)',
+                         ['host'], multiprocess_mode='liveall')
+
 WPS_DATA_CACHE_READ = Counter('wps_data_cache_read_bytes', 'Number of bytes'
                               ' read from cache')
 
@@ -98,6 +111,9 @@ WPS_DATA_OUTPUT = Counter('wps_data_output_bytes', 'Number of bytes written')
 WPS_PROCESS_TIME = Summary('wps_process', 'Processing duration (seconds)',
                            ['identifier'])
 
+WPS_PREPROCESS_TIME = Summary('wps_preprocess', 'Preprocessing duration'
+                              ' (seconds)', ['task'])
+
 WPS_CERT_DOWNLOAD = Counter('wps_cert_download', 'Number of times certificates'
                             ' have been downloaded')
 
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2019-03-12 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wps', '0040_update_process'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AxisMetadata',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=512)),
+                ('variable', models.CharField(max_length=64)),
+                ('last_modified', models.CharField(blank=True, max_length=64)),
+                ('itemsize', models.PositiveIntegerField(null=True)),
+                ('storage_chunks', models.TextField(null=True)),
+                ('axes', models.TextField()),
+                ('coordinates', models.BinaryField()),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='axismetadata',
+            unique_together=set([('url', 'variable')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2019-03-14 09:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wps', '0041_axis_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('input_index', models.PositiveIntegerField()),
+                ('chunk_index', models.PositiveIntegerField()),
+                ('nbytes', models.BigIntegerField(default=0)),
+                ('stage', models.CharField(max_length=64)),
+                ('state', models.CharField(default='queued', max_length=64)),
+                ('task_id', models.CharField(blank=True, max_length=256)),
+                ('path', models.CharField(blank=True, max_length=512)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wps.Job')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='jobchunk',
+            unique_together=set([('job', 'input_index', 'chunk_index')]),
+        ),
+    ]
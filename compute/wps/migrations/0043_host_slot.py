@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2019-03-18 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wps', '0042_job_chunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostSlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('host', models.CharField(max_length=256)),
+                ('slot', models.PositiveIntegerField()),
+                ('token', models.CharField(blank=True, max_length=64)),
+                ('expires', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='hostslot',
+            unique_together=set([('host', 'slot')]),
+        ),
+    ]
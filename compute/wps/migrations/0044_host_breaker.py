@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2019-03-20 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wps', '0043_host_slot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostBreaker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('host', models.CharField(max_length=256, unique=True)),
+                ('state', models.CharField(default='closed', max_length=64)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('changed', models.FloatField(default=0)),
+            ],
+        ),
+    ]
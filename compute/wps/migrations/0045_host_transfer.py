@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.9 on 2019-03-22 10:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wps', '0044_host_breaker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('host', models.CharField(db_index=True, max_length=256)),
+                ('nbytes', models.BigIntegerField()),
+                ('seconds', models.FloatField()),
+                ('created', models.FloatField()),
+            ],
+        ),
+    ]
@@ -4,6 +4,7 @@ import base64
 import contextlib
 import datetime
 import hashlib
+import io
 import json
 import logging
 import os
@@ -15,8 +16,10 @@ from urlparse import urlparse
 
 import cdms2
 import cwt
+import numpy as np
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
 from django.db.models import F
@@ -29,6 +32,7 @@ from openid.store import nonce
 
 from wps import helpers
 from wps import metrics
+from wps import WPSError
 from wps.util import wps_response
 
 logger = logging.getLogger('wps.models')
@@ -348,6 +352,201 @@ class Cache(models.Model):
     def __str__(self):
         return '{0.local_path}'.format(self)
 
+def storage_chunk_sizes(var, order):
+    """ Reads the storage chunk shape of a variable.
+
+    The shape is read from the `_ChunkSizes` attribute exposed by OpenDAP
+    servers and the netCDF library, variables without it are treated as
+    contiguous.
+
+    Args:
+        var (cdms2.fvariable.FileVariable): Variable to inspect.
+        order (list): Axis names in the order of the variable.
+
+    Returns:
+        A dict of axis names to storage chunk sizes or None if the variable
+        is not chunked.
+    """
+    sizes = getattr(var, 'attributes', {}).get('_ChunkSizes', None)
+
+    try:
+        sizes = [int(x) for x in np.atleast_1d(sizes)]
+    except (TypeError, ValueError):
+        return None
+
+    if len(sizes) != len(order):
+        return None
+
+    return dict(zip(order, sizes))
+
+# Key of the bounds of an axis in the coordinates archive
+BOUNDS_KEY = '{}.bounds'
+
+class AxisMetadata(models.Model):
+    url = models.CharField(max_length=512)
+    variable = models.CharField(max_length=64)
+    last_modified = models.CharField(blank=True, max_length=64)
+    itemsize = models.PositiveIntegerField(null=True)
+    storage_chunks = models.TextField(null=True)
+    axes = models.TextField()
+    coordinates = models.BinaryField()
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('url', 'variable'),)
+
+    @classmethod
+    def lookup(cls, url, variable, last_modified=None):
+        """ Looks up the metadata for a variable.
+
+        Args:
+            url (str): Url of the file.
+            variable (str): Name of the variable.
+            last_modified (str): Current Last-Modified of the file, entries
+                recorded with a different value are removed.
+
+        Returns:
+            An AxisMetadata or None if missing or stale.
+        """
+        try:
+            entry = cls.objects.get(url=url, variable=variable)
+        except cls.DoesNotExist:
+            return None
+
+        if last_modified is not None and entry.last_modified != last_modified:
+            logger.info('Removing stale axis metadata for %r modified %r',
+                        url, last_modified)
+
+            entry.delete()
+
+            return None
+
+        return entry
+
+    @classmethod
+    def from_variable(cls, url, var, last_modified=None):
+        """ Records the metadata of a variable.
+
+        Args:
+            url (str): Url of the file.
+            var (cdms2.fvariable.FileVariable): Variable to record.
+            last_modified (str): Last-Modified of the file.
+
+        Returns:
+            An AxisMetadata.
+        """
+        axes = []
+        coordinates = {}
+
+        for axis in var.getAxisList():
+            values = np.array(axis[:])
+
+            bounds = axis.getBounds()
+
+            is_longitude = bool(axis.isLongitude())
+
+            axes.append({
+                'id': axis.id,
+                'length': len(axis),
+                'units': getattr(axis, 'units', None) or None,
+                'calendar': getattr(axis, 'calendar', None) or None,
+                'first': float(values[0]) if values.size > 0 else None,
+                'last': float(values[-1]) if values.size > 0 else None,
+                'time': bool(axis.isTime()),
+                'latitude': bool(axis.isLatitude()),
+                'longitude': is_longitude,
+                'circular': is_longitude and bool(axis.isCircular()),
+            })
+
+            coordinates[axis.id] = values
+
+            if bounds is not None:
+                coordinates[BOUNDS_KEY.format(axis.id)] = np.array(bounds)
+
+        buf = io.BytesIO()
+
+        np.savez_compressed(buf, **coordinates)
+
+        order = [x['id'] for x in axes]
+
+        defaults = {
+            'last_modified': last_modified or '',
+            'itemsize': var.dtype.itemsize,
+            'storage_chunks': json.dumps(storage_chunk_sizes(var, order)),
+            'axes': json.dumps(axes),
+            'coordinates': buf.getvalue(),
+        }
+
+        entry, _ = cls.objects.update_or_create(url=url, variable=var.id,
+                                                defaults=defaults)
+
+        logger.info('Recorded axis metadata for %r %r', url, order)
+
+        return entry
+
+    @property
+    def nbytes(self):
+        lengths = [x['length'] for x in json.loads(self.axes)]
+
+        return (self.itemsize or 4) * reduce(lambda x, y: x * y, lengths, 1)
+
+    @property
+    def chunk_sizes(self):
+        return helpers.byteify(json.loads(self.storage_chunks or 'null'))
+
+    def load_coordinates(self):
+        data = np.load(io.BytesIO(bytes(self.coordinates)))
+
+        try:
+            return dict((x, data[x]) for x in data.files)
+        finally:
+            data.close()
+
+    def axis_list(self):
+        """ Builds the variable's axes from the recorded metadata.
+
+        Returns:
+            A list of cdms2.axis.TransientAxis.
+        """
+        coordinates = self.load_coordinates()
+
+        axes = []
+
+        for desc in json.loads(self.axes):
+            bounds = coordinates.get(BOUNDS_KEY.format(desc['id']), None)
+
+            axis = cdms2.createAxis(coordinates[desc['id']], bounds,
+                                    id=str(desc['id']))
+
+            if desc['units'] is not None:
+                axis.units = str(desc['units'])
+
+            if desc['calendar'] is not None:
+                axis.calendar = str(desc['calendar'])
+
+            if desc['time']:
+                axis.designateTime()
+            elif desc['latitude']:
+                axis.designateLatitude()
+            elif desc['longitude']:
+                axis.designateLongitude()
+
+                if desc['circular']:
+                    axis.topology = 'circular'
+
+            axes.append(axis)
+
+        return axes
+
+    def get_time(self):
+        try:
+            return [x for x in self.axis_list() if x.isTime()][0]
+        except IndexError:
+            return None
+
+    def __str__(self):
+        return '{0.url} {0.variable}'.format(self)
+
 class Auth(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
@@ -647,6 +846,521 @@ class Job(models.Model):
             } for x in self.status_set.filter(updated_date__gt=date)
         ]
 
+class JobChunk(models.Model):
+    """ Chunk in a job's work queue.
+
+    Workers claim queued chunks until the queue is empty. A chunk moves
+    through the ingress and process stages, the manifest records the task
+    and output path of the last stage that handled it.
+
+    Claims are leased, a worker renews the lease of its claims from a
+    heartbeat while it runs. Chunks whose lease expired, or that were
+    claimed by an earlier delivery of the same task, are queued again.
+    """
+    INGRESS = 'ingress'
+    PROCESS = 'process'
+
+    QUEUED = 'queued'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+
+    # Number of queued chunks fetched per claim attempt
+    CLAIM_BATCH = 8
+
+    # Seconds between polls while waiting on another stage
+    CLAIM_POLL = 1
+
+    job = models.ForeignKey(Job, on_delete=models.CASCADE)
+    input_index = models.PositiveIntegerField()
+    chunk_index = models.PositiveIntegerField()
+    nbytes = models.BigIntegerField(default=0)
+    stage = models.CharField(max_length=64)
+    state = models.CharField(max_length=64, default=QUEUED)
+    task_id = models.CharField(max_length=256, blank=True)
+    path = models.CharField(max_length=512, blank=True)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('job', 'input_index', 'chunk_index'),)
+
+    @classmethod
+    def enqueue(cls, job, chunks):
+        """ Replaces the job's queue.
+
+        Args:
+            job (Job): Job the chunks belong to.
+            chunks (list): List of (input index, chunk index, nbytes, stage)
+                tuples.
+        """
+        cls.objects.filter(job=job).delete()
+
+        cls.objects.bulk_create([
+            cls(job=job, input_index=w, chunk_index=x, nbytes=y, stage=z)
+            for w, x, y, z in chunks
+        ])
+
+    @classmethod
+    def claim(cls, job, stage, input_index, task_id):
+        """ Claims a queued chunk.
+
+        Largest chunks are claimed first. A chunk is claimed with a
+        conditional update, if another worker claimed it first the next
+        candidate is tried.
+
+        Args:
+            job (Job): Job to claim from.
+            stage (str): Stage the chunk is queued for.
+            input_index (int): Input the chunk belongs to.
+            task_id (str): Id of the claiming task.
+
+        Returns:
+            The claimed JobChunk or None if the queue is empty.
+        """
+        while True:
+            candidates = list(cls.objects.filter(
+                job=job, stage=stage, input_index=input_index,
+                state=cls.QUEUED
+            ).order_by('-nbytes', 'chunk_index').values_list(
+                'pk', flat=True)[:cls.CLAIM_BATCH])
+
+            if len(candidates) == 0:
+                return None
+
+            for pk in candidates:
+                claimed = cls.objects.filter(pk=pk, state=cls.QUEUED).update(
+                    state=cls.CLAIMED, task_id=task_id or '',
+                    updated_date=timezone.now())
+
+                if claimed == 1:
+                    return cls.objects.get(pk=pk)
+
+    @classmethod
+    def requeue(cls, job, stage, input_index=None, exclude=None):
+        """ Queues chunks whose lease expired.
+
+        Args:
+            job (Job): Job the chunks belong to.
+            stage (str): Stage the chunks are claimed for.
+            input_index (int): Input the chunks belong to, all inputs if None.
+            exclude (str): Id of a task whose claims are kept.
+
+        Returns:
+            The number of chunks queued.
+        """
+        expired = timezone.now() - datetime.timedelta(
+            seconds=settings.WORKER_CLAIM_TIMEOUT)
+
+        claimed = cls.objects.filter(job=job, stage=stage, state=cls.CLAIMED,
+                                     updated_date__lt=expired)
+
+        if input_index is not None:
+            claimed = claimed.filter(input_index=input_index)
+
+        count = claimed.exclude(task_id=exclude or '').update(
+            state=cls.QUEUED, task_id='')
+
+        if count > 0:
+            logger.info('Queued %r abandoned chunks of job %r', count, job.id)
+
+        return count
+
+    @classmethod
+    def renew(cls, job, task_id):
+        cls.objects.filter(job=job, state=cls.CLAIMED,
+                           task_id=task_id or '').update(
+                               updated_date=timezone.now())
+
+    @classmethod
+    def claims(cls, job, stage, input_index, task_id):
+        """ Claims chunks until none are queued.
+
+        Chunks whose lease expired are queued again and claimed before
+        returning. Chunks claimed by other workers are not waited on, a task
+        waits once for them with `wait` after claiming from all its inputs.
+
+        Args:
+            job (Job): Job to claim from.
+            stage (str): Stage the chunks are queued for.
+            input_index (int): Input the chunks belong to.
+            task_id (str): Id of the claiming task.
+
+        Returns:
+            A generator yielding JobChunk.
+        """
+        if task_id:
+            # An earlier delivery of this task died holding its claims
+            cls.objects.filter(job=job, stage=stage, input_index=input_index,
+                               state=cls.CLAIMED, task_id=task_id).update(
+                                   state=cls.QUEUED, task_id='')
+
+        while True:
+            chunk = cls.claim(job, stage, input_index, task_id)
+
+            if chunk is not None:
+                yield chunk
+
+                continue
+
+            if cls.requeue(job, stage, input_index, task_id) == 0:
+                return
+
+    @classmethod
+    def wait(cls, job, stage, task_id):
+        """ Waits until the chunks of a stage are done.
+
+        Chunks claimed by other workers are waited on until they are done or
+        their lease expires and they are queued again. While processing,
+        chunks still being ingressed are waited on as well.
+
+        Processing workers reducing over the split axis complete their
+        claims only once they stop claiming, the task's claims must be
+        completed before waiting.
+
+        Args:
+            job (Job): Job the chunks belong to.
+            stage (str): Stage the chunks are queued for.
+            task_id (str): Id of the waiting task.
+
+        Returns:
+            A bool whether chunks were queued again and should be claimed.
+
+        Raises:
+            WPSError: If the chunks are not done within WORKER_QUEUE_TIMEOUT
+                seconds.
+        """
+        waited = 0
+
+        while True:
+            if cls.objects.filter(job=job, stage=stage,
+                                  state=cls.QUEUED).exists():
+                return True
+
+            waiting = cls.objects.filter(job=job)
+
+            if stage != cls.PROCESS:
+                waiting = waiting.filter(stage=stage)
+
+            waiting = waiting.exclude(state=cls.DONE).exclude(
+                state=cls.CLAIMED, task_id=task_id or '')
+
+            if not waiting.exists():
+                return False
+
+            if cls.requeue(job, stage, exclude=task_id) > 0:
+                return True
+
+            if waited >= settings.WORKER_QUEUE_TIMEOUT:
+                raise WPSError('Timed out waiting for chunks of job {!r}',
+                               job.id)
+
+            time.sleep(cls.CLAIM_POLL)
+
+            waited += cls.CLAIM_POLL
+
+    @classmethod
+    def complete(cls, job, input_index, chunk_index, path, next_stage=None):
+        """ Marks a chunk as handled.
+
+        Args:
+            job (Job): Job the chunk belongs to.
+            input_index (int): Input the chunk belongs to.
+            chunk_index (int): Index of the chunk.
+            path (str): Path of the output of the stage.
+            next_stage (str): Stage to queue the chunk for.
+        """
+        if next_stage is None:
+            kwargs = {'state': cls.DONE}
+        else:
+            kwargs = {'state': cls.QUEUED, 'stage': next_stage}
+
+        cls.objects.filter(job=job, input_index=input_index,
+                           chunk_index=chunk_index).update(path=path, **kwargs)
+
+    @classmethod
+    def pending(cls, job):
+        """ Number of chunks of each input that are not done.
+
+        Args:
+            job (Job): Job to describe.
+
+        Returns:
+            A dict mapping input index to the number of chunks.
+        """
+        rows = cls.objects.filter(job=job).exclude(state=cls.DONE).values_list(
+            'input_index', flat=True)
+
+        counts = {}
+
+        for input_index in rows:
+            counts[input_index] = counts.get(input_index, 0) + 1
+
+        return counts
+
+    @classmethod
+    def manifest(cls, job):
+        """ Outputs of the job's chunks.
+
+        Args:
+            job (Job): Job to describe.
+
+        Returns:
+            A dict mapping input index to the stage and chunk output paths
+            ordered by chunk index.
+        """
+        manifest = {}
+
+        chunks = cls.objects.filter(job=job, state=cls.DONE).order_by(
+            'input_index', 'chunk_index')
+
+        for chunk in chunks:
+            _, paths = manifest.setdefault(chunk.input_index, (chunk.stage, []))
+
+            paths.append(chunk.path)
+
+        return manifest
+
+    def __str__(self):
+        return '{0.job_id} {0.input_index} {0.chunk_index} {0.stage} {0.state}'.format(self)
+
+class HostSlot(models.Model):
+    """ Download slot of a remote host shared by all workers.
+
+    A host has one row per slot, a worker holds a slot while it reads from
+    the host. Slots are leased, a slot held by a worker that died is freed
+    when its lease expires.
+    """
+    host = models.CharField(max_length=256)
+    slot = models.PositiveIntegerField()
+    token = models.CharField(max_length=64, blank=True)
+    expires = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('host', 'slot'),)
+
+    @classmethod
+    def create_slots(cls, host, limit):
+        existing = set(cls.objects.filter(host=host).values_list('slot',
+                                                                 flat=True))
+
+        for slot in range(limit):
+            if slot in existing:
+                continue
+
+            try:
+                with transaction.atomic():
+                    cls.objects.create(host=host, slot=slot)
+            except IntegrityError:
+                # Created by another worker
+                pass
+
+    @classmethod
+    def acquire(cls, host, limit, token, lease):
+        """ Acquires a free slot.
+
+        A slot is acquired with a conditional update, if another worker
+        acquired it first the next free slot is tried.
+
+        Args:
+            host (str): Host to acquire a slot of.
+            limit (int): Number of slots of the host.
+            token (str): Token identifying the holder.
+            lease (int): Number of seconds the slot is held at most.
+
+        Returns:
+            A bool whether a slot was acquired.
+        """
+        now = timezone.now()
+
+        free = Q(token='') | Q(expires__lt=now)
+
+        candidates = list(cls.objects.filter(free, host=host,
+                                             slot__lt=limit).values_list(
+                                                 'pk', flat=True))
+
+        if len(candidates) == 0 and cls.objects.filter(
+                host=host, slot__lt=limit).count() < limit:
+            cls.create_slots(host, limit)
+
+            return cls.acquire(host, limit, token, lease)
+
+        expires = now + datetime.timedelta(seconds=lease)
+
+        for pk in candidates:
+            acquired = cls.objects.filter(free, pk=pk).update(token=token,
+                                                              expires=expires)
+
+            if acquired == 1:
+                return True
+
+        return False
+
+    @classmethod
+    def renew(cls, host, token, lease):
+        """ Extends the lease of a held slot.
+
+        Args:
+            host (str): Host the slot belongs to.
+            token (str): Token identifying the holder.
+            lease (int): Number of seconds the slot is held at most from now.
+
+        Returns:
+            A bool whether the slot is still held.
+        """
+        expires = timezone.now() + datetime.timedelta(seconds=lease)
+
+        return cls.objects.filter(host=host, token=token).update(
+            expires=expires) == 1
+
+    @classmethod
+    def release(cls, host, token):
+        """ Releases a slot.
+
+        Args:
+            host (str): Host the slot belongs to.
+            token (str): Token identifying the holder.
+        """
+        cls.objects.filter(host=host, token=token).update(token='',
+                                                          expires=None)
+
+    def __str__(self):
+        return '{0.host} {0.slot} {0.token}'.format(self)
+
+class HostBreaker(models.Model):
+    """ Circuit breaker of a remote host shared by all workers.
+
+    State changes are made with conditional updates or while holding the
+    row lock, concurrent failures recorded by different workers are never
+    lost.
+    """
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    host = models.CharField(max_length=256, unique=True)
+    state = models.CharField(max_length=64, default=CLOSED)
+    failures = models.PositiveIntegerField(default=0)
+    changed = models.FloatField(default=0)
+
+    @classmethod
+    def get(cls, host):
+        return cls.objects.get_or_create(host=host)[0]
+
+    @classmethod
+    def trial(cls, host, before, now):
+        """ Half opens the breaker for a trial request.
+
+        Args:
+            host (str): Host of the breaker.
+            before (float): Breakers changed after this time stay open.
+            now (float): Current time.
+
+        Returns:
+            A bool whether this worker makes the trial request.
+        """
+        return cls.objects.filter(host=host, changed__lte=before).exclude(
+            state=cls.CLOSED).update(state=cls.HALF_OPEN, changed=now) == 1
+
+    @classmethod
+    def close(cls, host, now):
+        """ Closes the breaker and clears its failures.
+
+        Args:
+            host (str): Host of the breaker.
+            now (float): Current time.
+
+        Returns:
+            A bool whether the breaker was changed.
+        """
+        return cls.objects.filter(host=host).exclude(
+            state=cls.CLOSED, failures=0).update(state=cls.CLOSED, failures=0,
+                                                 changed=now) > 0
+
+    @classmethod
+    def fail(cls, host, threshold, now):
+        """ Records a failure, opening the breaker at the threshold.
+
+        A failure of a trial request opens the breaker again.
+
+        Args:
+            host (str): Host of the breaker.
+            threshold (int): Number of consecutive failures opening the
+                breaker.
+            now (float): Current time.
+
+        Returns:
+            The updated HostBreaker.
+        """
+        cls.get(host)
+
+        with transaction.atomic():
+            entry = cls.objects.select_for_update().get(host=host)
+
+            entry.failures += 1
+
+            if entry.state == cls.HALF_OPEN or entry.failures >= threshold:
+                entry.state = cls.OPEN
+
+                entry.changed = now
+
+            entry.save()
+
+        return entry
+
+    def __str__(self):
+        return '{0.host} {0.state} {0.failures}'.format(self)
+
+class HostTransfer(models.Model):
+    """ Request made to a remote host shared by all workers.
+
+    Each request is recorded as its own row, requests recorded concurrently
+    by different workers are never lost. Only the most recent requests of a
+    host are kept.
+    """
+    host = models.CharField(max_length=256, db_index=True)
+    nbytes = models.BigIntegerField()
+    seconds = models.FloatField()
+    created = models.FloatField()
+
+    @classmethod
+    def record(cls, host, nbytes, seconds, keep, now):
+        """ Records a request and removes requests beyond the history.
+
+        Args:
+            host (str): Host the request was made to.
+            nbytes (int): Number of bytes transferred.
+            seconds (float): Duration of the request.
+            keep (int): Number of requests kept for the host.
+            now (float): Current time.
+        """
+        cls.objects.create(host=host, nbytes=nbytes, seconds=seconds,
+                           created=now)
+
+        stale = list(cls.objects.filter(host=host).order_by('-pk').values_list(
+            'pk', flat=True)[keep:keep+1])
+
+        if len(stale) > 0:
+            cls.objects.filter(host=host, pk__lte=stale[0]).delete()
+
+    @classmethod
+    def history(cls, host, limit, since):
+        """ Most recent requests made to a host.
+
+        Args:
+            host (str): Host the requests were made to.
+            limit (int): Maximum number of requests.
+            since (float): Requests made before this time are ignored.
+
+        Returns:
+            A list of tuples of bytes and seconds, oldest first.
+        """
+        rows = cls.objects.filter(host=host, created__gte=since).order_by(
+            '-pk').values_list('nbytes', 'seconds')[:limit]
+
+        return [(x, y) for x, y in reversed(list(rows))]
+
+    def __str__(self):
+        return '{0.host} {0.nbytes} {0.seconds}'.format(self)
+
 class Status(models.Model):
     job = models.ForeignKey(Job, on_delete=models.CASCADE)
 
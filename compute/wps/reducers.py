@@ -0,0 +1,679 @@
+#! /usr/bin/env python
+
+import collections
+import hashlib
+import logging
+import os
+import re
+import threading
+
+import cdms2
+import numpy as np
+
+from wps import WPSError
+
+logger = logging.getLogger('wps.reducers')
+
+PARTIAL_AXIS = 'partial'
+
+# Attribute recording the type of the reduced data in a partial state
+DTYPE_ATTR = 'partial_dtype'
+
+PARTIAL_SUFFIX = '_partial'
+
+SUM = 'sum'
+MAX = 'max'
+MIN = 'min'
+
+REDUCTIONS = {
+    SUM: np.sum,
+    MAX: np.maximum.reduce,
+    MIN: np.minimum.reduce,
+}
+
+# Reductions of floating point values skipping NaN
+FLOAT_REDUCTIONS = {
+    SUM: np.nansum,
+    MAX: np.fmax.reduce,
+    MIN: np.fmin.reduce,
+}
+
+# Weight options of CDAT.average, weights are generated from the axis bounds
+# or all values are weighted equally
+WEIGHTED = ('generate', 'weighted')
+
+EQUAL = ('equal', 'unweighted')
+
+# Number of area weight tables kept by each worker
+AREA_CACHE_SIZE = 32
+
+# Per process area weights shared by all threads of a worker
+AREA_WEIGHTS = collections.OrderedDict()
+
+AREA_LOCK = threading.Lock()
+
+PARTIAL_NAME = re.compile('^[^_]+_(\d+)_(\d+)_.*' + PARTIAL_SUFFIX + '\.')
+
+def axis_indices(data, axes):
+    """ Indices of axes of a variable.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable to look up.
+        axes (list): Axis names.
+
+    Returns:
+        A tuple of int indices.
+
+    Raises:
+        WPSError: If an axis is not an axis of the variable.
+    """
+    indices = []
+
+    for axis in axes:
+        axis_index = data.getAxisIndex(axis)
+
+        if axis_index == -1:
+            raise WPSError('Unknown axis {!s}', axis)
+
+        indices.append(axis_index)
+
+    return tuple(indices)
+
+def identity(op, dtype):
+    """ Value which does not change the result of a reduction. """
+    if op == SUM:
+        return 0
+
+    if dtype.kind == 'f':
+        return -np.inf if op == MAX else np.inf
+
+    info = np.iinfo(dtype) if dtype.kind in 'iu' else None
+
+    if info is None:
+        raise WPSError('Unable to reduce values of type {!s}', dtype)
+
+    return info.min if op == MAX else info.max
+
+def reduce_values(data, indices, op):
+    """ Reduces the values of a variable over several axes in one pass.
+
+    Unmasked data is reduced with plain numpy reductions. Masked values are
+    replaced by the identity of the reduction, the result is masked where
+    every reduced value was masked. Floating point reductions skip NaN.
+
+    Args:
+        data (numpy.ndarray): Data to reduce, may be masked.
+        indices (tuple): Indices of the axes to reduce.
+        op (str): Reduction, one of SUM, MAX or MIN.
+
+    Returns:
+        A tuple of the numpy.ndarray result and its mask, numpy.ma.nomask if
+        nothing is masked.
+    """
+    values = np.ma.getdata(data)
+
+    mask = np.ma.getmask(data)
+
+    if mask is not np.ma.nomask and not mask.any():
+        mask = np.ma.nomask
+
+    if mask is not np.ma.nomask:
+        values = np.where(mask, identity(op, values.dtype), values)
+
+    if values.dtype.kind == 'f':
+        func = FLOAT_REDUCTIONS[op]
+    else:
+        func = REDUCTIONS[op]
+
+    result = func(values, axis=indices)
+
+    if mask is not np.ma.nomask:
+        mask = mask.all(axis=indices)
+
+    return result, mask
+
+def reduce_axes(data, axes, op):
+    """ Reduces a variable over several axes.
+
+    The axes are reduced together and the remaining axes and attributes of
+    the variable are attached to the result once.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable to reduce.
+        axes (list): Names of the axes to reduce.
+        op (str): Reduction, one of SUM, MAX or MIN.
+
+    Returns:
+        A cdms2.tvariable.TransientVariable.
+
+    Raises:
+        WPSError: If an axis is not an axis of the variable.
+    """
+    indices = axis_indices(data, axes)
+
+    result, mask = reduce_values(data, indices, op)
+
+    remaining = [x for y, x in enumerate(data.getAxisList())
+                 if y not in indices]
+
+    return cdms2.createVariable(result, mask=mask, axes=remaining, id=data.id,
+                                fill_value=data.fill_value,
+                                attributes=dict(data.attributes))
+
+def count(data, indices):
+    """ Number of unmasked values reduced into each result. """
+    mask = np.ma.getmask(data)
+
+    if mask is np.ma.nomask:
+        return np.prod([data.shape[x] for x in indices])
+
+    return (~mask).sum(axis=indices)
+
+def axis_bounds(axis):
+    bounds = axis.getBounds()
+
+    if bounds is None:
+        bounds = axis.genGenericBounds()
+
+    return np.array(bounds, dtype=np.float64)
+
+def axis_weights(axis):
+    """ Weights of the cells of an axis generated from its bounds.
+
+    Latitude cells are weighted by the difference of the sines of their
+    bounds, proportional to their area on the sphere.
+
+    Args:
+        axis (cdms2.axis.AbstractAxis): Axis to weight.
+
+    Returns:
+        A numpy.ndarray.
+    """
+    bounds = axis_bounds(axis)
+
+    if axis.isLatitude():
+        bounds = np.sin(np.radians(np.clip(bounds, -90.0, 90.0)))
+
+    return np.abs(bounds[:, 1] - bounds[:, 0])
+
+def area_weights(axes, option):
+    """ Weights of the spatial axes being averaged.
+
+    The table is the outer product of the weights of the axes. Tables are
+    cached per worker by a hash of the axes' coordinates, their names and
+    the weight option.
+
+    Args:
+        axes (list): Latitude and longitude axes in the order of the data.
+        option (str): Weight option.
+
+    Returns:
+        A numpy.ndarray.
+    """
+    digest = hashlib.sha1()
+
+    for axis in axes:
+        digest.update(np.array(axis[:], dtype=np.float64).tostring())
+
+        digest.update(axis_bounds(axis).tostring())
+
+    key = (digest.hexdigest(), tuple(x.id for x in axes), option)
+
+    with AREA_LOCK:
+        weights = AREA_WEIGHTS.pop(key, None)
+
+        if weights is not None:
+            AREA_WEIGHTS[key] = weights
+
+            return weights
+
+    weights = np.ones(())
+
+    for axis in axes:
+        weights = np.multiply.outer(weights, axis_weights(axis))
+
+    logger.info('Generated area weights %r', weights.shape)
+
+    with AREA_LOCK:
+        AREA_WEIGHTS[key] = weights
+
+        while len(AREA_WEIGHTS) > AREA_CACHE_SIZE:
+            AREA_WEIGHTS.popitem(last=False)
+
+    return weights
+
+def reduction_weights(data, indices, option=None):
+    """ Weights of the values of a variable being averaged.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable being averaged.
+        indices (tuple): Indices of the axes being averaged.
+        option (str): Weight option, defaults to weighted.
+
+    Returns:
+        A numpy.ndarray broadcastable to the shape of the data, None if all
+        values are weighted equally.
+
+    Raises:
+        WPSError: If the weight option is unknown.
+    """
+    if option is None or option.lower() in WEIGHTED:
+        option = WEIGHTED[1]
+    elif option.lower() in EQUAL:
+        return None
+    else:
+        raise WPSError('Unknown weight option {!r}', option)
+
+    axes = data.getAxisList()
+
+    spatial = [x for x in sorted(indices) if axes[x].isLatitude() or
+               axes[x].isLongitude()]
+
+    shape = [data.shape[x] if x in spatial else 1 for x in range(data.ndim)]
+
+    weights = area_weights([axes[x] for x in spatial], option).reshape(shape)
+
+    for index in indices:
+        if index in spatial:
+            continue
+
+        shape = [1 for _ in range(data.ndim)]
+
+        shape[index] = data.shape[index]
+
+        weights = weights * axis_weights(axes[index]).reshape(shape)
+
+    return weights
+
+def average_axes(data, axes, option=None):
+    """ Weighted average of a variable over several axes.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable to average.
+        axes (list): Names of the axes to average.
+        option (str): Weight option.
+
+    Returns:
+        A cdms2.tvariable.TransientVariable.
+    """
+    return Average().apply(data, axes, option)
+
+def partial_path(path):
+    """ Path of the partial state of a chunk's output path. """
+    base, ext = os.path.splitext(path)
+
+    return base + PARTIAL_SUFFIX + ext
+
+def partial_chunk(path):
+    """ Chunk index recorded in the name of a partial state.
+
+    Args:
+        path (str): Recorded path of the partial state.
+
+    Returns:
+        An int chunk index or None if the path is not a partial state.
+    """
+    match = PARTIAL_NAME.match(os.path.basename(path))
+
+    if match is None:
+        return None
+
+    return int(match.group(2))
+
+class Reducer(object):
+    """ Reduction producing partial states which can be merged.
+
+    A partial state is a variable with a leading partial axis holding the
+    components of the state. The first component holds the reduced values,
+    the second the weight of the values, either the count of unmasked values
+    or the sum of their weights, reducers may add further components.
+    Chunks are reduced independently and their states merged in any order,
+    values with no weight are masked when the state is finalized.
+    """
+    def reduce(self, data, indices, option=None):
+        """ Reduces the data of a chunk.
+
+        Args:
+            data (cdms2.tvariable.TransientVariable): Data to reduce.
+            indices (tuple): Indices of the axes to reduce.
+            option (str): Weight option of the reduction.
+
+        Returns:
+            A tuple of the numpy.ndarray components, the values and weights
+            followed by any other components.
+        """
+        raise NotImplementedError()
+
+    def merge_values(self, first, second):
+        return first + second
+
+    def merge_components(self, first, second):
+        """ Merges the components of two partial states.
+
+        Args:
+            first (list): Components of a partial state.
+            second (list): Components of a partial state.
+
+        Returns:
+            A list of numpy.ndarray components.
+        """
+        return [self.merge_values(first[0], second[0]), first[1] + second[1]]
+
+    def finalize_values(self, values, weights):
+        return values
+
+    def finalize_components(self, components):
+        return self.finalize_values(components[0], components[1])
+
+    def apply(self, data, axes, option=None):
+        """ Reduces a variable.
+
+        Args:
+            data (cdms2.tvariable.TransientVariable): Variable to reduce.
+            axes (list): Names of the axes to reduce.
+            option (str): Weight option of the reduction.
+
+        Returns:
+            A cdms2.tvariable.TransientVariable.
+        """
+        return self.finalize(self.partial(data, axes, option))
+
+    def partial(self, data, axes, option=None):
+        """ Reduces a chunk to a partial state.
+
+        Args:
+            data (cdms2.tvariable.TransientVariable): Chunk to reduce.
+            axes (list): Names of the axes to reduce.
+            option (str): Weight option of the reduction.
+
+        Returns:
+            A cdms2.tvariable.TransientVariable.
+        """
+        indices = axis_indices(data, axes)
+
+        components = self.reduce(data, indices, option)
+
+        components = np.broadcast_arrays(*[np.asarray(x, np.float64)
+                                           for x in components])
+
+        remaining = [x for y, x in enumerate(data.getAxisList())
+                     if y not in indices]
+
+        partial = cdms2.createAxis(np.arange(len(components)), id=PARTIAL_AXIS)
+
+        attributes = dict(data.attributes)
+
+        attributes[DTYPE_ATTR] = data.dtype.str
+
+        return cdms2.createVariable(np.stack(components),
+                                    axes=[partial] + remaining, id=data.id,
+                                    attributes=attributes)
+
+    def merge(self, first, second):
+        """ Merges two partial states.
+
+        Args:
+            first (cdms2.tvariable.TransientVariable): Partial state.
+            second (cdms2.tvariable.TransientVariable): Partial state.
+
+        Returns:
+            A cdms2.tvariable.TransientVariable.
+        """
+        first_data = np.ma.getdata(first)
+
+        second_data = np.ma.getdata(second)
+
+        if first_data.shape != second_data.shape:
+            raise WPSError('Unable to merge partial states with shapes {!r} and '
+                           '{!r}', first_data.shape, second_data.shape)
+
+        components = self.merge_components(list(first_data), list(second_data))
+
+        return cdms2.createVariable(np.stack(components),
+                                    axes=first.getAxisList(), id=first.id,
+                                    attributes=dict(first.attributes))
+
+    def finalize(self, state):
+        """ Computes the result of a partial state.
+
+        Args:
+            state (cdms2.tvariable.TransientVariable): Partial state.
+
+        Returns:
+            A cdms2.tvariable.TransientVariable.
+        """
+        data = np.ma.getdata(state)
+
+        values = self.finalize_components(list(data))
+
+        # Results are masked where they have no weight or are undefined
+        mask = (data[1] <= 0) | np.ma.getmaskarray(values)
+
+        values = np.ma.getdata(values)
+
+        attributes = dict(state.attributes)
+
+        dtype = np.dtype(str(attributes.pop(DTYPE_ATTR, 'f8')))
+
+        if dtype.kind == 'f':
+            values = values.astype(dtype)
+
+        return cdms2.createVariable(values, mask=mask,
+                                    axes=state.getAxisList()[1:], id=state.id,
+                                    attributes=attributes)
+
+    def tree_merge(self, states):
+        """ Merges partial states pairwise.
+
+        States are merged like a binary counter, at most log2(n) states are
+        held while merging n states.
+
+        Args:
+            states (generator): Generator yielding partial states.
+
+        Returns:
+            A cdms2.tvariable.TransientVariable.
+
+        Raises:
+            WPSError: If there are no states.
+        """
+        stack = []
+
+        for state in states:
+            level = 0
+
+            while len(stack) > 0 and stack[-1][0] == level:
+                state = self.merge(stack.pop()[1], state)
+
+                level += 1
+
+            stack.append((level, state))
+
+        if len(stack) == 0:
+            raise WPSError('No partial states to merge')
+
+        _, state = stack.pop()
+
+        while len(stack) > 0:
+            state = self.merge(stack.pop()[1], state)
+
+        return state
+
+class Sum(Reducer):
+    def reduce(self, data, indices, option=None):
+        values, _ = reduce_values(data, indices, SUM)
+
+        return values, count(data, indices)
+
+class Max(Reducer):
+    def reduce(self, data, indices, option=None):
+        # Values with no weight are left at the identity of the reduction
+        values, _ = reduce_values(data, indices, MAX)
+
+        return values, count(data, indices)
+
+    def merge_values(self, first, second):
+        return np.fmax(first, second)
+
+class Min(Reducer):
+    def reduce(self, data, indices, option=None):
+        values, _ = reduce_values(data, indices, MIN)
+
+        return values, count(data, indices)
+
+    def merge_values(self, first, second):
+        return np.fmin(first, second)
+
+class Average(Reducer):
+    """ Weighted average, weighted like cdutil.averager. """
+    def reduce(self, data, indices, option=None):
+        weights = reduction_weights(data, indices, option)
+
+        values = np.ma.getdata(data)
+
+        mask = np.ma.getmask(data)
+
+        if mask is np.ma.nomask or not mask.any():
+            if weights is None:
+                return values.sum(axis=indices), count(data, indices)
+
+            return ((values * weights).sum(axis=indices),
+                    weights.sum(axis=indices))
+
+        valid = ~mask
+
+        if weights is None:
+            weights = valid
+        else:
+            weights = valid * weights
+
+        total = np.where(valid, values * weights, 0).sum(axis=indices)
+
+        return total, weights.sum(axis=indices)
+
+    def finalize_values(self, values, weights):
+        return values / np.where(weights > 0, weights, 1)
+
+class Moments(Reducer):
+    """ Central moments of values.
+
+    The state holds the mean, count and sums of the powers of the deviations
+    from the mean up to `order`. Chunks are reduced in two passes over their
+    data and states are merged with the pairwise updates of Chan et al. and
+    Pebay, which stay numerically stable for long series.
+    """
+    order = 2
+
+    def reduce(self, data, indices, option=None):
+        values = np.ma.getdata(data)
+
+        mask = np.ma.getmask(data)
+
+        if mask is not np.ma.nomask and not mask.any():
+            mask = np.ma.nomask
+
+        # Counts keep the reduced axes to broadcast against the chunk
+        if mask is np.ma.nomask:
+            total = values.sum(axis=indices, keepdims=True, dtype=np.float64)
+
+            n = np.full(total.shape, count(data, indices), np.float64)
+        else:
+            valid = ~mask
+
+            total = np.where(valid, values, 0).sum(axis=indices, keepdims=True,
+                                                   dtype=np.float64)
+
+            n = valid.sum(axis=indices, keepdims=True).astype(np.float64)
+
+        mean = total / np.where(n > 0, n, 1)
+
+        deviation = values - mean
+
+        if mask is not np.ma.nomask:
+            deviation[mask] = 0
+
+        components = [np.squeeze(mean, axis=indices),
+                      np.squeeze(n, axis=indices)]
+
+        power = deviation * deviation
+
+        for x in range(2, self.order + 1):
+            if x > 2:
+                power *= deviation
+
+            components.append(power.sum(axis=indices))
+
+        return components
+
+    def merge_components(self, first, second):
+        mean_a, n_a = first[:2]
+
+        mean_b, n_b = second[:2]
+
+        n = n_a + n_b
+
+        safe = np.where(n > 0, n, 1)
+
+        delta = mean_b - mean_a
+
+        mean = mean_a + delta * n_b / safe
+
+        m2 = first[2] + second[2] + delta**2 * n_a * n_b / safe
+
+        components = [mean, n, m2]
+
+        if self.order > 2:
+            m3 = (first[3] + second[3] +
+                  delta**3 * n_a * n_b * (n_a - n_b) / safe**2 +
+                  3 * delta * (n_a * second[2] - n_b * first[2]) / safe)
+
+            components.append(m3)
+
+        if self.order > 3:
+            m4 = (first[4] + second[4] +
+                  delta**4 * n_a * n_b * (n_a**2 - n_a * n_b + n_b**2) /
+                  safe**3 +
+                  6 * delta**2 * (n_a**2 * second[2] + n_b**2 * first[2]) /
+                  safe**2 +
+                  4 * delta * (n_a * second[3] - n_b * first[3]) / safe)
+
+            components.append(m4)
+
+        return components
+
+    def variance(self, components):
+        n = components[1]
+
+        return components[2] / np.where(n > 0, n, 1)
+
+class Variance(Moments):
+    """ Population variance. """
+    def finalize_components(self, components):
+        return self.variance(components)
+
+class StandardDeviation(Moments):
+    """ Population standard deviation. """
+    def finalize_components(self, components):
+        return np.sqrt(self.variance(components))
+
+class Skewness(Moments):
+    """ Sample skewness, undefined where the variance is zero. """
+    order = 3
+
+    def finalize_components(self, components):
+        variance = np.ma.masked_less_equal(self.variance(components), 0)
+
+        n = components[1]
+
+        return components[3] / np.where(n > 0, n, 1) / variance**1.5
+
+class Kurtosis(Moments):
+    """ Excess kurtosis, undefined where the variance is zero. """
+    order = 4
+
+    def finalize_components(self, components):
+        variance = np.ma.masked_less_equal(self.variance(components), 0)
+
+        n = components[1]
+
+        return components[4] / np.where(n > 0, n, 1) / variance**2 - 3.0
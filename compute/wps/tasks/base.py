@@ -43,6 +43,8 @@ def register_process(identifier, **kwargs):
 
         func.PROCESS = kwargs.get('process')
 
+        func.REDUCER = kwargs.get('reducer')
+
         func.METADATA = kwargs.get('metadata', {})
 
         return func
@@ -10,18 +10,23 @@ from collections import deque
 import cdms2
 import cwt
 import cdutil
-from cdms2 import MV2
 from celery.task.control import inspect
 from celery.utils.log import get_task_logger
 from django.conf import settings
 from django.utils import timezone
 
 from wps import helpers
+from wps import hyperslab
+from wps import intermediate
 from wps import metrics
 from wps import models
+from wps import reducers
+from wps import weights
 from wps import WPSError
 from wps.tasks import base
+from wps.context import NETCDF_LOCK
 from wps.context import OperationContext
+from wps.context import claim_lease
 
 logger = get_task_logger('wps.tasks.cdat')
 
@@ -115,43 +120,241 @@ whose value will be used to process over. The value should be a "|" delimited
 string e.g. 'lat|lon'.
 """
 
-def process_data(self, context, index, process):
-    """ Process a chunks of data.
+VAR_ABSTRACT = """
+Computes the population variance over axes. Requires singular parameter named
+"axes" whose value will be used to process over. The value should be a "|"
+delimited string e.g. 'lat|lon'.
+"""
 
-    Function passed as process should accept two arguments, the first being a 
-    cdms2.TransientVariable and the second a list of axis names.
+STD_ABSTRACT = """
+Computes the population standard deviation over axes. Requires singular
+parameter named "axes" whose value will be used to process over. The value
+should be a "|" delimited string e.g. 'lat|lon'.
+"""
+
+SKEWNESS_ABSTRACT = """
+Computes the skewness over axes. Requires singular parameter named "axes" whose
+value will be used to process over. The value should be a "|" delimited string
+e.g. 'lat|lon'.
+"""
+
+KURTOSIS_ABSTRACT = """
+Computes the excess kurtosis over axes. Requires singular parameter named
+"axes" whose value will be used to process over. The value should be a "|"
+delimited string e.g. 'lat|lon'.
+"""
+
+def input_reducer(context, input, axes):
+    """ Reducer merging the partial results of an input's chunks.
+
+    Chunks reduced over the axis they are split along can not be
+    concatenated, each worker reduces its chunks to a partial state which
+    are merged by `concat`.
+
+    Args:
+        context (OperationContext): Current context.
+        input (VariableContext): Input being reduced.
+        axes (list): Names of the axes being reduced.
+
+    Returns:
+        A wps.reducers.Reducer or None if the chunks are reduced
+        independently.
+    """
+    if axes is None or input.chunk is None:
+        return None
+
+    reducer = getattr(base.get_process(context.operation.identifier),
+                      'REDUCER', None)
+
+    if reducer is None or not any(x in input.chunk.axes for x in axes):
+        return None
+
+    return reducer
+
+def weight_option(context):
+    """ Weight option of an operation.
+
+    Args:
+        context (OperationContext): Current context.
+
+    Returns:
+        A str weight option or None if the operation has none.
+    """
+    option = context.operation.get_parameter('weightoptions')
+
+    if option is None or len(option.values) == 0:
+        return None
+
+    return str(option.values[0])
+
+def partial_key(plan, chunk_index, axes):
+    """ Key of the chunks whose partial states are merged together.
+
+    Chunks sharing the slices of the split axes which are not reduced cover
+    the same portion of the output.
+
+    Args:
+        plan (wps.context.ChunkPlan): Chunk plan of the input.
+        chunk_index (int): Index of the chunk.
+        axes (list): Names of the axes being reduced.
+
+    Returns:
+        A tuple.
+    """
+    return tuple(hyperslab.slice_key(plan[chunk_index][x]) for x in plan.axes
+                 if x not in axes)
+
+def partial_groups(input, axes):
+    """ Groups the partial states of an input.
+
+    Args:
+        input (VariableContext): Input the partial states belong to.
+        axes (list): Names of the axes being reduced.
+
+    Returns:
+        A list of (chunk index, paths) tuples ordered by the index of the
+        first chunk of each group.
+    """
+    groups = {}
+
+    # Chunks handled by the same worker share their output in the manifest
+    for path in sorted(set(input.process)):
+        chunk_index = reducers.partial_chunk(path)
+
+        if chunk_index is None:
+            raise WPSError('Output {!r} is not a partial state', path)
+
+        entry = groups.setdefault(partial_key(input.chunk, chunk_index, axes),
+                                  [chunk_index, []])
+
+        if chunk_index < entry[0]:
+            entry[0] = chunk_index
+
+        entry[1].append(path)
+
+    return sorted((x, y) for x, y in groups.values())
+
+def process_inputs(self, context, index, process):
+    """ Processes the chunks of each input.
 
     Args:
         context (OperationContext): Current context.
         index (int): Worker index used to determine the portion of work to complete.
-        process (function): A function to process the data, see above for arguments.
+        process (function): A function to process the data.
 
     Returns:
-        Updated context.
+        The number of bytes processed.
     """
     axes = context.operation.get_parameter('axes', True)
 
     nbytes = 0
 
     for input_index, input in enumerate(context.sorted_inputs()):
-        for _, chunk_index, chunk in input.chunks(index, context):
+        if context.chunk_queue:
+            chunks = input.chunks_queue(input_index, context,
+                                        models.JobChunk.PROCESS,
+                                        self.request.id)
+        else:
+            chunks = input.chunks(input_index, index, context)
+
+        reducer = input_reducer(context, input, axes.values)
+
+        option = weight_option(context)
+
+        def output_path(chunk_index):
+            process_filename = '{}_{:08}_{:08}_{}{}'.format(
+                str(context.job.id), input_index, chunk_index,
+                '_'.join(axes.values), intermediate.EXTENSION)
+
+            return context.gen_ingress_path(process_filename)
+
+        states = {}
+
+        for _, chunk_index, chunk in chunks:
             nbytes += chunk.nbytes
 
-            process_filename = '{}_{:08}_{:08}_{}.nc'.format(
-                str(context.job.id), input_index, chunk_index, '_'.join(axes.values))
+            if reducer is not None:
+                with metrics.WPS_PROCESS_TIME.labels(context.operation.identifier).time():
+                    state = reducer.partial(chunk, axes.values, option)
+
+                key = partial_key(input.chunk, chunk_index, axes.values)
+
+                if key in states:
+                    entry = states[key]
+
+                    if chunk_index < entry[0]:
+                        entry[0] = chunk_index
+
+                    entry[1].append(chunk_index)
 
-            process_path = context.gen_ingress_path(process_filename)
+                    entry[2] = reducer.merge(entry[2], state)
+                else:
+                    states[key] = [chunk_index, [chunk_index], state]
+
+                continue
+
+            process_path = output_path(chunk_index)
 
             if process is not None:
                 # Track processing time
                 with metrics.WPS_PROCESS_TIME.labels(context.operation.identifier).time():
                     chunk = process(chunk, axes.values)
 
-            with context.new_output(process_path) as outfile:
-                outfile.write(chunk, id=input.variable.var_name)
+            intermediate.write(process_path, chunk)
+
+            input.process.append(process_path)
+
+            if context.chunk_queue:
+                models.JobChunk.complete(context.job, input_index,
+                                         chunk_index, process_path)
+
+        for first, indices, state in states.values():
+            process_path = reducers.partial_path(output_path(first))
+
+            intermediate.write(process_path, state)
 
             input.process.append(process_path)
 
+            logger.info('Wrote partial state of %r chunks to %r', len(indices),
+                        process_path)
+
+            if context.chunk_queue:
+                for chunk_index in indices:
+                    models.JobChunk.complete(context.job, input_index,
+                                             chunk_index, process_path)
+
+    return nbytes
+
+def process_data(self, context, index, process):
+    """ Process a chunks of data.
+
+    Function passed as process should accept two arguments, the first being a 
+    cdms2.TransientVariable and the second a list of axis names.
+
+    When the process reduces the axis the chunks are split along, the
+    chunks are reduced to partial states with the process' reducer. The
+    states of a worker's chunks are merged as they are processed and a
+    single state is written for each portion of the output.
+
+    Args:
+        context (OperationContext): Current context.
+        index (int): Worker index used to determine the portion of work to complete.
+        process (function): A function to process the data, see above for arguments.
+
+    Returns:
+        Updated context.
+    """
+    if not context.chunk_queue:
+        nbytes = process_inputs(self, context, index, process)
+    else:
+        with claim_lease(context.job, self.request.id):
+            nbytes = process_inputs(self, context, index, process)
+
+            # Chunks abandoned by workers that died are claimed again
+            while models.JobChunk.wait(context.job, models.JobChunk.PROCESS,
+                                       self.request.id):
+                nbytes += process_inputs(self, context, index, process)
+
     self.status('Processed {!r} bytes', nbytes)
 
     return context
@@ -188,16 +391,58 @@ def regrid_chunk(context, chunk, selector):
 
     shape = chunk.shape
 
-    chunk = chunk.regrid(grid, regridTool=tool, regridMethod=method)
+    chunk = weights.regrid(chunk, grid, tool, method)
 
     logger.info('Regrid %r -> %r', shape, chunk.shape)
 
     return chunk
 
+def output_axes(context, input, axes):
+    """ Axes of a chunk as written to the output.
+
+    Time axes are converted to the context's units and spatial axes are
+    replaced by the target grid when regridding.
+
+    Args:
+        context (OperationContext): Current context.
+        input (VariableContext): Input the chunk belongs to.
+        axes (list): Axes of the chunk.
+
+    Returns:
+        A list of cdms2.axis.TransientAxis.
+    """
+    grid = None
+
+    if context.is_regrid:
+        grid, _, _ = context.regrid_context(input.mapped)
+
+    result = []
+
+    for axis in axes:
+        if axis.isTime() and context.units is not None:
+            axis = hyperslab.copy_axis(axis)
+
+            axis.toRelativeTime(str(context.units))
+        elif grid is not None and axis.isLatitude():
+            axis = grid.getLatitude()
+        elif grid is not None and axis.isLongitude():
+            axis = grid.getLongitude()
+
+        result.append(axis)
+
+    return result
+
 @base.cwt_shared_task()
 def concat(self, contexts):
     """ Concatenate data chunks.
 
+    The output variable is created with its final shape and every chunk is
+    written to its hyperslab as it is read. Regridded inputs are never split
+    over a spatial axis, each chunk is regridded on its own.
+
+    Partial states of inputs reduced over their split axis are tree merged
+    for each portion of the output before they are written.
+
     Args:
         context (OperationContext): Current context.
 
@@ -206,59 +451,74 @@ def concat(self, contexts):
     """
     context = OperationContext.merge_ingress(contexts)
 
+    if context.chunk_queue:
+        context.load_manifest()
+
     context.output_path = context.gen_public_path()
 
     nbytes = 0
     start = datetime.datetime.now()
 
+    inputs = [(x, y) for x, y in enumerate(context.sorted_inputs())
+              if y.mapped is not None]
+
+    if len(inputs) == 0:
+        raise WPSError('No inputs to concatenate')
+
+    var_name = str(inputs[0][1].variable.var_name)
+
+    axes = context.operation.get_parameter('axes')
+
+    if axes is not None:
+        axes = axes.values
+
     with context.new_output(context.output_path) as outfile:
-        for index, input in enumerate(context.sorted_inputs()):
-            data = []
-            chunk_axis = None
-            chunk_axis_index = None
+        writer = hyperslab.HyperslabWriter(outfile, var_name, NETCDF_LOCK)
 
-            # Skip file if not mapped
-            if input.mapped is None:
-                logger.info('Skipping %r', input.filename)
+        layouts = []
 
-                continue
+        for index, input in inputs:
+            reducer = input_reducer(context, input, axes)
 
-            for file_path, _, chunk in input.chunks(input_index=index, context=context):
-                logger.info('Chunk shape %r %r', file_path, chunk.shape)
+            if reducer is None:
+                groups = None
 
-                if chunk_axis is None:
-                    chunk_axis_index = chunk.getAxisIndex(input.chunk_axis)
+                chunk_axes = list(input.chunk_axes(context))
 
-                    chunk_axis = chunk.getAxis(chunk_axis_index)
+                split = input.chunk.axes
+            else:
+                groups = partial_groups(input, axes)
 
-                # We can write chunks along the temporal axis immediately
-                # otherwise we need to collect them to concatenate over
-                # an axis
-                if chunk_axis.isTime():
-                    logger.info('Writing temporal chunk %r', chunk.shape)
+                # The partial axis leads the axes of a partial state
+                chunk_axes = [(x, intermediate.read_axes(y[0])[1:]) for x, y in
+                              groups]
 
-                    if context.units is not None:
-                        chunk.getTime().toRelativeTime(str(context.units))
+                split = [x for x in input.chunk.axes if x not in axes]
 
-                    if context.is_regrid:
-                        chunk = regrid_chunk(context, chunk, input.mapped)
+            chunk_axes = [(x, output_axes(context, input, y)) for x, y in
+                          chunk_axes]
 
-                    outfile.write(chunk, id=str(input.variable.var_name))
-                else:
-                    logger.info('Gathering spatial chunk')
+            input_index = writer.add_input(input.chunk, chunk_axes, split)
 
-                    data.append(chunk)
+            layouts.append((index, input, input_index, groups, reducer))
 
-                nbytes += chunk.nbytes
+        for index, input, input_index, groups, reducer in layouts:
+            if groups is None:
+                # Writes to the output wait on NETCDF_LOCK held by OPeNDAP
+                # reads, read ahead would not overlap them
+                chunks = input.chunks(input_index=index, context=context,
+                                      read_ahead=False)
+            else:
+                chunks = ((None, x, reducer.finalize(reducer.tree_merge(
+                    intermediate.read(z) for z in y))) for x, y in groups)
 
-            # Concatenate chunks along an axis
-            if chunk_axis is not None and not chunk_axis.isTime():
-                data = MV2.concatenate(data, axis=chunk_axis_index)
+            for file_path, chunk_index, chunk in chunks:
+                logger.info('Chunk shape %r %r', file_path, chunk.shape)
 
                 if context.is_regrid:
                     chunk = regrid_chunk(context, chunk, input.mapped)
 
-                outfile.write(data, id=str(input.variable.var_name))
+                writer.write(input_index, chunk_index, chunk)
 
                 nbytes += chunk.nbytes
 
@@ -289,72 +549,68 @@ def aggregate(self, context, index):
     """
     return context
 
-@base.register_process('CDAT.average', abstract=AVERAGE_ABSTRACT, process=cdutil.averager, metadata={'inputs': '1'})
+@base.register_process('CDAT.average', abstract=AVERAGE_ABSTRACT, process=cdutil.averager, reducer=reducers.Average(), metadata={'inputs': '1'})
 @base.cwt_shared_task()
 def average(self, context, index):
-    def average_func(data, axes):
-        axis_indices = []
-
-        for axis in axes:
-            axis_index = data.getAxisIndex(axis)
-
-            if axis_index == -1:
-                raise WPSError('Unknown axis {!s}', axis)
+    option = weight_option(context)
 
-            axis_indices.append(str(axis_index))
-
-        axis_sig = ''.join(axis_indices)
-
-        data = cdutil.averager(data, axis=axis_sig)
-
-        return data
+    def average_func(data, axes):
+        return reducers.average_axes(data, axes, option)
 
     return process_data(self, context, index, average_func)
 
-@base.register_process('CDAT.sum', abstract=SUM_ABSTRACT, metadata={'inputs': '1'})
+@base.register_process('CDAT.sum', abstract=SUM_ABSTRACT, reducer=reducers.Sum(), metadata={'inputs': '1'})
 @base.cwt_shared_task()
 def sum(self, context, index):
     def sum_func(data, axes):
-        for axis in axes:
-            axis_index = data.getAxisIndex(axis)
-
-            if axis_index == -1:
-                raise WPSError('Unknown axis {!s}', axis)
-
-            data = MV2.sum(data, axis=axis_index)
-
-        return data
+        return reducers.reduce_axes(data, axes, reducers.SUM)
 
     return process_data(self, context, index, sum_func)
 
-@base.register_process('CDAT.max', abstract=MAX_ABSTRACT, metadata={'inputs': '1'})
+@base.register_process('CDAT.max', abstract=MAX_ABSTRACT, reducer=reducers.Max(), metadata={'inputs': '1'})
 @base.cwt_shared_task()
 def max(self, context, index):
     def max_func(data, axes):
-        for axis in axes:
-            axis_index = data.getAxisIndex(axis)
-
-            if axis_index == -1:
-                raise WPSError('Unknown axis {!s}', axis)
-
-            data = MV2.max(data, axis=axis_index)
-
-        return data
+        return reducers.reduce_axes(data, axes, reducers.MAX)
 
     return process_data(self, context, index, max_func)
 
-@base.register_process('CDAT.min', abstract=MIN_ABSTRACT, metadata={'inputs': '1'})
+@base.register_process('CDAT.min', abstract=MIN_ABSTRACT, reducer=reducers.Min(), metadata={'inputs': '1'})
 @base.cwt_shared_task()
 def min(self, context, index):
     def min_func(data, axes):
-        for axis in axes:
-            axis_index = data.getAxisIndex(axis)
+        return reducers.reduce_axes(data, axes, reducers.MIN)
 
-            if axis_index == -1:
-                raise WPSError('Unknown axis {!s}', axis)
+    return process_data(self, context, index, min_func)
 
-            data = MV2.min(data, axis=axis_index)
+@base.register_process('CDAT.var', abstract=VAR_ABSTRACT, reducer=reducers.Variance(), metadata={'inputs': '1'})
+@base.cwt_shared_task()
+def var(self, context, index):
+    def var_func(data, axes):
+        return reducers.Variance().apply(data, axes)
 
-        return data
+    return process_data(self, context, index, var_func)
 
-    return process_data(self, context, index, min_func)
+@base.register_process('CDAT.std', abstract=STD_ABSTRACT, reducer=reducers.StandardDeviation(), metadata={'inputs': '1'})
+@base.cwt_shared_task()
+def std(self, context, index):
+    def std_func(data, axes):
+        return reducers.StandardDeviation().apply(data, axes)
+
+    return process_data(self, context, index, std_func)
+
+@base.register_process('CDAT.skewness', abstract=SKEWNESS_ABSTRACT, reducer=reducers.Skewness(), metadata={'inputs': '1'})
+@base.cwt_shared_task()
+def skewness(self, context, index):
+    def skewness_func(data, axes):
+        return reducers.Skewness().apply(data, axes)
+
+    return process_data(self, context, index, skewness_func)
+
+@base.register_process('CDAT.kurtosis', abstract=KURTOSIS_ABSTRACT, reducer=reducers.Kurtosis(), metadata={'inputs': '1'})
+@base.cwt_shared_task()
+def kurtosis(self, context, index):
+    def kurtosis_func(data, axes):
+        return reducers.Kurtosis().apply(data, axes)
+
+    return process_data(self, context, index, kurtosis_func)
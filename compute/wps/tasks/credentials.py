@@ -1,14 +1,22 @@
 #! /usr/bin/env python
 
+import contextlib
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 from datetime import datetime
 
+from celery import current_app
+from celery import shared_task
 from django.conf import settings
+from django.utils import timezone
 from openid.consumer import discover
 from OpenSSL import crypto
 
+from wps import models
 from wps import WPSError
 from wps.auth import oauth2
 from wps.auth import openid
@@ -17,6 +25,7 @@ __ALL__ = [
     'check_certificate',
     'refresh_certificate',
     'load_certificate',
+    'refresh_certificates',
 ]
 
 logger = logging.getLogger('wps.tasks.credentials')
@@ -26,6 +35,21 @@ CERT_DATE_FMT = '%Y%m%d%H%M%SZ'
 URN_AUTHORIZE = 'urn:esg:security:oauth:endpoint:authorize'
 URN_RESOURCE = 'urn:esg:security:oauth:endpoint:resource'
 
+# Staged certificates per user id, shared by the threads of a worker
+STAGED = {}
+
+STAGED_LOCK = threading.Lock()
+
+USER_LOCKS = {}
+
+# Yadis discovery results per OpenID url
+DISCOVERY = {}
+
+@current_app.on_after_configure.connect
+def setup_periodic_tasks(sender, **kwargs):
+    sender.add_periodic_task(settings.CERT_REFRESH_CHECK,
+                             refresh_certificates.s())
+
 class CertificateError(WPSError):
     def __init__(self, user, reason):
         msg = 'Certificate error for user "{username}": {reason}'
@@ -69,6 +93,28 @@ def check_certificate(user):
 
     return True
 
+def discover_services(openid_url):
+    """ Discovers the services of an OpenID url.
+
+    Results are cached for CERT_DISCOVERY_TTL seconds.
+
+    Args:
+        openid_url (str): OpenID url.
+
+    Returns:
+        A tuple of the url and list of services.
+    """
+    cached = DISCOVERY.get(openid_url)
+
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+
+    result = discover.discoverYadis(openid_url)
+
+    DISCOVERY[openid_url] = (time.time() + settings.CERT_DISCOVERY_TTL, result)
+
+    return result
+
 def refresh_certificate(user):
     """ Refresh user certificate
 
@@ -85,7 +131,7 @@ def refresh_certificate(user):
     if user.auth.type == 'myproxyclient':
         raise CertificateError(user, 'MyProxyClient certificate has expired')
 
-    url, services = discover.discoverYadis(user.auth.openid_url)
+    url, services = discover_services(user.auth.openid_url)
 
     auth_service = openid.find_service_by_type(services, URN_AUTHORIZE)
 
@@ -119,19 +165,59 @@ def refresh_certificate(user):
 
     return user.auth.cert
 
-def load_certificate(user):
-    """ Loads a user certificate.
+def user_lock(user):
+    """ Lock serializing the staging of a user's credentials. """
+    with STAGED_LOCK:
+        return USER_LOCKS.setdefault(user.id, threading.Lock())
 
-    First the users certificate is checked and refreshed if needed. It's
-    then written to disk and the processes current working directory is 
-    set, allowing calls to NetCDF library to use the certificate.
+def certificate_not_after(user):
+    """ Expiry of a user's certificate.
 
     Args:
         user: User object.
+
+    Returns:
+        A datetime after which the certificate is not valid.
+    """
+    try:
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, user.auth.cert)
+    except Exception:
+        raise CertificateError(user, 'Loading certificate')
+
+    return datetime.strptime(cert.get_notAfter(), CERT_DATE_FMT)
+
+def write_if_changed(path, content):
+    """ Writes a file unless it already has the content.
+
+    Args:
+        path (str): Path of the file.
+        content (str): Content of the file.
+
+    Returns:
+        True if the file was written.
     """
-    if not check_certificate(user):
-        refresh_certificate(user)
+    if os.path.exists(path):
+        with open(path) as infile:
+            if infile.read() == content:
+                return False
+
+    with open(path, 'w') as outfile:
+        outfile.write(content)
+
+    return True
 
+def stage_certificate(user):
+    """ Writes a user's certificate and .dodsrc file.
+
+    Files are only rewritten when their content changes. The .dodsrc uses
+    absolute paths so it can be used from any working directory.
+
+    Args:
+        user: User object.
+
+    Returns:
+        A dict describing the staged certificate.
+    """
     user_path = os.path.join(settings.WPS_USER_TEMP_PATH, str(user.id))
 
     if not os.path.exists(user_path):
@@ -139,34 +225,139 @@ def load_certificate(user):
 
         logger.info('Created user directory {}'.format(user_path))
 
-    os.chdir(user_path)
-
-    logger.info('Changed working directory to {}'.format(user_path))
-
     cert_path = os.path.join(user_path, 'cert.pem')
 
-    with open(cert_path, 'w') as outfile:
-        outfile.write(user.auth.cert)
+    if write_if_changed(cert_path, user.auth.cert):
+        logger.info('Wrote user certificate')
 
-    logger.info('Wrote user certificate')
+        dods_cookies_path = os.path.join(user_path, '.dods_cookies')
 
-    dods_cookies_path = os.path.join(user_path, '.dods_cookies')
+        if os.path.exists(dods_cookies_path):
+            os.remove(dods_cookies_path)
 
-    if os.path.exists(dods_cookies_path):
-        os.remove(dods_cookies_path)
-
-        logger.info('Removed stale dods_cookies file')
+            logger.info('Removed stale dods_cookies file')
 
     dodsrc_path = os.path.join(user_path, '.dodsrc')
 
-    if not os.path.exists(dodsrc_path):
-        with open(dodsrc_path, 'w') as outfile:
-            outfile.write('HTTP.COOKIEJAR=.dods_cookies\n')
-            outfile.write('HTTP.SSL.CERTIFICATE={}\n'.format(cert_path))
-            outfile.write('HTTP.SSL.KEY={}\n'.format(cert_path))
-            outfile.write('HTTP.SSL.CAPATH={}\n'.format(settings.WPS_CA_PATH))
-            outfile.write('HTTP.SSL.VERIFY=0\n')
+    dodsrc = ''.join([
+        'HTTP.COOKIEJAR={}\n'.format(os.path.join(user_path, '.dods_cookies')),
+        'HTTP.SSL.CERTIFICATE={}\n'.format(cert_path),
+        'HTTP.SSL.KEY={}\n'.format(cert_path),
+        'HTTP.SSL.CAPATH={}\n'.format(settings.WPS_CA_PATH),
+        'HTTP.SSL.VERIFY=0\n',
+    ])
 
+    if write_if_changed(dodsrc_path, dodsrc):
         logger.info('Wrote .dodsrc file {}'.format(dodsrc_path))
 
-    return cert_path
+    return {
+        'fingerprint': hashlib.sha1(user.auth.cert.encode('utf-8')).hexdigest(),
+        'not_after': certificate_not_after(user),
+        'cert_path': cert_path,
+        'dodsrc_path': dodsrc_path,
+    }
+
+def staged_certificate(user):
+    """ Stages a user's certificate if needed.
+
+    The staged certificate is kept in memory, it's only checked, refreshed
+    and written again when it expires or the user's certificate changes.
+
+    Args:
+        user: User object.
+
+    Returns:
+        A dict describing the staged certificate.
+    """
+    with user_lock(user):
+        fingerprint = hashlib.sha1(user.auth.cert.encode('utf-8')).hexdigest()
+
+        staged = STAGED.get(user.id)
+
+        if (staged is not None and staged['fingerprint'] == fingerprint and
+                datetime.now() < staged['not_after']):
+            return staged
+
+        if not check_certificate(user):
+            refresh_certificate(user)
+
+        staged = stage_certificate(user)
+
+        STAGED[user.id] = staged
+
+        return staged
+
+def dodsrc_path(user):
+    """ Path of a user's staged .dodsrc file. """
+    return staged_certificate(user)['dodsrc_path']
+
+@contextlib.contextmanager
+def dap_config(path):
+    """ Points the DAP library at a .dodsrc file.
+
+    The environment is shared by the process, callers must hold the lock
+    serializing calls into the NetCDF library.
+
+    Args:
+        path (str): Path to the .dodsrc file or None to use the default.
+    """
+    previous = os.environ.get('DAPRCFILE')
+
+    if path is None:
+        os.environ.pop('DAPRCFILE', None)
+    else:
+        os.environ['DAPRCFILE'] = path
+
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop('DAPRCFILE', None)
+        else:
+            os.environ['DAPRCFILE'] = previous
+
+def load_certificate(user):
+    """ Loads a user certificate.
+
+    The certificate is staged by `staged_certificate` along with a .dodsrc
+    file, allowing calls to NetCDF library to use the certificate.
+
+    Args:
+        user: User object.
+
+    Returns:
+        The path to the certificate.
+    """
+    return staged_certificate(user)['cert_path']
+
+@shared_task
+def refresh_certificates():
+    """ Refreshes certificates ahead of their expiry.
+
+    Certificates of OAuth2 users with jobs within CERT_REFRESH_ACTIVE that
+    expire within CERT_REFRESH_WINDOW are refreshed.
+    """
+    threshold = timezone.now() - settings.CERT_REFRESH_ACTIVE
+
+    users = models.User.objects.filter(job__status__created_date__gte=threshold,
+                                       auth__type='oauth2').distinct()
+
+    expires = datetime.now() + settings.CERT_REFRESH_WINDOW
+
+    logger.info('Checking certificates of {} active users'.format(len(users)))
+
+    for user in users:
+        try:
+            if user.auth.cert != '' and certificate_not_after(user) > expires:
+                continue
+
+            refresh_certificate(user)
+        except Exception:
+            # Discovery, HTTP and OAuth2 errors of one user must not stop the
+            # refresh of the others
+            logger.exception('Failed to refresh certificate for {}'.format(
+                user.username))
+
+            continue
+
+        logger.info('Refreshed certificate for {}'.format(user.username))
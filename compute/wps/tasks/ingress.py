@@ -3,21 +3,23 @@
 import contextlib
 import datetime
 import hashlib
-import os
 import psutil
 import uuid
 from urlparse import urlparse
 
 import cdms2
-from cdms2 import MV2
 from django import db
 from django.conf import settings
 from celery.utils import log
 
 from wps import helpers
+from wps import hyperslab
+from wps import intermediate
 from wps import metrics
 from wps import models
 from wps import WPSError
+from wps.context import NETCDF_LOCK
+from wps.context import claim_lease
 from wps.context import OperationContext
 from wps.tasks import base
 from wps.tasks import preprocess
@@ -28,38 +30,25 @@ logger = log.get_task_logger('wps.tasks.ingress')
 def ingress_cleanup(self, context):
     for input in context.inputs:
         for file_path in (input.ingress + input.process):
-            try:
-                os.remove(file_path)
-            except:
-                pass
+            intermediate.remove(file_path)
 
             logger.info('Removed %r', file_path)
 
     return context
 
 def write_cache_file(entry, input, context):
-    data = []
-    chunk_axis = None
-    chunk_axis_index = None
-
     entry.local_path = entry.new_output_path()
 
     with context.new_output(entry.local_path) as outfile:
-        for _, _, chunk in input.chunks_ingress(context):
-            if chunk_axis is None:
-                chunk_axis_index = chunk.getAxisIndex(input.chunk_axis)
-
-                chunk_axis = chunk.getAxis(chunk_axis_index)
+        writer = hyperslab.HyperslabWriter(outfile, input.variable.var_name,
+                                           NETCDF_LOCK)
 
-            if chunk_axis.isTime():
-                outfile.write(chunk, id=input.variable.var_name)
-            else:
-                data.append(chunk)
+        input_index = writer.add_input(
+            input.chunk, list(input.paths_axes(input.ingress)),
+            input.chunk.axes)
 
-        if chunk_axis is not None and not chunk_axis.isTime():
-            data = MV2.concatenate(data, axis=chunk_axis_index)
-
-            outfile.write(data, id=input.variable.var_name)
+        for _, chunk_index, chunk in input.chunks_ingress(None):
+            writer.write(input_index, chunk_index, chunk)
 
     try:
         size = entry.set_size()
@@ -93,29 +82,59 @@ def ingress_cache(self, context):
 
     return context
 
-@base.cwt_shared_task()
-def ingress_chunk(self, context, index):
+def ingress_inputs(self, context, index):
     for input_index, input in enumerate(context.sorted_inputs()):
         if input.is_cached or input.mapped is None:
             logger.info('Skipping %r either cached or not included', input.variable.uri)
 
             continue
 
-        for _, chunk_index, chunk in input.chunks(index, context):
+        if context.chunk_queue:
+            chunks = input.chunks_queue(input_index, context,
+                                        models.JobChunk.INGRESS,
+                                        self.request.id)
+        else:
+            chunks = input.chunks(input_index, index, context)
+
+        for _, chunk_index, chunk in chunks:
             start = datetime.datetime.now()
 
-            ingress_filename = '{}_{:08}_{:08}.nc'.format(str(context.job.id),
-                                                          input_index, chunk_index)
+            ingress_filename = '{}_{:08}_{:08}{}'.format(str(context.job.id),
+                                                         input_index, chunk_index,
+                                                         intermediate.EXTENSION)
 
             ingress_path = context.gen_ingress_path(ingress_filename)
 
-            with context.new_output(ingress_path) as outfile:
-                outfile.write(chunk, id=input.variable.var_name)
+            intermediate.write(ingress_path, chunk)
 
             input.ingress.append(ingress_path)
 
+            if context.chunk_queue:
+                if context.is_compute:
+                    next_stage = models.JobChunk.PROCESS
+                else:
+                    next_stage = None
+
+                models.JobChunk.complete(context.job, input_index, chunk_index,
+                                         ingress_path, next_stage)
+
             elapsed = datetime.datetime.now() - start
 
             self.status('Ingressed {!r} bytes in {!r} seconds', chunk.nbytes, elapsed.total_seconds())
 
+@base.cwt_shared_task()
+def ingress_chunk(self, context, index):
+    if not context.chunk_queue:
+        ingress_inputs(self, context, index)
+
+        return context
+
+    with claim_lease(context.job, self.request.id):
+        ingress_inputs(self, context, index)
+
+        # Chunks abandoned by workers that died are claimed again
+        while models.JobChunk.wait(context.job, models.JobChunk.INGRESS,
+                                   self.request.id):
+            ingress_inputs(self, context, index)
+
     return context
@@ -4,21 +4,33 @@ import collections
 import contextlib
 import copy
 import hashlib
+import heapq
+import itertools
 import json
 import math
+import multiprocessing
 import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import cwt
 import cdms2
+import cdtime
+import numpy as np
 import requests
 from celery.utils.log import get_task_logger
+from django import db
 from django.conf import settings
 
 from wps import helpers
+from wps import hosts
 from wps import metrics
 from wps import models
 from wps import WPSError
+from wps.context import ChunkPlan
 from wps.context import OperationContext
+from wps.context import working_set_multiplier
 from wps.tasks import base
 
 logger = get_task_logger('wps.tasks.preprocess')
@@ -29,96 +41,343 @@ def merge(self, contexts):
 
     logger.info('Merged contexts to %r', context)
 
+    totals = assign_chunks(context)
+
+    self.status('Assigned {!r} bytes to workers', totals)
+
+    enqueue_chunks(context)
+
     return context
 
+def balance(sizes, workers):
+    """ Assigns items to workers, longest processing time first.
+
+    Items are assigned largest first to the worker with the smallest total,
+    ties go to the worker with the fewest items.
+
+    Args:
+        sizes (list): Size of each item.
+        workers (int): Number of workers.
+
+    Returns:
+        A tuple with the worker index of each item and the total size
+        assigned to each worker.
+    """
+    heap = [(0, 0, x) for x in range(workers)]
+
+    assignment = [None for _ in sizes]
+
+    totals = [0 for _ in range(workers)]
+
+    for index in sorted(range(len(sizes)), key=lambda x: -sizes[x]):
+        total, count, worker = heapq.heappop(heap)
+
+        assignment[index] = worker
+
+        totals[worker] += sizes[index]
+
+        heapq.heappush(heap, (totals[worker], count + 1, worker))
+
+    return assignment, totals
+
+def enqueue_chunks(context):
+    """ Fills the job's chunk queue.
+
+    Chunks that need ingressing are queued for the ingress stage, the rest
+    are queued for processing if the operation computes anything.
+
+    Args:
+        context (OperationContext): Current operation context.
+    """
+    if not settings.WORKER_CHUNK_QUEUE or context.job is None:
+        return
+
+    chunks = []
+
+    for input_index, input in enumerate(context.sorted_inputs()):
+        if input.mapped is None:
+            continue
+
+        if settings.INGRESS_ENABLED and not input.is_cached:
+            stage = models.JobChunk.INGRESS
+        elif context.is_compute:
+            stage = models.JobChunk.PROCESS
+        else:
+            continue
+
+        chunks.extend((input_index, x, y, stage)
+                      for x, y in enumerate(input.chunk.sizes))
+
+    models.JobChunk.enqueue(context.job, chunks)
+
+    context.chunk_queue = True
+
+    logger.info('Queued %r chunks', len(chunks))
+
+def assign_chunks(context):
+    """ Assigns the chunks of all inputs to workers.
+
+    Chunks are balanced by size over WORKER_PER_USER workers, the chunks of
+    a large input are spread over multiple workers. The assignment is only
+    used when the job has no chunk queue, queued chunks are claimed largest
+    first by whichever worker is free.
+
+    Args:
+        context (OperationContext): Current operation context.
+
+    Returns:
+        A list of the total bytes assigned to each worker.
+    """
+    items = [(x, y) for x in context.inputs for y in range(len(x.chunk))]
+
+    sizes = [x.chunk.sizes[y] for x, y in items]
+
+    assignment, totals = balance(sizes, settings.WORKER_PER_USER)
+
+    for input in context.inputs:
+        input.workers = [None for _ in range(len(input.chunk))]
+
+    for (input, index), worker in zip(items, assignment):
+        input.workers[index] = worker
+
+    logger.info('Worker byte totals %r', totals)
+
+    return totals
+
+# Bytes used by the mask of a masked array for each element
+MASK_ITEMSIZE = 1
+
+# Itemsize assumed when the variable's dtype is unknown
+DEFAULT_ITEMSIZE = 4
+
 def axis_size(data):
+    """ Number of elements selected along an axis.
+
+    Args:
+        data (slice, int): A slice or number of elements.
+
+    Returns:
+        An int number of elements.
+    """
     if isinstance(data, slice):
-        return ((data.stop - data.start) / data.step) * 4
+        step = data.step or 1
+
+        return max(int(math.ceil((data.stop - data.start) / float(step))), 0)
 
     return data
 
-@base.cwt_shared_task()
-def generate_chunks(self, context):
-    """ Generate chunks.
+def align_count(count, size):
+    """ Aligns a number of elements with a storage chunk size.
+
+    Args:
+        count (int): Number of elements that fit in memory.
+        size (int): Storage chunk size along the axis.
+
+    Returns:
+        The largest multiple of size not greater than count, otherwise the
+        largest divisor of size not greater than count.
+    """
+    if count >= size:
+        return count - (count % size)
+
+    return max(x for x in range(1, count + 1) if size % x == 0)
+
+def plan_chunks(order, mapped, candidates, element_size, budget, storage=None):
+    """ Plans the chunks for a mapped domain.
+
+    The lowest order candidate axis is split first, when a single slab along
+    it does not fit within the budget the next candidate axis is split as
+    well. If the storage chunk shape is known, slab sizes are rounded to a
+    multiple of the storage chunk size, or to a divisor of it when a single
+    storage chunk does not fit, and boundaries are placed on multiples of
+    the slab size. Only slabs spanning whole storage chunks avoid reading a
+    storage chunk more than once.
+
+    Args:
+        order (list): Axis names in the order of the variable.
+        mapped (dict): Axis names mapped to slices.
+        candidates (list): Axis names that can be split, in order.
+        element_size (int): Bytes per element including mask overhead.
+        budget (float): Maximum bytes per chunk.
+        storage (dict): Axis names mapped to storage chunk sizes.
+
+    Returns:
+        A ChunkPlan.
+    """
+    lengths = dict((x, axis_size(mapped[x])) for x in order)
+
+    storage = storage or {}
+
+    remaining = list(order)
+
+    split = []
+
+    aligned = set()
+
+    nbytes = element_size * reduce(lambda x, y: x * y,
+                                   [lengths[x] for x in remaining], 1)
+
+    for axis in candidates:
+        remaining.remove(axis)
+
+        unit = element_size * reduce(lambda x, y: x * y,
+                                     [lengths[x] for x in remaining], 1)
+
+        count = max(min(int(budget / unit), lengths[axis]), 1)
+
+        if (axis in storage and count < lengths[axis] and
+                (mapped[axis].step or 1) == 1):
+            count = align_count(count, storage[axis])
+
+            aligned.add(axis)
+
+        split.append((axis, count))
+
+        nbytes = unit * count
+
+        if nbytes <= budget:
+            break
+
+    logger.info('Split %r aligned %r chunk size %r budget %r', split,
+                aligned, nbytes, budget)
+
+    if nbytes > budget:
+        raise WPSError('A single chunk cannot fit it memory, consider'
+                       ' subsetting the data further.')
+
+    slices = []
+
+    for axis, count in split:
+        value = mapped[axis]
+
+        span = count * (value.step or 1)
+
+        if axis in aligned:
+            # Boundaries fall on multiples of span relative to the file
+            first = value.start - (value.start % span) + span
+
+            starts = [value.start] + range(first, value.stop, span)
+        else:
+            starts = range(value.start, value.stop, span)
+
+        stops = starts[1:] + [value.stop]
+
+        slices.append([slice(x, y, value.step) for x, y in zip(starts, stops)])
+
+    axes = [x[0] for x in split]
+
+    chunks = [dict(zip(axes, x)) for x in itertools.product(*slices)]
+
+    base = element_size * reduce(lambda x, y: x * y,
+                                 [lengths[x] for x in remaining], 1)
+
+    sizes = [base * reduce(lambda x, y: x * y,
+                           [axis_size(y) for y in x.values()], 1)
+             for x in chunks]
+
+    return ChunkPlan(axes, chunks, nbytes, sizes)
+
+def process_axes(context):
+    """ Axes the operation is applied over.
 
     Args:
         context (OperationContext): Current context.
 
     Returns:
-        Updated context.
+        A set of axis names.
     """
     axes = context.operation.get_parameter('axes')
 
     try:
-        process_axis = set(axes.values)
+        return set(axes.values)
     except AttributeError:
-        process_axis = set()
+        return set()
 
-    logger.info('Process axes %r', process_axis)
+def chunk_input(input, process_axis, budget, regrid=False):
+    """ Plans the chunks of a single input.
 
-    for input in context.inputs:
-        order = input.mapped_order
+    Regridded inputs are never split over a spatial axis, each chunk holds
+    whole horizontal slabs and is regridded on its own.
+
+    Args:
+        input (VariableContext): Input to plan.
+        process_axis (set): Axes the operation is applied over.
+        budget (float): Maximum number of bytes per chunk.
+        regrid (bool): Whether the input is regridded.
+    """
+    order = input.mapped_order
 
-        # Find axes that we can chunk over
-        file_axes = set(order) - process_axis
+    # Axes that we can chunk over, lowest order first
+    candidates = [x for x in order if x not in process_axis]
 
-        # Select the lowest order axis that's available
-        try:
-            chunk_axis = reduce(lambda x, y: x if order.index(x) <
-                                        order.index(y) else y, file_axes)
-        except TypeError:
-            # Default to time axis?
-            chunk_axis = None
+    if regrid:
+        candidates = [x for x in candidates if x not in input.spatial_axes]
 
-        logger.info('Selected %r axis for chunking', chunk_axis)
+    logger.info('Candidate axes for chunking %r', candidates)
 
-        # Determine which mapping to use.
-        if input.is_cached:
-            mapped = input.cache_mapped()
+    # Determine which mapping to use.
+    if input.is_cached:
+        mapped = input.cache_mapped()
+
+        logger.info('Cached mapping')
+    else:
+        mapped = input.mapped
 
-            logger.info('Cached mapping')
+        logger.info('Normal mapping')
+
+    logger.info('Using mapping %r', mapped)
+
+    if mapped is not None:
+        element_size = (input.itemsize or DEFAULT_ITEMSIZE) + MASK_ITEMSIZE
+
+        # Remote chunks are not shrunk below the minimum request size
+        if input.is_cached:
+            input_budget = budget
         else:
-            mapped = input.mapped
+            input_budget = hosts.chunk_size(input.hostname, budget)
 
-            logger.info('Normal mapping')
+        # Cache files do not share the storage layout of the remote file
+        if input.is_cached:
+            storage = None
+        else:
+            storage = input.storage_chunks
 
-        logger.info('Using mapping %r', mapped)
+        input.chunk = plan_chunks(order, mapped, candidates, element_size,
+                                  input_budget, storage)
+    else:
+        input.chunk = ChunkPlan()
 
-        if chunk_axis is not None and mapped is not None:
-            # Collect non chunk axis slices
-            non_chunk_axes = [mapped[x] for x in (set(order) - set([chunk_axis]))]
+    input.chunk_axis = input.chunk.axis
 
-            logger.info('Non chunk axes %r', non_chunk_axes)
+    input.nbytes = sum(input.chunk.sizes)
 
-            # Reduce won't convert if array length is 1
-            if len(non_chunk_axes) > 1:
-                chunk_size = reduce(lambda x, y: axis_size(x) * axis_size(y),
-                                    non_chunk_axes)
-            else:
-                chunk_size = axis_size(non_chunk_axes[0])
+@base.cwt_shared_task()
+def generate_chunks(self, context):
+    """ Generate chunks.
 
-            logger.info('Chunk size %r', chunk_size)
+    Chunks are sized using the variable's itemsize, mask overhead and the
+    operation's working set multiplier. Chunks read remotely are never
+    smaller than WORKER_CHUNK_MIN_SIZE.
 
-            chunk_per_worker = int(settings.WORKER_MEMORY / 2 / chunk_size)
+    Args:
+        context (OperationContext): Current context.
 
-            logger.info('Chunk per worker %r', chunk_per_worker)
+    Returns:
+        Updated context.
+    """
+    with metrics.WPS_PREPROCESS_TIME.labels('generate_chunks').time():
+        process_axis = process_axes(context)
 
-            if chunk_per_worker == 0:
-                raise WPSError('A single chunk cannot fit it memory, consider'
-                               ' subsetting the data further.')
+        logger.info('Process axes %r', process_axis)
 
-            chunk_axis_slice = mapped[chunk_axis]
+        budget = settings.WORKER_MEMORY / float(working_set_multiplier(context))
 
-            # Generate actual chunks
-            for start in range(chunk_axis_slice.start, chunk_axis_slice.stop,
-                               chunk_per_worker):
-                input.chunk.append(slice(start, min(start + chunk_per_worker,
-                                                     chunk_axis_slice.stop),
-                                          chunk_axis_slice.step))
+        logger.info('Chunk memory budget %r', budget)
 
-        input.chunk_axis = chunk_axis
+        for input in context.inputs:
+            chunk_input(input, process_axis, budget, context.is_regrid)
 
-        self.status('Generated {!r} chunks over {!r} axis for {!r}', len(input.chunk), input.chunk_axis, input.filename)
+            self.status('Generated {!r} chunks over {!r} axes for {!r}', len(input.chunk), input.chunk.axes, input.filename)
 
     return context
 
@@ -160,33 +419,233 @@ def check_cache_entries(input, context):
 
 @base.cwt_shared_task()
 def check_cache(self, context):
-    for input in context.inputs:
-        if input.mapped is None:
-            logger.info('Skipping input %r', input.variable.uri)
+    with metrics.WPS_PREPROCESS_TIME.labels('check_cache').time():
+        for input in context.inputs:
+            if input.mapped is None:
+                logger.info('Skipping input %r', input.variable.uri)
 
-            continue
+                continue
 
-        input.cache = check_cache_entries(input, context)
+            input.cache = check_cache_entries(input, context)
 
     return context
 
-def map_axis_interval(axis, start, stop):
-    """ Map start/stop to axis.
+# Seconds in each fixed length time unit
+TIME_UNIT_SECONDS = {
+    's': 1, 'sec': 1, 'secs': 1, 'second': 1, 'seconds': 1,
+    'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hr': 3600, 'hrs': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+}
+
+# Transforms between time units keyed by units, calendar and base units
+TIME_CACHE = collections.OrderedDict()
+
+# Converted values of variable length units keyed by units, calendar, base
+# units and a digest of the values
+TIME_VALUES = collections.OrderedDict()
+
+TIME_CACHE_LOCK = threading.Lock()
+
+TIME_CACHE_SIZE = 256
+
+TIME_VALUES_SIZE = 32
+
+def time_cache(cache, size, key, func, *args):
+    """ Looks up a cached time conversion, computing it on a miss.
+
+    Least recently used entries are evicted once size is reached.
 
     Args:
-        axis (cdms2.Axis): Axis to be mapped.
-        start (int): Start value.
-        stop (int): Stop value.
+        cache (collections.OrderedDict): Cache to use.
+        size (int): Maximum number of entries.
+        key (tuple): Key of the conversion.
+        func (function): Function computing the conversion.
+        *args: Arguments passed to func.
 
     Returns:
-        A tuple with the mapping.
+        The cached or computed value.
     """
-    try:
-        map = axis.mapInterval((start, stop))
-    except Exception:
+    with TIME_CACHE_LOCK:
+        if key in cache:
+            value = cache.pop(key)
+
+            cache[key] = value
+
+            return value
+
+    value = func(*args)
+
+    with TIME_CACHE_LOCK:
+        cache[key] = value
+
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    return value
+
+def time_unit_seconds(units):
+    """ Length of a relative time unit.
+
+    Args:
+        units (str): Relative time units e.g. "days since 1990-01-01".
+
+    Returns:
+        The number of seconds in the unit or None if the unit does not have a
+        fixed length e.g. months or years.
+    """
+    unit = units.split('since')[0].strip().lower()
+
+    return TIME_UNIT_SECONDS.get(unit)
+
+def affine_transform(units, calendar, base_units):
+    scale = time_unit_seconds(units)
+
+    base_scale = time_unit_seconds(base_units)
+
+    if scale is None or base_scale is None:
+        return None
+
+    offset = cdtime.reltime(0, units).torel(base_units, calendar).value
+
+    return float(scale) / base_scale, offset
+
+def time_transform(units, calendar, base_units):
+    """ Affine transform between two relative time units.
+
+    Transforms are cached, least recently used transforms are evicted once
+    TIME_CACHE_SIZE is reached.
+
+    Args:
+        units (str): Units of the values.
+        calendar (int): cdtime calendar of the values.
+        base_units (str): Units to convert to.
+
+    Returns:
+        A tuple of the scale and offset or None if either unit does not have
+        a fixed length.
+    """
+    return time_cache(TIME_CACHE, TIME_CACHE_SIZE, (units, calendar,
+                                                     base_units),
+                      affine_transform, units, calendar, base_units)
+
+def convert_values(values, units, calendar, base_units):
+    values = np.array([
+        cdtime.reltime(x, units).torel(base_units, calendar).value
+        for x in values
+    ], dtype=np.float64)
+
+    # Cached arrays are shared between callers
+    values.flags.writeable = False
+
+    return values
+
+def convert_time(values, units, calendar, base_units):
+    """ Converts relative time values to new base units.
+
+    Fixed length units are converted with a single cached affine transform,
+    other units fall back to converting each value with cdtime. The values
+    converted by cdtime are cached, least recently used values are evicted
+    once TIME_VALUES_SIZE is reached.
+
+    Args:
+        values (numpy.ndarray): Relative time values.
+        units (str): Units of the values.
+        calendar (int): cdtime calendar of the values.
+        base_units (str): Units to convert to.
+
+    Returns:
+        A numpy.ndarray of values relative to base_units.
+    """
+    transform = time_transform(units, calendar, base_units)
+
+    if transform is not None:
+        scale, offset = transform
+
+        return values * scale + offset
+
+    values = np.ascontiguousarray(values, dtype=np.float64)
+
+    digest = hashlib.sha1(values.tostring()).hexdigest()
+
+    return time_cache(TIME_VALUES, TIME_VALUES_SIZE, (units, calendar,
+                                                      base_units, digest),
+                      convert_values, values, units, calendar, base_units)
+
+def axis_values(axis, units):
+    """ Coordinate values of an axis.
+
+    Args:
+        axis (cdms2.Axis): Axis to read.
+        units (str): Units time values are converted to.
+
+    Returns:
+        A numpy.ndarray of the coordinate values.
+    """
+    values = np.asarray(axis[:], dtype=np.float64)
+
+    if axis.isTime() and units is not None and axis.units != units:
+        values = convert_time(values, axis.units, axis.getCalendar(),
+                              str(units))
+
+    return values
+
+def map_interval(values, start, stop, modulo=None):
+    """ Maps a closed interval to the indices of a coordinate array.
+
+    Monotonic increasing and decreasing coordinates are supported. When a
+    modulo is given the interval may wrap around the axis and the stop index
+    may be greater than the length of the axis.
+
+    Args:
+        values (numpy.ndarray): Monotonic coordinate values.
+        start (float): Start of the interval.
+        stop (float): Stop of the interval.
+        modulo (float): Cycle length of a circular axis.
+
+    Returns:
+        A tuple with the start and stop index.
+    """
+    start, stop = min(start, stop), max(start, stop)
+
+    n = len(values)
+
+    decreasing = n > 1 and values[0] > values[-1]
+
+    if decreasing:
+        reverse = values[::-1]
+
+        i = n - np.searchsorted(reverse, stop, 'right')
+
+        j = n - np.searchsorted(reverse, start, 'left')
+    elif modulo is not None and n > 0:
+        # Move the interval into the first cycle of the axis
+        shift = math.floor((start - values[0]) / modulo) * modulo
+
+        extended = np.concatenate([values + x * modulo for x in range(3)])
+
+        i = np.searchsorted(extended, start - shift, 'left')
+
+        j = min(np.searchsorted(extended, stop - shift, 'right'), i + n)
+
+        if i >= n:
+            i, j = i - n, j - n
+    else:
+        i = np.searchsorted(values, start, 'left')
+
+        j = np.searchsorted(values, stop, 'right')
+
+    if i >= j:
         raise WPSError('Unabled to map interval {!r} to {!r}', start, stop)
 
-    return map
+    return int(i), int(j)
+
+def axis_modulo(axis):
+    """ Cycle length of an axis or None if it is not circular. """
+    if axis.isCircular():
+        return axis.getModulo()
+
+    return None
 
 def map_axis_indices(axis, dimension):
     """ Maps axis to indices.
@@ -226,12 +685,13 @@ def map_axis_indices(axis, dimension):
 
     return selector
 
-def map_axis_values(axis, dimension):
+def map_axis_values(axis, dimension, units=None):
     """ Map axis to values.
     
     Args:
         axis (cdms2.Axis): Axis to be mapped.
         dimension (cwt.Dimension): The dimension to map.
+        units (str): Units to be used if a time axis is being mapped.
 
     Returns:
         A selector for cdms2.
@@ -242,7 +702,9 @@ def map_axis_values(axis, dimension):
 
     step = helpers.int_or_float(dimension.step)
 
-    map = map_axis_interval(axis, start, stop)
+    values = axis_values(axis, units)
+
+    map = map_interval(values, start, stop, axis_modulo(axis))
 
     selector = slice(map[0], map[1], step)
 
@@ -250,19 +712,52 @@ def map_axis_values(axis, dimension):
 
     return selector
 
-def map_axis_timestamps(axis, dimension):
+def timestamp_value(value, units, calendar):
+    """ Converts a timestamp to a relative time value.
+
+    Args:
+        value (str, int, float): Timestamp or relative time value.
+        units (str): Relative time units.
+        calendar (int): cdtime calendar.
+
+    Returns:
+        A float relative time value.
+    """
+    if isinstance(value, basestring):
+        try:
+            return cdtime.s2r(str(value), units, calendar).value
+        except Exception:
+            raise WPSError('Unabled to convert timestamp {!r}', value)
+
+    return value
+
+def map_axis_timestamps(axis, dimension, units=None):
     """ Map axis to timestamps.
 
     Args:
         axis (cdms2.Axis): Axis to be mapped.
         dimension (cwt.Dimension): The dimension to map.
+        units (str): Units to be used if a time axis is being mapped.
 
     Returns:
         A selector for cdms2.
     """
     step = helpers.int_or_float(dimension.step)
-    
-    map = map_axis_interval(axis, dimension.start, dimension.end)
+
+    values = axis_values(axis, units)
+
+    if axis.isTime() and units is not None:
+        units = str(units)
+    else:
+        units = axis.units
+
+    calendar = axis.getCalendar()
+
+    start = timestamp_value(dimension.start, units, calendar)
+
+    stop = timestamp_value(dimension.end, units, calendar)
+
+    map = map_interval(values, start, stop, axis_modulo(axis))
 
     selector = slice(map[0], map[1], step)
 
@@ -281,17 +776,12 @@ def map_axis(axis, dimension, units):
     Returns:
         A slice that will be used as a cdms2 selector.
     """
-    if axis.isTime() and units is not None:
-        axis = axis.clone()
-
-        axis.toRelativeTime(str(units))
-
     if dimension is None or dimension.crs == cwt.INDICES:
         selector = map_axis_indices(axis, dimension)
     elif dimension.crs == cwt.VALUES:
-        selector = map_axis_values(axis, dimension)
+        selector = map_axis_values(axis, dimension, units)
     elif dimension.crs == cwt.TIMESTAMPS:
-        selector = map_axis_timestamps(axis, dimension)
+        selector = map_axis_timestamps(axis, dimension, units)
     else:
         raise WPSError('Unknown CRS {!r}', dimension.crs)
 
@@ -331,6 +821,155 @@ def merge_dimensions(context, file_dimensions):
     # Return union of user and file dimensions
     return user_dim | file_dim
 
+def probe_metadata(context):
+    """ Retrieves the axis metadata of all inputs concurrently.
+
+    Inputs are probed by a bounded pool of threads, the number of concurrent
+    probes to a single host is limited by WORKER_METADATA_HOST_LIMIT. All
+    probes share a single deadline of WORKER_METADATA_TIMEOUT seconds.
+
+    Threads can not be interrupted, a probe that is still running when the
+    deadline passes is abandoned rather than stopped. Abandoned probes that
+    have not opened their file yet return without opening it. Files missing
+    from the axis metadata index are opened under NETCDF_LOCK, so those
+    probes are serialized within a worker and only index lookups and access
+    checks run concurrently.
+
+    Args:
+        context (OperationContext): Current operation context.
+
+    Returns:
+        A list of wps.models.AxisMetadata in the same order as the inputs.
+
+    Raises:
+        WPSError: If the metadata is not retrieved before the deadline.
+    """
+    limits = dict((x.hostname, threading.BoundedSemaphore(
+        settings.WORKER_METADATA_HOST_LIMIT)) for x in context.inputs)
+
+    cancelled = threading.Event()
+
+    def probe(input):
+        try:
+            with limits[input.hostname]:
+                if cancelled.is_set():
+                    raise WPSError('Cancelled retrieving metadata for {!r}',
+                                   input.filename)
+
+                return input.metadata(context.user, cancelled)
+        finally:
+            # Each thread has its own database connection
+            db.connection.close()
+
+    size = max(min(settings.WORKER_METADATA_THREADS, len(context.inputs)), 1)
+
+    deadline = time.time() + settings.WORKER_METADATA_TIMEOUT
+
+    pool = ThreadPool(size)
+
+    try:
+        results = [pool.apply_async(probe, (x,)) for x in context.inputs]
+
+        metadata = []
+
+        for input, result in zip(context.inputs, results):
+            try:
+                metadata.append(result.get(max(deadline - time.time(), 0)))
+            except multiprocessing.TimeoutError:
+                raise WPSError('Timed out retrieving metadata for {!r}',
+                               input.filename)
+    finally:
+        cancelled.set()
+
+        # Abandoned probes finish in the background, the pool's threads are
+        # daemons and do not block the worker from exiting
+        pool.terminate()
+
+    return metadata
+
+def map_input(context, input, metadata):
+    """ Maps the domain to a single input.
+
+    Args:
+        context (OperationContext): Current operation context.
+        input (VariableContext): Input to map.
+        metadata (AxisMetadata): Axis metadata of the input.
+    """
+    axes = metadata.axis_list()
+
+    input.mapped_order = [x.id for x in axes]
+
+    logger.info('Axis mapped order %r', input.mapped_order)
+
+    input.spatial_axes = [x.id for x in axes if x.isLatitude() or
+                          x.isLongitude()]
+
+    input.itemsize = metadata.itemsize
+
+    input.storage_chunks = metadata.chunk_sizes
+
+    logger.info('Storage chunks %r', input.storage_chunks)
+
+    input.mapped = map_axes(context, axes)
+
+def map_axes(context, axes):
+    """ Maps the domain to the axes of a variable.
+
+    Args:
+        context (OperationContext): Current operation context.
+        axes (list): List of cdms2.axis.TransientAxis of the variable.
+
+    Returns:
+        A dict of axis names mapped to selectors or None if the domain does
+        not map to the axes.
+    """
+    mapped = {}
+
+    dimensions = merge_dimensions(context, [x.id for x in axes])
+
+    logger.info('Merge dimensions %r', dimensions)
+
+    for name in dimensions:
+        try:
+            dim = context.domain.get_dimension(name)
+        except AttributeError:
+            dim = None
+
+        try:
+            axis = [x for x in axes if x.id == name][0]
+        except IndexError:
+            raise WPSError('Axis {!r} was not found in remote file',
+                           name)
+
+        try:
+            mapped[name] = map_axis(axis, dim, context.units)
+        #except WPSError:
+        #    raise
+        except Exception:
+            return None
+
+        logger.info('Mapped %r to %r', name, mapped[name])
+
+    return mapped
+
+def mapped_nbytes(context, metadata):
+    """ Number of bytes of the domain selected from an input.
+
+    Args:
+        context (OperationContext): Current operation context.
+        metadata (AxisMetadata): Axis metadata of the input.
+
+    Returns:
+        An int number of bytes, 0 if the domain does not map to the input.
+    """
+    mapped = map_axes(context, metadata.axis_list())
+
+    if mapped is None:
+        return 0
+
+    return (metadata.itemsize or DEFAULT_ITEMSIZE) * reduce(
+        lambda x, y: x * y, [axis_size(x) for x in mapped.values()], 1)
+
 @base.cwt_shared_task()
 def map_domain(self, context):
     """ Maps a domain.
@@ -341,46 +980,41 @@ def map_domain(self, context):
     Returns:
         An updated operation context.
     """
-    for input in context.inputs:
-        self.status('Mapping {!r}', input.filename)
+    with metrics.WPS_PREPROCESS_TIME.labels('map_domain').time():
+        metadata = probe_metadata(context)
 
-        with input.open(context.user) as var:
-            axes = var.getAxisList()
+        for input, input_metadata in zip(context.inputs, metadata):
+            self.status('Mapping {!r}', input.filename)
 
-            input.mapped_order = [x.id for x in axes]
+            map_input(context, input, input_metadata)
 
-            logger.info('Axis mapped order %r', input.mapped_order)
-
-            dimensions = merge_dimensions(context, input.mapped_order)
+    return context
 
-            logger.info('Merge dimensions %r', dimensions)
+def input_units(input, metadata):
+    """ Sets the time units of a single input.
 
-            for name in dimensions:
-                try:
-                    dim = context.domain.get_dimension(name)
-                except AttributeError:
-                    dim = None
+    Args:
+        input (VariableContext): Input to inspect.
+        metadata (AxisMetadata): Axis metadata of the input.
 
-                axis_index = var.getAxisIndex(name)
+    Returns:
+        The time units of the input or None if it has no time axis.
+    """
+    time = metadata.get_time()
 
-                if axis_index == -1:
-                    raise WPSError('Axis {!r} was not found in remote file',
-                                   name)
+    if time is None:
+        logger.info('Skipping %r', input.filename)
 
-                axis = var.getAxis(axis_index).clone()
+        return None
 
-                try:
-                    input.mapped[name] = map_axis(axis, dim, context.units)
-                #except WPSError:
-                #    raise
-                except Exception:
-                    input.mapped = None
+    input.first = time[0]
 
-                    break
+    input.units = time.units
 
-                logger.info('Mapped %r to %r', name, input.mapped[name])
+    logger.info('%r units: %r first: %r', input.filename, input.units,
+                input.first)
 
-    return context
+    return input.units
 
 @base.cwt_shared_task()
 def base_units(self, context):
@@ -393,39 +1027,85 @@ def base_units(self, context):
         An OperationContext whose inputs have their time units
         filled out.
     """
-    units = []
-
     logger.info('Determining base units')
 
-    for input in context.inputs:
-        with input.open(context.user) as var:
-            time = var.getTime()
-
-            if time is not None:
-                input.first = time[0]
+    with metrics.WPS_PREPROCESS_TIME.labels('base_units').time():
+        metadata = probe_metadata(context)
 
-                input.units = time.units
+        units = [input_units(x, y) for x, y in zip(context.inputs, metadata)]
 
-                units.append(input.units)
+        units = [x for x in units if x is not None]
 
-                logger.info('%r units: %r first: %r', input.filename, input.units,
-                            input.first)
-            else:
-                logger.info('Skipping %r', input.filename)
+        try:
+            context.units = sorted(units)[0]
+        except IndexError:
+            pass
 
-    try:
-        context.units = sorted(units)[0]
-    except IndexError:
-        pass
+        # Inputs are balanced by the size of the domain selected from them
+        for input, input_metadata in zip(context.inputs, metadata):
+            input.nbytes = mapped_nbytes(context, input_metadata)
 
     self.status('Setting units to {!r}', context.units)
 
     return context
 
+@base.cwt_shared_task()
+def preprocess_inputs(self, context):
+    """ Preprocesses all inputs in a single task.
+
+    Fuses base_units, map_domain, check_cache and generate_chunks. The
+    metadata of each input is read once and the resulting context matches
+    the one produced by the chain of individual tasks.
+
+    Args:
+        context (OperationContext): Current operation context.
+
+    Returns:
+        An updated operation context.
+    """
+    with metrics.WPS_PREPROCESS_TIME.labels('preprocess_inputs').time():
+        metadata = probe_metadata(context)
+
+        units = [input_units(x, y) for x, y in zip(context.inputs, metadata)]
+
+        units = [x for x in units if x is not None]
+
+        try:
+            context.units = sorted(units)[0]
+        except IndexError:
+            pass
+
+        logger.info('Setting units to %r', context.units)
+
+        process_axis = process_axes(context)
+
+        budget = settings.WORKER_MEMORY / float(working_set_multiplier(context))
+
+        for input, input_metadata in zip(context.inputs, metadata):
+            map_input(context, input, input_metadata)
+
+            if input.mapped is not None:
+                input.cache = check_cache_entries(input, context)
+
+            chunk_input(input, process_axis, budget, context.is_regrid)
+
+            self.status('Generated {!r} chunks over {!r} axes for {!r}', len(input.chunk), input.chunk.axes, input.filename)
+
+        totals = assign_chunks(context)
+
+        enqueue_chunks(context)
+
+    self.status('Assigned {!r} bytes to workers', totals)
+
+    return context
+
 @base.cwt_shared_task()
 def filter_inputs(self, context, index):
     """ Filters context inputs.
 
+    Inputs are balanced over the workers by the size of the domain selected
+    from them, largest first.
+
     Args:
         context (OperationContext): Current operation context.
         index (int): The index to filter on.
@@ -436,11 +1116,17 @@ def filter_inputs(self, context, index):
     logger.debug('Index %r Length %r Workers %r', index, len(context.inputs),
                  settings.WORKER_PER_USER)
 
-    indices = [x for x in range(index, len(context.inputs),
-                                settings.WORKER_PER_USER)]
+    sizes = [x.nbytes or 0 for x in context.inputs]
+
+    assignment, totals = balance(sizes, settings.WORKER_PER_USER)
+
+    indices = [x for x, y in enumerate(assignment) if y == index]
 
     logger.info('Filtering indices %r', indices)
 
+    self.status('Preprocessing {!r} inputs with {!r} bytes', len(indices),
+                totals[index])
+
     context.inputs = [context.inputs[x] for x in indices]
 
     return context
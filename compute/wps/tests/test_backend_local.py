@@ -26,3 +26,27 @@ class LocalBackendTestCase(test.TestCase):
         self.backend.populate_processes()
 
         self.assertEqual(len(self.backend.processes), count)
+
+    @mock.patch('wps.backends.cdat.tasks')
+    def test_generate_preprocess_fused(self, mock_tasks):
+        context = mock.MagicMock()
+
+        with self.settings(PREPROCESS_FUSED=True):
+            self.backend.generate_preprocess(context)
+
+        mock_tasks.preprocess_inputs.s.assert_called()
+        mock_tasks.base_units.s.assert_not_called()
+
+        context.job.step_inc.assert_called_with(2)
+
+    @mock.patch('wps.backends.cdat.tasks')
+    def test_generate_preprocess(self, mock_tasks):
+        context = mock.MagicMock()
+
+        with self.settings(PREPROCESS_FUSED=False, WORKER_PER_USER=2):
+            self.backend.generate_preprocess(context)
+
+        mock_tasks.preprocess_inputs.s.assert_not_called()
+        mock_tasks.base_units.s.assert_called()
+
+        self.assertEqual(mock_tasks.map_domain.s.call_count, 2)
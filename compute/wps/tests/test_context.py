@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+
+import threading
+
+import cdms2
+import cwt
+import mock
+from django import test
+
+from wps import context
+
+class ContextTestCase(test.TestCase):
+
+    @mock.patch('wps.context.metrics')
+    def test_prefetch_error(self, mock_metrics):
+        def chunks():
+            yield 1
+
+            raise Exception('failed')
+
+        gen = context.prefetch(chunks(), 2, 'host')
+
+        self.assertEqual(next(gen), 1)
+
+        with self.assertRaises(Exception) as e:
+            next(gen)
+
+        self.assertEqual(str(e.exception), 'failed')
+
+    @mock.patch('wps.context.metrics')
+    def test_prefetch_stop_early(self, mock_metrics):
+        closed = []
+
+        def chunks():
+            try:
+                for x in range(10):
+                    yield x
+            finally:
+                closed.append(True)
+
+        gen = context.prefetch(chunks(), 1, 'host')
+
+        self.assertEqual(next(gen), 0)
+
+        gen.close()
+
+        self.assertEqual(closed, [True])
+
+    @mock.patch('wps.context.metrics')
+    def test_prefetch(self, mock_metrics):
+        gen = context.prefetch((x for x in range(5)), 2, 'host')
+
+        self.assertEqual(list(gen), range(5))
+
+        self.assertEqual(mock_metrics.WPS_CHUNK_WAIT.labels.return_value.observe.call_count, 6)
+
+    def test_prefetch_disabled(self):
+        gen = context.prefetch(iter(range(5)), 0, 'host')
+
+        self.assertEqual(list(gen), range(5))
+
+    @test.override_settings(WORKER_MEMORY=10, WORKER_PREFETCH_DEPTH=4)
+    def test_prefetch_depth(self):
+        input = context.VariableContext(None)
+
+        input.chunk = mock.MagicMock(nbytes=2)
+
+        # The reader holds one chunk beyond the buffer
+        self.assertEqual(input.prefetch_depth(2), 2)
+
+        self.assertEqual(input.prefetch_depth(3), 1)
+
+        input.chunk.nbytes = 5
+
+        self.assertEqual(input.prefetch_depth(2), 0)
+
+        input.chunk.nbytes = 0
+
+        self.assertEqual(input.prefetch_depth(2), 0)
+
+    @mock.patch('wps.context.db')
+    @mock.patch('wps.context.models')
+    def test_renew_claims(self, mock_models, mock_db):
+        mock_models.JobChunk.CLAIM_POLL = 0
+
+        stop = threading.Event()
+
+        with self.settings(WORKER_CLAIM_TIMEOUT=0):
+            renewer = threading.Thread(target=context.renew_claims,
+                                       args=('job', 'task1', stop))
+
+            renewer.start()
+
+            stop.wait(0.1)
+
+            stop.set()
+
+            renewer.join()
+
+        mock_models.JobChunk.renew.assert_called_with('job', 'task1')
+
+        mock_db.connection.close.assert_called()
+
+    def test_access_anonymous_per_file(self):
+        input = context.VariableContext(cwt.Variable(
+            'https://test.com/thredds/dodsC/tas.nc', 'tas'))
+
+        with mock.patch.object(input, 'cached_check_access',
+                               return_value=True) as mock_check:
+            input.access(mock.MagicMock())
+
+        mock_check.assert_called_with(
+            ('https://test.com/thredds/dodsC/tas.nc', None, None))
+        self.assertIsNone(input.dodsrc)
+
+    @mock.patch('wps.context.hosts.session')
+    def test_remote_last_modified_cached(self, mock_session):
+        input = context.VariableContext(cwt.Variable(
+            'https://test.com/thredds/dodsC/tas.nc', 'tas'))
+
+        with mock.patch('wps.context.hosts.MODIFIED', {}):
+            context.hosts.cache_modified(input.variable.uri, 'Mon')
+
+            self.assertEqual(input.remote_last_modified(None), 'Mon')
+
+        mock_session.assert_not_called()
+
+    @mock.patch('wps.context.hosts.session')
+    def test_remote_last_modified_head(self, mock_session):
+        response = mock_session.return_value.head.return_value
+        response.status_code = 200
+        response.headers = {'Last-Modified': 'Tue'}
+
+        input = context.VariableContext(cwt.Variable(
+            'https://test.com/thredds/dodsC/tas.nc', 'tas'))
+
+        with mock.patch('wps.context.hosts.MODIFIED', {}):
+            self.assertEqual(input.remote_last_modified(None), 'Tue')
+
+            self.assertEqual(input.remote_last_modified(None), 'Tue')
+
+        mock_session.return_value.head.assert_called_once_with(
+            'https://test.com/thredds/dodsC/tas.nc.dds', timeout=(2, 30),
+            cert=None, verify=False, allow_redirects=True)
+
+    @mock.patch('wps.context.models.AxisMetadata')
+    def test_metadata_last_modified_without_user(self, mock_metadata):
+        input = context.VariableContext(cwt.Variable(
+            'https://test.com/thredds/dodsC/tas.nc', 'tas'))
+
+        with mock.patch.object(input, 'remote_last_modified',
+                               return_value='Wed'):
+            entry = input.metadata(None)
+
+        mock_metadata.lookup.assert_called_with(
+            'https://test.com/thredds/dodsC/tas.nc', 'tas', 'Wed')
+        self.assertEqual(entry, mock_metadata.lookup.return_value)
+
+    def test_subset_grid(self):
+        op = context.OperationContext()
+
+        grid = cdms2.createUniformGrid(-88.0, 45, 4.0, 2.0, 90, 4.0)
+
+        target = op.subset_grid(grid, {'lat': (-10, 10), 'lon': slice(0, 10),
+                                       'time': slice(0, 2)})
+
+        self.assertEqual(target.shape, (5, 10))
+        self.assertEqual(list(target.getLatitude()[:]), [-8, -4, 0, 4, 8])
+        self.assertEqual(target.getLongitude()[0], 2.0)
+
+    def test_subset_grid_no_overlap(self):
+        op = context.OperationContext()
+
+        grid = cdms2.createUniformGrid(-88.0, 45, 4.0, 2.0, 90, 4.0)
+
+        with self.assertRaises(context.WPSError):
+            op.subset_grid(grid, {'lat': (91, 95)})
+
+    def test_generate_grid_memoized(self):
+        context.GRIDS.clear()
+
+        op = context.OperationContext()
+
+        gridder = cwt.Gridder(grid='uniform~4x4')
+
+        with mock.patch.object(op, 'generate_user_defined_grid',
+                               wraps=op.generate_user_defined_grid) as mock_generate:
+            first = op.generate_grid(gridder, {'lat': (-10, 10)})
+
+            second = op.generate_grid(gridder, {'lat': (-10, 10),
+                                                'time': slice(0, 2)})
+
+            third = op.generate_grid(gridder, {'lat': (-20, 20)})
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+        self.assertEqual(mock_generate.call_count, 1)
+        self.assertEqual(third.shape, (11, 90))
+
+        context.GRIDS.clear()
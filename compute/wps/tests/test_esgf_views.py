@@ -145,19 +145,16 @@ class ESGFViewsTestCase(test.TestCase):
                                   ['file:///test1.nc'])
 
         self.assertEqual(mock_process.call_args[0][1:2], ('dataset_id|tas',))
+        self.assertEqual(mock_process.call_args[0][2].variable.uri,
+                         'file:///test1.nc')
 
         self.assertEqual(data, [self.process_url_output])
-        
+
     @mock.patch('wps.views.esgf.process_axes')
-    @mock.patch('cdms2.open')
     @mock.patch('wps.views.esgf.cache')
-    def test_process_url_cached(self, mock_cache, mock_open, mock_process):
+    def test_process_url_cached(self, mock_cache, mock_process):
         mock_cache.get.return_value = {}
 
-        mock_process.side_effect = [
-            self.process_url_output
-        ]
-
         user = mock.MagicMock()
 
         context = mock.MagicMock()
@@ -168,17 +165,21 @@ class ESGFViewsTestCase(test.TestCase):
 
         mock_process.assert_not_called()
 
+        context.metadata.assert_not_called()
+
     @mock.patch('wps.views.esgf.process_axes')
-    @mock.patch('cdms2.open')
     @mock.patch('wps.views.esgf.cache')
     @mock.patch('hashlib.md5')
-    def test_process_url(self, mock_md5, mock_cache, mock_open, mock_process):
+    def test_process_url(self, mock_md5, mock_cache, mock_process):
         mock_md5.return_value.hexdigest.return_value = 'id'
 
         mock_cache.get.return_value = None
 
         mock_process.side_effect = [
-            self.process_url_output
+            {
+                'temporal': self.time_desc,
+                'spatial': [self.lat_desc],
+            }
         ]
 
         user = mock.MagicMock()
@@ -192,7 +193,10 @@ class ESGFViewsTestCase(test.TestCase):
 
         self.assertEqual(data, self.process_url_output)
 
-        mock_process.assert_called()
+        context.metadata.assert_called_with(user)
+
+        mock_process.assert_called_with(
+            context.metadata.return_value.axis_list.return_value)
 
         mock_cache.set.assert_called_with('id', self.process_url_output,
                                           24*60*60)
@@ -201,11 +205,8 @@ class ESGFViewsTestCase(test.TestCase):
 
     def test_process_axes(self):
         self.maxDiff = None
-        header = mock.MagicMock()
-
-        header.getAxisList.return_value = [self.time, self.lat]
 
-        data = esgf.process_axes(header)
+        data = esgf.process_axes([self.time, self.lat])
 
         expected = {
             'temporal': self.time_desc,
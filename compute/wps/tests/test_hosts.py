@@ -0,0 +1,347 @@
+#! /usr/bin/env python
+
+import socket
+import threading
+
+import mock
+import requests
+from django import test
+
+from wps import hosts
+from wps import models
+from wps import WPSError
+
+class HostsTestCase(test.TestCase):
+
+    def setUp(self):
+        hosts.ACCESS.clear()
+
+        hosts.MODIFIED.clear()
+
+    def test_record_transfer_rolling(self):
+        with self.settings(WORKER_THROUGHPUT_HISTORY=2):
+            for x in range(4):
+                hosts.record_transfer('test.com', x, 1.0)
+
+        history = models.HostTransfer.history('test.com', 10, 0)
+
+        self.assertEqual(history, [(2, 1.0), (3, 1.0)])
+        self.assertEqual(models.HostTransfer.objects.count(), 2)
+
+    def test_record_transfer_hosts(self):
+        with self.settings(WORKER_THROUGHPUT_HISTORY=1):
+            hosts.record_transfer('test.com', 1, 1.0)
+            hosts.record_transfer('test2.com', 2, 1.0)
+
+        self.assertEqual(models.HostTransfer.history('test.com', 10, 0),
+                         [(1, 1.0)])
+        self.assertEqual(models.HostTransfer.history('test2.com', 10, 0),
+                         [(2, 1.0)])
+
+    @mock.patch('wps.hosts.time.time')
+    def test_estimate_throughput_expired(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        hosts.record_transfer('test.com', 1000, 0.501)
+        hosts.record_transfer('test.com', 1000000, 1.5)
+
+        mock_time.return_value = 1000.0 + hosts.THROUGHPUT_TIMEOUT + 1
+
+        self.assertIsNone(hosts.estimate_throughput('test.com'))
+
+    def test_estimate_throughput_no_history(self):
+        hosts.record_transfer('test.com', 1000, 1.0)
+
+        self.assertIsNone(hosts.estimate_throughput('test.com'))
+
+    def test_estimate_throughput_same_size(self):
+        hosts.record_transfer('test.com', 1000, 1.0)
+        hosts.record_transfer('test.com', 1000, 2.0)
+
+        self.assertIsNone(hosts.estimate_throughput('test.com'))
+
+    def test_estimate_throughput(self):
+        # 0.5 second latency at 1MB/s
+        hosts.record_transfer('test.com', 1000, 0.501)
+        hosts.record_transfer('test.com', 1000000, 1.5)
+        hosts.record_transfer('test.com', 4000000, 4.5)
+
+        latency, rate = hosts.estimate_throughput('test.com')
+
+        self.assertAlmostEqual(latency, 0.5, places=3)
+        self.assertAlmostEqual(rate, 1e6, delta=1e3)
+
+    def test_chunk_size_no_history(self):
+        self.assertEqual(hosts.chunk_size('test.com', 4e6), 4e6)
+
+    def test_chunk_size_high_latency(self):
+        hosts.record_transfer('test.com', 1000, 2.001)
+        hosts.record_transfer('test.com', 1000000, 3.0)
+
+        with self.settings(WORKER_LATENCY_OVERHEAD=0.1, WORKER_CHUNK_MIN_SIZE=1000):
+            size = hosts.chunk_size('test.com', 4e6)
+
+        self.assertEqual(size, 4e6)
+
+    def test_chunk_size_low_latency(self):
+        hosts.record_transfer('test.com', 1000, 0.0101)
+        hosts.record_transfer('test.com', 10000000, 1.01)
+
+        with self.settings(WORKER_LATENCY_OVERHEAD=0.1, WORKER_CHUNK_MIN_SIZE=1000):
+            size = hosts.chunk_size('test.com', 4e6)
+
+        self.assertEqual(size, 4e6)
+
+    def test_chunk_size_minimum(self):
+        hosts.record_transfer('test.com', 1000, 0.0101)
+        hosts.record_transfer('test.com', 10000000, 1.01)
+
+        with self.settings(WORKER_LATENCY_OVERHEAD=0.1, WORKER_CHUNK_MIN_SIZE=8000000):
+            size = hosts.chunk_size('test.com', 4e6)
+
+        self.assertEqual(size, 8000000)
+
+    def test_session(self):
+        session = hosts.session('test.com')
+
+        self.assertIs(hosts.session('test.com'), session)
+        self.assertIsNot(hosts.session('test2.com'), session)
+        self.assertIsNot(hosts.session('test.com', '/tmp/cert.pem'), session)
+
+    def test_session_rejects_cookies(self):
+        session = hosts.session('test.com')
+
+        request = requests.cookies.MockRequest(
+            requests.Request('GET', 'https://test.com/data.nc').prepare())
+
+        cookie = requests.cookies.create_cookie('JSESSIONID', 'abc',
+                                                domain='test.com')
+
+        session.cookies.set_cookie_if_ok(cookie, request)
+
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_access_key(self):
+        key = hosts.access_key('test.com', 1, 'cert')
+
+        self.assertEqual(key[:2], ('test.com', 1))
+        self.assertNotEqual(key[2], 'cert')
+        self.assertEqual(hosts.access_key('test.com'), ('test.com', None, None))
+
+    def test_cached_access_missing(self):
+        self.assertIsNone(hosts.cached_access(('test.com', None, None)))
+
+    @mock.patch('wps.hosts.time')
+    def test_cached_access_expired(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        with self.settings(WORKER_ACCESS_TTL=60):
+            hosts.cache_access(('test.com', None, None), True)
+
+        mock_time.time.return_value = 1061
+
+        self.assertIsNone(hosts.cached_access(('test.com', None, None)))
+
+    @mock.patch('wps.hosts.time')
+    def test_cached_modified(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        url = 'https://test.com/thredds/dodsC/tas.nc'
+
+        self.assertEqual(hosts.cached_modified(url), (False, None))
+
+        with self.settings(WORKER_ACCESS_TTL=60):
+            hosts.cache_modified(url, None)
+
+        self.assertEqual(hosts.cached_modified(url), (True, None))
+
+        mock_time.time.return_value = 1061
+
+        self.assertEqual(hosts.cached_modified(url), (False, None))
+
+    @mock.patch('wps.hosts.time')
+    def test_cache_access_backoff(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        key = ('test.com', None, None)
+
+        with self.settings(WORKER_ACCESS_BACKOFF=5,
+                           WORKER_ACCESS_BACKOFF_MAX=12):
+            for expected in (1005, 1010, 1012):
+                hosts.cache_access(key, False, 'Timeout')
+
+                self.assertEqual(hosts.ACCESS[key]['expires'], expected)
+
+        self.assertEqual(hosts.cached_access(key), (False, 'Timeout'))
+
+        hosts.cache_access(key, True)
+
+        self.assertEqual(hosts.ACCESS[key]['failures'], 0)
+
+    @mock.patch('wps.hosts.time')
+    def test_breaker(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        with self.settings(WORKER_BREAKER_THRESHOLD=2, WORKER_BREAKER_RESET=60):
+            self.assertFalse(hosts.record_failure('test.com'))
+            self.assertTrue(hosts.record_failure('test.com'))
+
+            with self.assertRaises(hosts.HostUnavailableError):
+                hosts.check_breaker('test.com')
+
+            mock_time.time.return_value = 1061
+
+            hosts.check_breaker('test.com')
+
+            self.assertEqual(hosts.breaker('test.com')['state'], hosts.HALF_OPEN)
+
+            # Trial request is in progress
+            with self.assertRaises(hosts.HostUnavailableError):
+                hosts.check_breaker('test.com')
+
+            hosts.record_success('test.com')
+
+        self.assertEqual(hosts.breaker('test.com')['state'], hosts.CLOSED)
+        self.assertEqual(hosts.breaker('test.com')['failures'], 0)
+
+    def test_transport_error(self):
+        self.assertTrue(hosts.transport_error(requests.ConnectTimeout()))
+        self.assertTrue(hosts.transport_error(socket.timeout()))
+        self.assertTrue(hosts.transport_error(
+            RuntimeError('NetCDF: DAP server error')))
+        self.assertFalse(hosts.transport_error(
+            RuntimeError('NetCDF: Authorization failure')))
+        self.assertFalse(hosts.transport_error(MemoryError()))
+        self.assertFalse(hosts.transport_error(
+            IndexError('index out of bounds')))
+
+    @mock.patch('wps.hosts.time')
+    def test_breaker_single_trial(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        hosts.set_breaker('test.com', hosts.OPEN, 5)
+
+        # Workers that read the open breaker at the same time
+        self.assertTrue(models.HostBreaker.trial('test.com', 1001, 1061))
+        self.assertFalse(models.HostBreaker.trial('test.com', 1001, 1061))
+
+        self.assertEqual(hosts.breaker('test.com')['state'], hosts.HALF_OPEN)
+
+    @mock.patch('wps.hosts.time')
+    def test_breaker_half_open_failure(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        hosts.set_breaker('test.com', hosts.HALF_OPEN, 5)
+
+        self.assertTrue(hosts.record_failure('test.com'))
+        self.assertEqual(hosts.breaker('test.com')['state'], hosts.OPEN)
+
+    @mock.patch('wps.hosts.time')
+    def test_retry(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        func = mock.MagicMock(side_effect=[hosts.HostError('Timeout'), 'data'])
+
+        with self.settings(WORKER_RETRY_ATTEMPTS=3, WORKER_BREAKER_THRESHOLD=5):
+            self.assertEqual(hosts.retry('test.com', func, 'a'), 'data')
+
+        func.assert_called_with('a')
+
+        mock_time.sleep.assert_called_once()
+
+        self.assertEqual(hosts.breaker('test.com')['failures'], 0)
+
+    @mock.patch('wps.hosts.time')
+    def test_retry_exhausted(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        func = mock.MagicMock(side_effect=hosts.HostError('Timeout'))
+
+        with self.settings(WORKER_RETRY_ATTEMPTS=3, WORKER_BREAKER_THRESHOLD=5):
+            with self.assertRaises(hosts.HostError):
+                hosts.retry('test.com', func)
+
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(hosts.breaker('test.com')['failures'], 3)
+
+    @mock.patch('wps.hosts.time')
+    def test_retry_breaker_open(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        func = mock.MagicMock()
+
+        hosts.set_breaker('test.com', hosts.OPEN, 5)
+
+        with self.settings(WORKER_BREAKER_RESET=60):
+            with self.assertRaises(hosts.HostUnavailableError):
+                hosts.retry('test.com', func)
+
+        func.assert_not_called()
+
+    def test_download_slot_local(self):
+        with self.settings(WORKER_HOST_SEMAPHORE='local', WORKER_HOST_LIMIT=1,
+                           WORKER_HOST_LIMITS={}, WORKER_HOST_WAIT=0):
+            with hosts.download_slot('test.com'):
+                with self.assertRaises(WPSError):
+                    with hosts.download_slot('test.com'):
+                        pass
+
+                with hosts.download_slot('test2.com'):
+                    pass
+
+            with hosts.download_slot('test.com'):
+                pass
+
+    def test_download_slot_database(self):
+        with self.settings(WORKER_HOST_SEMAPHORE='database',
+                           WORKER_HOST_LIMIT=1,
+                           WORKER_HOST_LIMITS={'test.com': 2},
+                           WORKER_HOST_WAIT=0, WORKER_HOST_LEASE=60):
+            with hosts.download_slot('test.com'):
+                with hosts.download_slot('test.com'):
+                    with self.assertRaises(WPSError):
+                        with hosts.download_slot('test.com'):
+                            pass
+
+            self.assertEqual(models.HostSlot.objects.exclude(token='').count(), 0)
+
+    @mock.patch('wps.hosts.db')
+    @mock.patch('wps.hosts.SLOT_POLL', 0.01)
+    def test_renew_slot(self, mock_db):
+        semaphore = mock.MagicMock()
+        semaphore.renew.return_value = True
+
+        stop = threading.Event()
+
+        with self.settings(WORKER_HOST_LEASE=0):
+            renewer = threading.Thread(target=hosts.renew_slot,
+                                       args=(semaphore, 'test.com', 'token',
+                                             stop))
+
+            renewer.start()
+
+            stop.wait(0.1)
+
+            stop.set()
+
+            renewer.join()
+
+        semaphore.renew.assert_called_with('test.com', 'token', 0)
+
+        mock_db.connection.close.assert_called()
+
+    def test_host_slot_renew(self):
+        self.assertTrue(models.HostSlot.acquire('test.com', 1, 'token', 0))
+
+        self.assertTrue(models.HostSlot.renew('test.com', 'token', 60))
+
+        self.assertFalse(models.HostSlot.acquire('test.com', 1, 'other', 60))
+
+        self.assertFalse(models.HostSlot.renew('test.com', 'other', 60))
+
+    def test_download_slot_unlimited(self):
+        with self.settings(WORKER_HOST_LIMIT=0, WORKER_HOST_LIMITS={}):
+            with hosts.download_slot('test.com'):
+                pass
+
+        self.assertEqual(models.HostSlot.objects.count(), 0)
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+import cdms2
+import numpy as np
+from django import test
+
+from wps import hyperslab
+from wps.context import ChunkPlan
+from wps.tests import helpers
+
+class HyperslabTestCase(test.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.path = os.path.join(self.temp_dir, 'output.nc')
+
+        time = helpers.generate_time('days since 1990-1-1', 4)
+
+        lat = cdms2.createUniformLatitudeAxis(-90.0, 4, 45.0)
+
+        lon = cdms2.createUniformLongitudeAxis(0.0, 6, 60.0)
+
+        self.variable = helpers.generate_variable([time, lat, lon], 'tas')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def chunk_axes(self, plan, variable=None):
+        if variable is None:
+            variable = self.variable
+
+        return [(x, variable(**y).getAxisList()) for x, y in
+                enumerate(plan)]
+
+    def test_concat_axes(self):
+        time = self.variable.getTime()
+
+        axis = hyperslab.concat_axes([time.subAxis(0, 2), time.subAxis(2, 4)])
+
+        self.assertEqual(axis.id, 'time')
+        self.assertEqual(axis.units, 'days since 1990-1-1')
+        self.assertTrue(np.array_equal(axis[:], time[:]))
+
+    def test_write_split_axes(self):
+        plan = ChunkPlan(['time', 'latitude'], [
+            {'time': slice(x, x+2), 'latitude': slice(y, y+2)}
+            for x in (0, 2) for y in (0, 2)
+        ])
+
+        with cdms2.open(self.path, 'w') as outfile:
+            writer = hyperslab.HyperslabWriter(outfile, 'tas')
+
+            input_index = writer.add_input(plan, self.chunk_axes(plan),
+                                           plan.axes)
+
+            # Chunks are written in any order
+            for chunk_index in reversed(range(len(plan))):
+                writer.write(input_index, chunk_index,
+                             self.variable(**plan[chunk_index]))
+
+        with cdms2.open(self.path) as infile:
+            data = infile('tas')
+
+        self.assertEqual(data.shape, self.variable.shape)
+        self.assertTrue(np.allclose(data, self.variable))
+        self.assertTrue(np.array_equal(data.getLatitude()[:],
+                                       self.variable.getLatitude()[:]))
+
+    def test_write_inputs(self):
+        plan = ChunkPlan(['time'], [{'time': slice(0, 2)},
+                                    {'time': slice(2, 4)}])
+
+        time = cdms2.createAxis(np.arange(4, 8), id='time')
+
+        time.designateTime()
+
+        time.units = 'days since 1990-1-1'
+
+        other = self.variable.clone()
+
+        other.setAxis(0, time)
+
+        with cdms2.open(self.path, 'w') as outfile:
+            writer = hyperslab.HyperslabWriter(outfile, 'tas')
+
+            first = writer.add_input(plan, self.chunk_axes(plan), plan.axes)
+
+            second = writer.add_input(plan, self.chunk_axes(plan, other),
+                                      plan.axes)
+
+            for input_index, variable in ((first, self.variable),
+                                          (second, other)):
+                for chunk_index, selector in enumerate(plan):
+                    writer.write(input_index, chunk_index,
+                                 variable(**selector))
+
+        with cdms2.open(self.path) as infile:
+            data = infile('tas')
+
+        self.assertEqual(data.shape, (8, 4, 6))
+        self.assertTrue(np.allclose(data[4:], self.variable))
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from django import test
+
+from wps import intermediate
+from wps.tests import helpers
+
+class IntermediateTestCase(test.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.path = os.path.join(self.temp_dir, 'chunk.npy')
+
+        time = helpers.generate_time('days since 1990-1-1', 4)
+
+        time.calendar = 'noleap'
+
+        self.variable = helpers.generate_variable([time, helpers.latitude,
+                                                   helpers.longitude], 'tas')
+
+        self.variable.units = 'K'
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_paths(self):
+        self.assertEqual(intermediate.paths('/data/chunk.npy'),
+                         ('/data/chunk.npy', '/data/chunk.mask',
+                          '/data/chunk.json'))
+
+    def test_write_read(self):
+        intermediate.write(self.path, self.variable)
+
+        self.assertFalse(os.path.exists(intermediate.paths(self.path)[1]))
+
+        data = intermediate.read(self.path)
+
+        self.assertEqual(data.id, 'tas')
+        self.assertEqual(data.units, 'K')
+        self.assertEqual(data.shape, self.variable.shape)
+        self.assertTrue(np.array_equal(data, self.variable))
+
+        time = data.getTime()
+
+        self.assertEqual(time.units, 'days since 1990-1-1')
+        self.assertEqual(time.calendar, 'noleap')
+        self.assertTrue(np.array_equal(data.getLatitude()[:],
+                                       helpers.latitude[:]))
+
+    def test_write_read_masked(self):
+        self.variable[0, 0, :3] = np.ma.masked
+
+        intermediate.write(self.path, self.variable)
+
+        data = intermediate.read(self.path)
+
+        mask = np.ma.getmaskarray(data)
+
+        self.assertEqual(mask.sum(), 3)
+        self.assertTrue(mask[0, 0, :3].all())
+
+    def test_remove(self):
+        intermediate.write(self.path, self.variable)
+
+        intermediate.remove(self.path)
+
+        self.assertEqual(os.listdir(self.temp_dir), [])
@@ -1,6 +1,277 @@
 #! /usr/bin/env python
 
+import mock
+import numpy as np
 from django import test
 
+from wps import models
+from wps import WPSError
+from wps.tests import helpers
+
 class CacheModelTestCase(test.TestCase):
     pass
+
+class AxisMetadataModelTestCase(test.TestCase):
+
+    def setUp(self):
+        time = helpers.generate_time('days since 1990-1-1', 10)
+
+        self.variable = helpers.generate_variable([time, helpers.latitude,
+                                                   helpers.longitude], 'tas')
+
+    def test_storage_chunk_sizes(self):
+        var = mock.MagicMock()
+        var.attributes = {'_ChunkSizes': [1, 90, 180]}
+
+        sizes = models.storage_chunk_sizes(var, ['time', 'lat', 'lon'])
+
+        self.assertEqual(sizes, {'time': 1, 'lat': 90, 'lon': 180})
+
+    def test_storage_chunk_sizes_mismatch(self):
+        var = mock.MagicMock()
+        var.attributes = {'_ChunkSizes': 1}
+
+        sizes = models.storage_chunk_sizes(var, ['time', 'lat', 'lon'])
+
+        self.assertIsNone(sizes)
+
+    def test_storage_chunk_sizes_missing(self):
+        var = mock.MagicMock()
+        var.attributes = {}
+
+        sizes = models.storage_chunk_sizes(var, ['time', 'lat', 'lon'])
+
+        self.assertIsNone(sizes)
+
+    def test_lookup_missing(self):
+        entry = models.AxisMetadata.lookup('http://test.com/data.nc', 'tas')
+
+        self.assertIsNone(entry)
+
+    def test_lookup_stale(self):
+        models.AxisMetadata.from_variable('http://test.com/data.nc',
+                                          self.variable, 'Mon, 01 Jan 2018')
+
+        entry = models.AxisMetadata.lookup('http://test.com/data.nc', 'tas',
+                                           'Tue, 02 Jan 2018')
+
+        self.assertIsNone(entry)
+
+        self.assertEqual(models.AxisMetadata.objects.count(), 0)
+
+    def test_lookup(self):
+        models.AxisMetadata.from_variable('http://test.com/data.nc',
+                                          self.variable, 'Mon, 01 Jan 2018')
+
+        entry = models.AxisMetadata.lookup('http://test.com/data.nc', 'tas',
+                                           'Mon, 01 Jan 2018')
+
+        self.assertIsNotNone(entry)
+
+        entry = models.AxisMetadata.lookup('http://test.com/data.nc', 'tas')
+
+        self.assertIsNotNone(entry)
+
+    def test_axis_list(self):
+        entry = models.AxisMetadata.from_variable('http://test.com/data.nc',
+                                                  self.variable)
+
+        entry = models.AxisMetadata.objects.get(pk=entry.pk)
+
+        axes = entry.axis_list()
+
+        self.assertEqual([x.id for x in axes], ['time', 'lat', 'lon'])
+        self.assertTrue(axes[0].isTime())
+        self.assertEqual(axes[0].units, 'days since 1990-1-1')
+        self.assertEqual(len(axes[1]), 180)
+        self.assertEqual(axes[2][0], -180.0)
+        self.assertEqual(entry.itemsize, 8)
+        self.assertTrue(np.array_equal(axes[1].getBounds(),
+                                       self.variable.getLatitude().getBounds()))
+
+    def test_get_time(self):
+        entry = models.AxisMetadata.from_variable('http://test.com/data.nc',
+                                                  self.variable)
+
+        time = entry.get_time()
+
+        self.assertEqual(time[0], 0)
+        self.assertEqual(time.units, 'days since 1990-1-1')
+
+class HostSlotModelTestCase(test.TestCase):
+
+    def test_acquire(self):
+        self.assertTrue(models.HostSlot.acquire('test.com', 2, 'a', 60))
+        self.assertTrue(models.HostSlot.acquire('test.com', 2, 'b', 60))
+        self.assertFalse(models.HostSlot.acquire('test.com', 2, 'c', 60))
+
+        self.assertEqual(models.HostSlot.objects.filter(host='test.com').count(), 2)
+
+        models.HostSlot.release('test.com', 'a')
+
+        self.assertTrue(models.HostSlot.acquire('test.com', 2, 'c', 60))
+
+    def test_acquire_expired(self):
+        self.assertTrue(models.HostSlot.acquire('test.com', 1, 'a', -1))
+
+        self.assertTrue(models.HostSlot.acquire('test.com', 1, 'b', 60))
+
+        self.assertEqual(models.HostSlot.objects.get(host='test.com').token, 'b')
+
+    def test_acquire_limit_raised(self):
+        self.assertTrue(models.HostSlot.acquire('test.com', 1, 'a', 60))
+        self.assertTrue(models.HostSlot.acquire('test.com', 2, 'b', 60))
+
+class JobChunkModelTestCase(test.TestCase):
+    fixtures = ['users.json', 'processes.json', 'servers.json', 'jobs.json']
+
+    def setUp(self):
+        self.job = models.Job.objects.all()[0]
+
+        models.JobChunk.enqueue(self.job, [
+            (0, 0, 10, models.JobChunk.INGRESS),
+            (0, 1, 30, models.JobChunk.INGRESS),
+            (0, 2, 20, models.JobChunk.INGRESS),
+        ])
+
+    def test_claim_largest_first(self):
+        chunk = models.JobChunk.claim(self.job, models.JobChunk.INGRESS, 0,
+                                      'task1')
+
+        self.assertEqual(chunk.chunk_index, 1)
+        self.assertEqual(chunk.state, models.JobChunk.CLAIMED)
+        self.assertEqual(chunk.task_id, 'task1')
+
+    def test_claim_empty(self):
+        chunk = models.JobChunk.claim(self.job, models.JobChunk.PROCESS, 0,
+                                      'task1')
+
+        self.assertIsNone(chunk)
+
+    def test_claims(self):
+        chunks = models.JobChunk.claims(self.job, models.JobChunk.INGRESS, 0,
+                                        'task1')
+
+        self.assertEqual([x.chunk_index for x in chunks], [1, 2, 0])
+
+    def test_claims_process_stops(self):
+        models.JobChunk.objects.filter(chunk_index=0).update(
+            state=models.JobChunk.CLAIMED)
+
+        with self.settings(WORKER_QUEUE_TIMEOUT=0):
+            chunks = models.JobChunk.claims(self.job, models.JobChunk.PROCESS,
+                                            0, 'task1')
+
+            self.assertEqual(list(chunks), [])
+
+    def test_claims_process_interleaved(self):
+        for x in range(3):
+            models.JobChunk.complete(self.job, 0, x, '/data/{}.nc'.format(x),
+                                     models.JobChunk.PROCESS)
+
+        first = models.JobChunk.claims(self.job, models.JobChunk.PROCESS, 0,
+                                       'task1')
+
+        second = models.JobChunk.claims(self.job, models.JobChunk.PROCESS, 0,
+                                        'task2')
+
+        claimed = [next(first), next(second), next(first)]
+
+        # Neither consumer completes its claims until it stops claiming
+        with self.settings(WORKER_QUEUE_TIMEOUT=0):
+            self.assertEqual(list(second), [])
+            self.assertEqual(list(first), [])
+
+        self.assertEqual(sorted(x.chunk_index for x in claimed), [0, 1, 2])
+        self.assertEqual([x.task_id for x in claimed],
+                         ['task1', 'task2', 'task1'])
+
+    def test_claims_requeues_redelivered(self):
+        models.JobChunk.claim(self.job, models.JobChunk.INGRESS, 0, 'task1')
+
+        chunks = models.JobChunk.claims(self.job, models.JobChunk.INGRESS, 0,
+                                        'task1')
+
+        self.assertEqual([x.chunk_index for x in chunks], [1, 2, 0])
+
+    def test_claims_requeues_expired(self):
+        models.JobChunk.claim(self.job, models.JobChunk.INGRESS, 0, 'task1')
+
+        with self.settings(WORKER_CLAIM_TIMEOUT=-1):
+            chunks = models.JobChunk.claims(self.job, models.JobChunk.INGRESS,
+                                            0, 'task2')
+
+            self.assertEqual([x.chunk_index for x in chunks], [2, 0, 1])
+
+    def test_claims_skips_claimed(self):
+        models.JobChunk.claim(self.job, models.JobChunk.INGRESS, 0, 'task1')
+
+        chunks = models.JobChunk.claims(self.job, models.JobChunk.INGRESS, 0,
+                                        'task2')
+
+        self.assertEqual([x.chunk_index for x in chunks], [2, 0])
+
+    def test_wait_done(self):
+        for x in range(3):
+            models.JobChunk.complete(self.job, 0, x, '/data/{}.nc'.format(x))
+
+        self.assertFalse(models.JobChunk.wait(self.job,
+                                              models.JobChunk.INGRESS,
+                                              'task1'))
+
+    def test_wait_queued(self):
+        self.assertTrue(models.JobChunk.wait(self.job, models.JobChunk.INGRESS,
+                                             'task1'))
+
+    def test_wait_requeues_expired(self):
+        list(models.JobChunk.claims(self.job, models.JobChunk.INGRESS, 0,
+                                    'task1'))
+
+        with self.settings(WORKER_CLAIM_TIMEOUT=-1):
+            self.assertTrue(models.JobChunk.wait(self.job,
+                                                 models.JobChunk.INGRESS,
+                                                 'task2'))
+
+        self.assertEqual(models.JobChunk.objects.filter(
+            state=models.JobChunk.QUEUED).count(), 3)
+
+    def test_wait_times_out(self):
+        list(models.JobChunk.claims(self.job, models.JobChunk.INGRESS, 0,
+                                    'task1'))
+
+        with self.settings(WORKER_QUEUE_TIMEOUT=0):
+            with self.assertRaises(WPSError):
+                models.JobChunk.wait(self.job, models.JobChunk.INGRESS,
+                                     'task2')
+
+    def test_wait_ignores_own_claims(self):
+        list(models.JobChunk.claims(self.job, models.JobChunk.INGRESS, 0,
+                                    'task1'))
+
+        self.assertFalse(models.JobChunk.wait(self.job,
+                                              models.JobChunk.INGRESS,
+                                              'task1'))
+
+    def test_pending(self):
+        models.JobChunk.complete(self.job, 0, 1, '/data/1.nc')
+
+        self.assertEqual(models.JobChunk.pending(self.job), {0: 2})
+
+    def test_manifest(self):
+        for x in (2, 0, 1):
+            models.JobChunk.complete(self.job, 0, x, '/data/{}.nc'.format(x),
+                                     models.JobChunk.PROCESS)
+
+            chunk = models.JobChunk.claim(self.job, models.JobChunk.PROCESS,
+                                          0, 'task2')
+
+            models.JobChunk.complete(self.job, 0, chunk.chunk_index,
+                                     '/data/{}_process.nc'.format(x))
+
+        manifest = models.JobChunk.manifest(self.job)
+
+        self.assertEqual(manifest, {
+            0: (models.JobChunk.PROCESS, ['/data/0_process.nc',
+                                          '/data/1_process.nc',
+                                          '/data/2_process.nc']),
+        })
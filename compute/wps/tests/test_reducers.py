@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+
+import cdms2
+import cdutil
+import numpy as np
+from django import test
+
+from wps import reducers
+from wps import WPSError
+from wps.tests import helpers
+
+class ReducersTestCase(test.TestCase):
+
+    def setUp(self):
+        time = helpers.generate_time('days since 1990-1-1', 6)
+
+        lat = cdms2.createUniformLatitudeAxis(-80.0, 5, 40.0)
+
+        lon = cdms2.createUniformLongitudeAxis(0.0, 4, 90.0)
+
+        self.variable = helpers.generate_variable([time, lat, lon], 'tas')
+
+        self.variable[:3, 0, 0] = np.ma.masked
+
+        self.variable[:, 1, 1] = np.ma.masked
+
+    def merged(self, reducer, axes):
+        states = (reducer.partial(self.variable[x:x+2], axes) for x in
+                  range(0, 6, 2))
+
+        return reducer.finalize(reducer.tree_merge(states))
+
+    def test_partial_path(self):
+        path = reducers.partial_path('/data/1_00000000_00000004_time.npy')
+
+        self.assertEqual(path, '/data/1_00000000_00000004_time_partial.npy')
+        self.assertEqual(reducers.partial_chunk(path), 4)
+        self.assertIsNone(reducers.partial_chunk(
+            '/data/1_00000000_00000004_time.npy'))
+
+    def test_unknown_axis(self):
+        with self.assertRaises(WPSError):
+            reducers.Sum().partial(self.variable, ['lev'])
+
+    def test_tree_merge_empty(self):
+        with self.assertRaises(WPSError):
+            reducers.Sum().tree_merge([])
+
+    def test_sum(self):
+        result = self.merged(reducers.Sum(), ['time'])
+
+        expected = np.ma.sum(self.variable, axis=0)
+
+        self.assertEqual(result.shape, (5, 4))
+        self.assertTrue(np.ma.allclose(result, expected))
+        self.assertTrue(np.array_equal(np.ma.getmaskarray(result),
+                                       np.ma.getmaskarray(expected)))
+
+    def test_max(self):
+        result = self.merged(reducers.Max(), ['time', 'lat'])
+
+        self.assertTrue(np.ma.allclose(result, np.ma.max(np.ma.max(
+            self.variable, axis=0), axis=0)))
+
+    def test_min(self):
+        result = self.merged(reducers.Min(), ['time'])
+
+        self.assertTrue(np.ma.allclose(result, np.ma.min(self.variable,
+                                                         axis=0)))
+        self.assertTrue(np.ma.getmaskarray(result)[1, 1])
+        self.assertFalse(np.ma.getmaskarray(result)[0, 0])
+
+    def test_average(self):
+        result = self.merged(reducers.Average(), ['time'])
+
+        expected = cdutil.averager(self.variable, axis='0')
+
+        self.assertTrue(np.ma.allclose(result, expected))
+        self.assertEqual(result.dtype, self.variable.dtype)
+
+    def test_merge_shape_mismatch(self):
+        reducer = reducers.Sum()
+
+        with self.assertRaises(WPSError):
+            reducer.merge(reducer.partial(self.variable, ['time']),
+                          reducer.partial(self.variable, ['lat']))
+
+    def test_reduce_axes(self):
+        result = reducers.reduce_axes(self.variable, ['time', 'lon'],
+                                      reducers.SUM)
+
+        expected = np.ma.sum(np.ma.sum(self.variable, axis=2), axis=0)
+
+        self.assertEqual(result.getAxisIds(), ['lat'])
+        self.assertTrue(np.ma.allclose(result, expected))
+
+    def test_reduce_axes_unmasked(self):
+        data = cdms2.createVariable(np.arange(24.0).reshape((6, 4)),
+                                    id='tas')
+
+        data[2, 1] = np.nan
+
+        result = reducers.reduce_axes(data, [data.getAxisIds()[0]],
+                                      reducers.MAX)
+
+        self.assertFalse(np.ma.getmaskarray(result).any())
+        self.assertEqual(list(result), [20, 21, 22, 23])
+
+        result = reducers.reduce_axes(data, [data.getAxisIds()[0]],
+                                      reducers.SUM)
+
+        self.assertEqual(result[1], 1 + 5 + 13 + 17 + 21)
+
+    def test_reduce_axes_masked_int(self):
+        data = cdms2.createVariable(np.arange(6).reshape((2, 3)), id='count')
+
+        data[:, 0] = np.ma.masked
+
+        data[0, 1] = np.ma.masked
+
+        result = reducers.reduce_axes(data, [data.getAxisIds()[0]],
+                                      reducers.MIN)
+
+        self.assertTrue(np.ma.getmaskarray(result)[0])
+        self.assertEqual(result[1], 4)
+        self.assertEqual(result[2], 2)
+
+    def test_average_axes_area(self):
+        reducers.AREA_WEIGHTS.clear()
+
+        result = reducers.average_axes(self.variable, ['lat', 'lon'])
+
+        expected = cdutil.averager(self.variable, axis='yx')
+
+        self.assertTrue(np.ma.allclose(result, expected))
+
+        reducers.average_axes(self.variable[:2], ['lat', 'lon'], 'weighted')
+
+        self.assertEqual(len(reducers.AREA_WEIGHTS), 1)
+
+        reducers.AREA_WEIGHTS.clear()
+
+    def test_average_axes_equal(self):
+        result = reducers.average_axes(self.variable, ['time'], 'equal')
+
+        self.assertTrue(np.ma.allclose(result, np.ma.mean(self.variable,
+                                                          axis=0)))
+
+    def test_average_axes_unknown_option(self):
+        with self.assertRaises(WPSError):
+            reducers.average_axes(self.variable, ['time'], 'area')
+
+    def test_variance(self):
+        result = self.merged(reducers.Variance(), ['time'])
+
+        expected = np.ma.var(self.variable, axis=0)
+
+        self.assertTrue(np.ma.allclose(result, expected))
+        self.assertTrue(np.array_equal(np.ma.getmaskarray(result),
+                                       np.ma.getmaskarray(expected)))
+
+    def test_std(self):
+        result = self.merged(reducers.StandardDeviation(), ['time', 'lon'])
+
+        data = np.ma.getdata(self.variable).transpose((1, 0, 2)).reshape((5, -1))
+
+        mask = np.ma.getmaskarray(self.variable).transpose((1, 0, 2)).reshape(
+            (5, -1))
+
+        expected = np.ma.std(np.ma.array(data, mask=mask), axis=1)
+
+        self.assertEqual(result.getAxisIds(), ['lat'])
+        self.assertTrue(np.ma.allclose(result, expected))
+
+    def test_variance_stable(self):
+        data = cdms2.createVariable(
+            (1e6 + np.random.random((64, 3))).astype(np.float32), id='tas')
+
+        reducer = reducers.Variance()
+
+        axis = data.getAxisIds()[0]
+
+        states = (reducer.partial(data[x:x+8], [axis]) for x in range(0, 64, 8))
+
+        result = reducer.finalize(reducer.tree_merge(states))
+
+        expected = np.var(np.ma.getdata(data).astype(np.float64), axis=0)
+
+        self.assertEqual(result.dtype, np.float32)
+        self.assertTrue(np.allclose(result, expected, rtol=1e-3))
+
+    def test_higher_moments(self):
+        data = np.ma.getdata(self.variable)[:, 2, 2].astype(np.float64)
+
+        deviation = data - data.mean()
+
+        variance = (deviation**2).mean()
+
+        result = self.merged(reducers.Skewness(), ['time'])
+
+        self.assertAlmostEqual(result[2, 2],
+                               (deviation**3).mean() / variance**1.5, places=4)
+
+        result = self.merged(reducers.Kurtosis(), ['time'])
+
+        self.assertAlmostEqual(result[2, 2],
+                               (deviation**4).mean() / variance**2 - 3.0,
+                               places=4)
+        self.assertTrue(np.ma.getmaskarray(result)[1, 1])
+
+    def test_skewness_constant(self):
+        data = cdms2.createVariable(np.ones((4, 2)), id='tas')
+
+        result = reducers.Skewness().apply(data, [data.getAxisIds()[0]])
+
+        self.assertTrue(np.ma.getmaskarray(result).all())
+
+    def test_moments_unmasked(self):
+        data = np.random.random((10, 4, 5))
+
+        for indices in ((0,), (1, 2)):
+            components = reducers.Kurtosis().reduce(data, indices)
+
+            self.assertEqual(components[1].shape, np.var(data, axis=indices).shape)
+            self.assertTrue(np.allclose(components[2] / components[1],
+                                        np.var(data, axis=indices)))
+
+    def test_variance_nomask(self):
+        data = cdms2.createVariable(np.ma.getdata(self.variable),
+                                    mask=np.ma.nomask,
+                                    axes=self.variable.getAxisList(), id='tas')
+
+        result = reducers.Variance().apply(data, ['time'])
+
+        self.assertEqual(result.shape, (5, 4))
+        self.assertTrue(np.ma.allclose(result, np.var(np.ma.getdata(data),
+                                                      axis=0)))
+
+        result = reducers.StandardDeviation().apply(data, ['lat', 'lon'])
+
+        self.assertEqual(result.shape, (6,))
+        self.assertTrue(np.ma.allclose(result, np.std(
+            np.ma.getdata(data).reshape((6, -1)), axis=1)))
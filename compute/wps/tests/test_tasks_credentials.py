@@ -2,6 +2,7 @@
 
 import datetime
 import mock
+import os
 
 from django import test
 
@@ -16,27 +17,82 @@ class CredentailsTestCase(test.TestCase):
     def setUp(self):
         self.user = models.User.objects.first()
 
+    def tearDown(self):
+        tasks.credentials.STAGED.clear()
+
+    @mock.patch('wps.tasks.credentials.certificate_not_after')
     @mock.patch('wps.tasks.credentials.open')
     @mock.patch('wps.tasks.credentials.os')
     @mock.patch('wps.tasks.credentials.refresh_certificate')
     @mock.patch('wps.tasks.credentials.check_certificate')
-    def test_load_certificate(self, mock_check, mock_refresh, mock_os, mock_open):
+    def test_load_certificate(self, mock_check, mock_refresh, mock_os, mock_open, mock_not_after):
         mock_os.path.exists.return_value = False
 
         mock_check.return_value = False
 
+        mock_not_after.return_value = datetime.datetime.now() + datetime.timedelta(days=1)
+
         tasks.load_certificate(self.user)        
 
         mock_refresh.assert_called_once()
 
         mock_os.makedirs.assert_called_once()
 
-        mock_os.chdir.assert_called_once()
+        mock_os.chdir.assert_not_called()
 
         mock_open.return_value.__enter__.return_value.write.assert_called()
         open_count = mock_open.return_value.__enter__.return_value.write.call_count
 
-        self.assertEqual(open_count, 6)
+        self.assertEqual(open_count, 2)
+
+    @mock.patch('wps.tasks.credentials.certificate_not_after')
+    @mock.patch('wps.tasks.credentials.open')
+    @mock.patch('wps.tasks.credentials.os')
+    @mock.patch('wps.tasks.credentials.refresh_certificate')
+    @mock.patch('wps.tasks.credentials.check_certificate')
+    def test_load_certificate_staged(self, mock_check, mock_refresh, mock_os, mock_open, mock_not_after):
+        mock_os.path.exists.return_value = False
+
+        mock_check.return_value = True
+
+        mock_not_after.return_value = datetime.datetime.now() + datetime.timedelta(days=1)
+
+        tasks.load_certificate(self.user)
+
+        tasks.load_certificate(self.user)
+
+        mock_check.assert_called_once()
+
+        self.assertEqual(mock_open.call_count, 2)
+
+        self.user.auth.cert = 'new cert'
+
+        tasks.load_certificate(self.user)
+
+        self.assertEqual(mock_check.call_count, 2)
+
+    @mock.patch('wps.tasks.credentials.open')
+    @mock.patch('wps.tasks.credentials.os.path.exists')
+    def test_write_if_changed(self, mock_exists, mock_open):
+        mock_exists.return_value = True
+
+        mock_open.return_value.__enter__.return_value.read.return_value = 'data'
+
+        self.assertFalse(tasks.credentials.write_if_changed('/cert.pem', 'data'))
+
+        self.assertTrue(tasks.credentials.write_if_changed('/cert.pem', 'new'))
+
+        mock_open.return_value.__enter__.return_value.write.assert_called_with('new')
+
+    def test_dap_config(self):
+        with mock.patch.dict('os.environ', {'DAPRCFILE': '/default'}):
+            with tasks.credentials.dap_config('/user/.dodsrc'):
+                self.assertEqual(os.environ['DAPRCFILE'], '/user/.dodsrc')
+
+            with tasks.credentials.dap_config(None):
+                self.assertNotIn('DAPRCFILE', os.environ)
+
+            self.assertEqual(os.environ['DAPRCFILE'], '/default')
 
     @mock.patch('openid.consumer.discover.discoverYadis')
     def test_refresh_certificate_myproxyclient(self, mock_discover):
@@ -159,3 +215,73 @@ class CredentailsTestCase(test.TestCase):
         mock_load.return_value.get_notAfter.return_value = after.strftime(tasks.CERT_DATE_FMT)
 
         self.assertTrue(tasks.check_certificate(self.user))
+
+    @mock.patch('wps.tasks.credentials.discover.discoverYadis')
+    def test_discover_services(self, mock_discover):
+        mock_discover.return_value = ('url', [])
+
+        tasks.credentials.DISCOVERY.clear()
+
+        tasks.credentials.discover_services('http://test.com/openid')
+
+        result = tasks.credentials.discover_services('http://test.com/openid')
+
+        self.assertEqual(result, ('url', []))
+
+        mock_discover.assert_called_once_with('http://test.com/openid')
+
+    @mock.patch('wps.tasks.credentials.refresh_certificate')
+    @mock.patch('wps.tasks.credentials.certificate_not_after')
+    def test_refresh_certificates(self, mock_not_after, mock_refresh):
+        server = models.Server.objects.create(host='default')
+
+        job = models.Job.objects.create(server=server, user=self.user)
+
+        job.status_set.create(status=models.ProcessStarted)
+
+        mock_not_after.return_value = datetime.datetime.now() + datetime.timedelta(hours=1)
+
+        with self.settings(CERT_REFRESH_WINDOW=datetime.timedelta(hours=12)):
+            tasks.refresh_certificates()
+
+        mock_refresh.assert_called_once_with(self.user)
+
+    @mock.patch('wps.tasks.credentials.refresh_certificate')
+    @mock.patch('wps.tasks.credentials.certificate_not_after')
+    def test_refresh_certificates_continues(self, mock_not_after, mock_refresh):
+        server = models.Server.objects.create(host='default')
+
+        other = models.User.objects.create_user('other', 'other@test.com',
+                                                'other')
+
+        models.Auth.objects.create(openid_url='', user=other, type='oauth2')
+
+        for user in (self.user, other):
+            job = models.Job.objects.create(server=server, user=user)
+
+            job.status_set.create(status=models.ProcessStarted)
+
+        mock_not_after.return_value = datetime.datetime.now()
+
+        mock_refresh.side_effect = [Exception('discovery failed'), None]
+
+        with self.settings(CERT_REFRESH_WINDOW=datetime.timedelta(hours=12)):
+            tasks.refresh_certificates()
+
+        self.assertEqual(mock_refresh.call_count, 2)
+
+    @mock.patch('wps.tasks.credentials.refresh_certificate')
+    @mock.patch('wps.tasks.credentials.certificate_not_after')
+    def test_refresh_certificates_not_expiring(self, mock_not_after, mock_refresh):
+        server = models.Server.objects.create(host='default')
+
+        job = models.Job.objects.create(server=server, user=self.user)
+
+        job.status_set.create(status=models.ProcessStarted)
+
+        mock_not_after.return_value = datetime.datetime.now() + datetime.timedelta(days=5)
+
+        with self.settings(CERT_REFRESH_WINDOW=datetime.timedelta(hours=12)):
+            tasks.refresh_certificates()
+
+        mock_refresh.assert_not_called()
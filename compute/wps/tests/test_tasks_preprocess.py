@@ -1,19 +1,233 @@
 #! /usr/bin/env python
 
+import threading
+import time
+
 import cwt
 import mock
+import numpy as np
 from django import test
 from django.conf import settings
 
 from wps import WPSError
+from wps.context import ChunkPlan
 from wps.tasks import preprocess
 
 class PreprocessTestCase(test.TestCase):
 
+    def setUp(self):
+        preprocess.TIME_CACHE.clear()
+        preprocess.TIME_VALUES.clear()
+
+        self.axes = []
+
+        for name in ('time', 'lat', 'lon'):
+            axis = mock.MagicMock()
+            type(axis).id = mock.PropertyMock(return_value=name)
+            axis.isLatitude.return_value = name == 'lat'
+            axis.isLongitude.return_value = name == 'lon'
+
+            self.axes.append(axis)
+
+    def test_plan_chunks_no_candidates(self):
+        mapped = {
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        plan = preprocess.plan_chunks(['lat', 'lon'], mapped, [], 5, 1e6)
+
+        self.assertEqual(plan.axes, [])
+        self.assertEqual(plan.chunks, [{}])
+        self.assertEqual(plan.nbytes, 324000)
+        self.assertEqual(plan.sizes, [324000])
+
+    def test_plan_chunks_does_not_fit(self):
+        mapped = {
+            'time': slice(0, 365, 1),
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        with self.assertRaises(WPSError):
+            preprocess.plan_chunks(['time', 'lat', 'lon'], mapped, ['time'],
+                                   9, 300000)
+
+    def test_plan_chunks_step(self):
+        mapped = {
+            'time': slice(0, 365, 2),
+            'lat': slice(0, 180, 1),
+        }
+
+        plan = preprocess.plan_chunks(['time', 'lat'], mapped, ['time'], 5,
+                                      90000)
+
+        self.assertEqual(plan.axes, ['time'])
+        self.assertEqual(plan.chunks, [{'time': slice(x, min(x+200, 365), 2)}
+                                       for x in range(0, 365, 200)])
+        self.assertEqual(plan.sizes, [90000, 74700])
+
+    def test_align_count(self):
+        self.assertEqual(preprocess.align_count(200, 90), 180)
+        self.assertEqual(preprocess.align_count(90, 90), 90)
+        self.assertEqual(preprocess.align_count(33, 90), 30)
+        self.assertEqual(preprocess.align_count(7, 90), 6)
+
+    def test_plan_chunks_storage_aligned(self):
+        mapped = {
+            'time': slice(5, 100, 1),
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        plan = preprocess.plan_chunks(['time', 'lat', 'lon'], mapped,
+                                      ['time'], 5, 324000*33, {'time': 10})
+
+        self.assertEqual(plan.chunks, [
+            {'time': slice(5, 30, 1)},
+            {'time': slice(30, 60, 1)},
+            {'time': slice(60, 90, 1)},
+            {'time': slice(90, 100, 1)},
+        ])
+
+    def test_plan_chunks_storage_step(self):
+        mapped = {
+            'time': slice(5, 100, 2),
+            'lat': slice(0, 180, 1),
+        }
+
+        plan = preprocess.plan_chunks(['time', 'lat'], mapped, ['time'], 5,
+                                      900*33, {'time': 10})
+
+        self.assertEqual(plan.chunks, [{'time': slice(x, min(x+66, 100), 2)}
+                                       for x in range(5, 100, 66)])
+
+    def test_generate_chunks_multiple_axes(self):
+        input = mock.MagicMock()
+        input.is_cached = False
+        input.itemsize = 8
+        input.mapped_order = ['time', 'lat', 'lon']
+        input.mapped = {
+            'time': slice(0, 365, 1),
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        op = mock.MagicMock()
+        op.identifier = 'CDAT.subset'
+        op.get_parameter.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.is_regrid = False
+        type(context).operation = mock.PropertyMock(return_value=op)
+
+        with self.settings(WORKER_MEMORY=600000, WORKER_CHUNK_MIN_SIZE=1000):
+            new_context = preprocess.generate_chunks(context)
+
+        self.assertEqual(input.chunk_axis, 'time')
+        self.assertEqual(input.chunk.axes, ['time', 'lat'])
+        self.assertEqual(len(input.chunk), 730)
+        self.assertEqual(input.chunk[0], {'time': slice(0, 1, 1),
+                                          'lat': slice(0, 92, 1)})
+        self.assertEqual(input.chunk[1], {'time': slice(0, 1, 1),
+                                          'lat': slice(92, 180, 1)})
+
+    @mock.patch('wps.tasks.preprocess.hosts.chunk_size')
+    def test_generate_chunks_host_budget(self, chunk_size):
+        chunk_size.return_value = 324000 * 10
+
+        input = mock.MagicMock()
+        input.is_cached = False
+        input.itemsize = 4
+        input.hostname = 'test.com'
+        input.mapped_order = ['time', 'lat', 'lon']
+        input.mapped = {
+            'time': slice(0, 365, 1),
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        op = mock.MagicMock()
+        op.identifier = 'CDAT.subset'
+        op.get_parameter.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.is_regrid = False
+        type(context).operation = mock.PropertyMock(return_value=op)
+
+        with self.settings(WORKER_MEMORY=200000000):
+            new_context = preprocess.generate_chunks(context)
+
+        chunk_size.assert_called_with('test.com', 1e8)
+
+        self.assertEqual(input.chunk.chunks, [{'time': slice(x, min(x+10, 365), 1)}
+                                              for x in range(0, 365, 10)])
+
+    def test_generate_chunks_regrid(self):
+        input = mock.MagicMock()
+        input.is_cached = False
+        input.itemsize = 4
+        input.mapped_order = ['time', 'lat', 'lon']
+        input.mapped = {
+            'time': slice(0, 365, 1),
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        op = mock.MagicMock()
+        op.identifier = 'CDAT.subset'
+        op.get_parameter.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.is_regrid = True
+        type(context).operation = mock.PropertyMock(return_value=op)
+
+        with self.settings(WORKER_MEMORY=200000000):
+            new_context = preprocess.generate_chunks(context)
+
+        self.assertEqual(input.chunk_axis, 'time')
+        self.assertEqual(input.chunk.chunks, [{'time': slice(x, min(x+205, 365), 1)}
+                                              for x in range(0, 365, 205)])
+
+    def test_generate_chunks_regrid_spatial(self):
+        input = mock.MagicMock()
+        input.is_cached = False
+        input.itemsize = 4
+        input.mapped_order = ['time', 'lat', 'lon']
+        input.spatial_axes = ['lat', 'lon']
+        input.mapped = {
+            'time': slice(0, 365, 1),
+            'lat': slice(0, 180, 1),
+            'lon': slice(0, 360, 1),
+        }
+
+        op = mock.MagicMock()
+        op.identifier = 'CDAT.subset'
+        op.get_parameter.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.is_regrid = True
+        type(context).operation = mock.PropertyMock(return_value=op)
+
+        with self.settings(WORKER_MEMORY=300000, WORKER_CHUNK_MIN_SIZE=1000):
+            with self.assertRaises(WPSError):
+                preprocess.generate_chunks(context)
+
+        context.is_regrid = False
+
+        with self.settings(WORKER_MEMORY=300000, WORKER_CHUNK_MIN_SIZE=1000):
+            preprocess.generate_chunks(context)
+
+        self.assertEqual(input.chunk.axes, ['time', 'lat'])
+
     def test_generate_chunks_process(self):
         input = mock.MagicMock()
-        input.chunk = []
         input.is_cached = False
+        input.itemsize = 4
         input.mapped_order = ['time', 'lat', 'lon']
         input.mapped = {
             'time': slice(0, 365, 1),
@@ -22,23 +236,25 @@ class PreprocessTestCase(test.TestCase):
         }
 
         op = mock.MagicMock()
+        op.identifier = 'CDAT.sum'
         op.get_parameter.return_value.values = ['time',]
 
         context = mock.MagicMock()
         context.inputs = [input,]
+        context.is_regrid = False
         type(context).operation = mock.PropertyMock(return_value=op)
 
         with self.settings(WORKER_MEMORY=200000000):
             new_context = preprocess.generate_chunks(context)
 
         self.assertEqual(input.chunk_axis, 'lat')
-        self.assertEqual(input.chunk, [slice(x, min(x+47, 180), 1) for x in
-                                       range(0, 180, 47)])
+        self.assertEqual(input.chunk.chunks, [{'lat': slice(x, min(x+152, 180), 1)}
+                                              for x in range(0, 180, 152)])
 
     def test_generate_chunks_no_axes(self):
         input = mock.MagicMock()
-        input.chunk = []
         input.is_cached = False
+        input.itemsize = 4
         input.mapped_order = ['time', 'lat', 'lon']
         input.mapped = {
             'time': slice(0, 365, 1),
@@ -47,17 +263,20 @@ class PreprocessTestCase(test.TestCase):
         }
 
         op = mock.MagicMock()
+        op.identifier = 'CDAT.sum'
         op.get_parameter.return_value = None
 
         context = mock.MagicMock()
         context.inputs = [input,]
+        context.is_regrid = False
         type(context).operation = mock.PropertyMock(return_value=op)
 
         with self.settings(WORKER_MEMORY=200000000):
             new_context = preprocess.generate_chunks(context)
 
         self.assertEqual(input.chunk_axis, 'time')
-        self.assertEqual(input.chunk, [slice(x, min(x+96, 365), 1) for x in range(0, 365, 96)])
+        self.assertEqual(input.chunk.chunks, [{'time': slice(x, min(x+308, 365), 1)}
+                                              for x in range(0, 365, 308)])
 
     @mock.patch('wps.models.Cache.objects.filter')
     def test_check_cache_entries_invalid(self, filter):
@@ -137,22 +356,109 @@ class PreprocessTestCase(test.TestCase):
 
         check_cache_entries.assert_called_with(input, context)
 
-    def test_map_axis_interval_exception(self):
-        axis = mock.MagicMock()
-        axis.mapInterval.side_effect = Exception()
+    def test_map_interval_no_overlap(self):
+        values = np.arange(0, 365, dtype=np.float64)
 
         with self.assertRaises(WPSError):
-            preprocess.map_axis_interval(axis, 20, 300)
+            preprocess.map_interval(values, 400, 500)
 
-    def test_map_axis_interval(self):
-        axis = mock.MagicMock()
-        axis.mapInterval.return_value = (20, 200)
+    def test_map_interval_decreasing(self):
+        values = np.arange(90, -91, -1, dtype=np.float64)
+
+        mapped = preprocess.map_interval(values, -10, 10)
+
+        self.assertEqual(mapped, (80, 101))
+
+    def test_map_interval_wraparound(self):
+        values = np.arange(0, 360, dtype=np.float64)
+
+        self.assertEqual(preprocess.map_interval(values, -10, 10, 360),
+                         (350, 371))
+        self.assertEqual(preprocess.map_interval(values, 0, 360, 360),
+                         (0, 360))
+
+    def test_map_interval(self):
+        values = np.arange(0, 365, dtype=np.float64)
+
+        mapped = preprocess.map_interval(values, 20, 300)
+
+        self.assertEqual(mapped, (20, 301))
+
+    def test_time_unit_seconds(self):
+        self.assertEqual(preprocess.time_unit_seconds('hours since 2000'),
+                         3600)
+        self.assertIsNone(preprocess.time_unit_seconds('months since 2000'))
+
+    @mock.patch('wps.tasks.preprocess.cdtime')
+    def test_convert_time(self, mock_cdtime):
+        mock_cdtime.reltime.return_value.torel.return_value.value = 10.0
+
+        values = np.array([0, 24, 48], dtype=np.float64)
+
+        converted = preprocess.convert_time(values, 'hours since 2000', 1,
+                                            'days since 1999')
+
+        self.assertEqual(converted.tolist(), [10.0, 11.0, 12.0])
+
+        mock_cdtime.reltime.assert_called_once_with(0, 'hours since 2000')
+
+        converted = preprocess.convert_time(values[1:], 'hours since 2000', 1,
+                                            'days since 1999')
+
+        self.assertEqual(converted.tolist(), [11.0, 12.0])
+        self.assertEqual(mock_cdtime.reltime.call_count, 1)
+
+    @mock.patch('wps.tasks.preprocess.TIME_CACHE_SIZE', 2)
+    @mock.patch('wps.tasks.preprocess.cdtime')
+    def test_time_transform_evicts(self, mock_cdtime):
+        mock_cdtime.reltime.return_value.torel.return_value.value = 0.0
+
+        preprocess.time_transform('hours since 2000', 1, 'days since 1999')
+
+        preprocess.time_transform('hours since 2001', 1, 'days since 1999')
+
+        preprocess.time_transform('hours since 2000', 1, 'days since 1999')
+
+        preprocess.time_transform('hours since 2002', 1, 'days since 1999')
+
+        self.assertEqual(list(preprocess.TIME_CACHE), [
+            ('hours since 2000', 1, 'days since 1999'),
+            ('hours since 2002', 1, 'days since 1999'),
+        ])
+
+    @mock.patch('wps.tasks.preprocess.cdtime')
+    def test_convert_time_variable_units(self, mock_cdtime):
+        mock_cdtime.reltime.return_value.torel.return_value.value = 31.0
+
+        values = np.array([1, 2], dtype=np.float64)
+
+        converted = preprocess.convert_time(values, 'months since 2000', 1,
+                                            'days since 2000')
+
+        self.assertEqual(converted.tolist(), [31.0, 31.0])
+
+        self.assertEqual(mock_cdtime.reltime.call_count, 2)
+
+    @mock.patch('wps.tasks.preprocess.cdtime')
+    def test_convert_time_variable_units_cached(self, mock_cdtime):
+        mock_cdtime.reltime.return_value.torel.return_value.value = 31.0
+
+        values = np.array([1, 2], dtype=np.float64)
+
+        preprocess.convert_time(values, 'months since 2000', 1,
+                                'days since 2000')
 
-        mapped = preprocess.map_axis_interval(axis, 20, 300)
+        converted = preprocess.convert_time(values.copy(), 'months since 2000',
+                                            1, 'days since 2000')
 
-        self.assertEqual(mapped, (20, 200)) 
+        self.assertEqual(converted.tolist(), [31.0, 31.0])
+        self.assertFalse(converted.flags.writeable)
+        self.assertEqual(mock_cdtime.reltime.call_count, 2)
 
-        axis.mapInterval.assert_called_with((20, 300))
+        preprocess.convert_time(values[:1], 'months since 2000', 1,
+                                'days since 2000')
+
+        self.assertEqual(mock_cdtime.reltime.call_count, 3)
 
     def test_map_axis_indices_dimension_larger(self):
         axis = mock.MagicMock()
@@ -191,57 +497,77 @@ class PreprocessTestCase(test.TestCase):
 
         self.assertEqual(selector, slice(0, 365, 1))
     
-    @mock.patch('wps.tasks.preprocess.map_axis_interval')
-    def test_map_axis_values(self, map_axis_interval):
-        map_axis_interval.return_value = (0, 365)
-
+    def test_map_axis_values_latitude(self):
         axis = mock.MagicMock()
+        axis.__getitem__.return_value = range(-90, 91)
+        axis.isTime.return_value = False
+        axis.isCircular.return_value = False
 
-        dimension = cwt.Dimension('time', 0, 365)
+        dimension = cwt.Dimension('lat', -45, 45, cwt.VALUES)
 
         selector = preprocess.map_axis_values(axis, dimension)
 
-        self.assertEqual(select, slice(0, 365, 1))
+        self.assertEqual(selector, slice(45, 136, 1))
 
-        map_axis_timestamps.assert_called_with(axis, 0, 365)
-
-    @mock.patch('wps.tasks.preprocess.map_axis_interval')
-    def test_map_axis_timestamps(self, map_axis_interval):
-        map_axis_interval.return_value = (0, 365)
+    @mock.patch('wps.tasks.preprocess.cdtime')
+    def test_map_axis_timestamps_convert(self, mock_cdtime):
+        mock_cdtime.s2r.side_effect = [
+            mock.MagicMock(value=10.0),
+            mock.MagicMock(value=20.0),
+        ]
 
         axis = mock.MagicMock()
+        axis.__getitem__.return_value = range(0, 365)
+        axis.isTime.return_value = True
+        axis.isCircular.return_value = False
+        axis.units = 'days since 2000'
 
-        dimension = cwt.Dimension('time', 'days since 2020', 'days since 2040')
+        dimension = cwt.Dimension('time', '2000-01-11', '2000-01-21',
+                                  cwt.TIMESTAMPS)
 
-        selector = preprocess.map_axis_timestamps(axis, dimension)
+        selector = preprocess.map_axis_timestamps(axis, dimension,
+                                                  'days since 2000')
 
-        self.assertEqual(select, slice(0, 365, 1))
+        self.assertEqual(selector, slice(10, 21, 1))
 
-        map_axis_timestamps.assert_called_with(axis, 'days since 2020', 
-                                               'days since 2040')
+        mock_cdtime.s2r.assert_any_call('2000-01-11', 'days since 2000',
+                                        axis.getCalendar.return_value)
 
-    def test_map_axis_time_axis_no_units(self):
+    @mock.patch('wps.tasks.preprocess.convert_time')
+    def test_map_axis_values_time_axis_no_units(self, convert_time):
         axis = mock.MagicMock()
+        axis.__getitem__.return_value = range(0, 365)
         axis.isTime.return_value = True
+        axis.isCircular.return_value = False
 
-        dimension = cwt.Dimension('time', 0, 365, cwt.TIMESTAMPS)
+        dimension = cwt.Dimension('time', 0, 365, cwt.VALUES)
 
         preprocess.map_axis(axis, dimension, None)
 
         axis.clone.assert_not_called()
 
-    def test_map_axis_time_axis(self):
+        convert_time.assert_not_called()
+
+    @mock.patch('wps.tasks.preprocess.convert_time')
+    def test_map_axis_values_time_axis(self, convert_time):
+        convert_time.return_value = np.arange(365, 730, dtype=np.float64)
+
         axis = mock.MagicMock()
+        axis.__getitem__.return_value = range(0, 365)
         axis.isTime.return_value = True
+        axis.isCircular.return_value = False
+        axis.units = 'days since 2001'
 
-        dimension = cwt.Dimension('time', 0, 365, cwt.TIMESTAMPS)
+        dimension = cwt.Dimension('time', 400, 499, cwt.VALUES)
 
-        preprocess.map_axis(axis, dimension, 'days since 2020')
+        selector = preprocess.map_axis(axis, dimension, 'days since 2000')
 
-        axis.clone.assert_called()
+        self.assertEqual(selector, slice(35, 135, 1))
 
-        axis.clone.return_value.toRelativeTime.assert_called_with(
-            'days since 2020')
+        axis.clone.assert_not_called()
+
+        self.assertEqual(convert_time.call_args[0][1], 'days since 2001')
+        self.assertEqual(convert_time.call_args[0][3], 'days since 2000')
 
     @mock.patch('wps.tasks.preprocess.map_axis_timestamps')
     def test_map_axis_timestamps(self, target):
@@ -385,6 +711,7 @@ class PreprocessTestCase(test.TestCase):
         map_axis.side_effect = Exception()
 
         input1 = mock.MagicMock()
+        input1.metadata.return_value.axis_list.return_value = self.axes
         input1.mapped = {}
 
         context = mock.MagicMock()
@@ -407,6 +734,7 @@ class PreprocessTestCase(test.TestCase):
         map_axis.side_effect = WPSError('')
 
         input1 = mock.MagicMock()
+        input1.metadata.return_value.axis_list.return_value = self.axes
         input1.mapped = {}
 
         context = mock.MagicMock()
@@ -426,11 +754,8 @@ class PreprocessTestCase(test.TestCase):
             'lon',
         ]
 
-        var = mock.MagicMock()
-        var.getAxisIndex.return_value = -1
-
         input1 = mock.MagicMock()
-        input1.open.return_value.__enter__.return_value = var
+        input1.metadata.return_value.axis_list.return_value = self.axes[:2]
         input1.mapped = {}
 
         context = mock.MagicMock()
@@ -456,6 +781,7 @@ class PreprocessTestCase(test.TestCase):
         ]
 
         input1 = mock.MagicMock()
+        input1.metadata.return_value.axis_list.return_value = self.axes
         input1.mapped = {}
 
         context = mock.MagicMock()
@@ -488,6 +814,7 @@ class PreprocessTestCase(test.TestCase):
         ]
 
         input1 = mock.MagicMock()
+        input1.metadata.return_value.axis_list.return_value = self.axes
         input1.mapped = {}
 
         domain = mock.MagicMock()
@@ -510,12 +837,90 @@ class PreprocessTestCase(test.TestCase):
 
         self.assertEqual(new_context.inputs[0].mapped, expected1)
 
-    def test_base_units_no_time(self):
-        var = mock.MagicMock()
-        var.getTime.return_value = None
+    def test_probe_metadata_timeout(self):
+        event = threading.Event()
+
+        input = mock.MagicMock()
+        input.metadata.side_effect = lambda user, cancelled: event.wait(5)
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+
+        try:
+            with self.settings(WORKER_METADATA_TIMEOUT=0):
+                with self.assertRaises(WPSError):
+                    preprocess.probe_metadata(context)
+        finally:
+            event.set()
+
+    def test_probe_metadata_deadline(self):
+        inputs = []
+
+        for x in range(3):
+            input = mock.MagicMock()
+            input.hostname = 'host'
+            input.metadata.side_effect = lambda user, cancelled: time.sleep(0.4)
+
+            inputs.append(input)
+
+        context = mock.MagicMock()
+        context.inputs = inputs
+
+        with self.settings(WORKER_METADATA_TIMEOUT=1,
+                           WORKER_METADATA_HOST_LIMIT=1):
+            with self.assertRaises(WPSError):
+                preprocess.probe_metadata(context)
+
+    def test_probe_metadata_cancels_abandoned(self):
+        event = threading.Event()
+
+        first = mock.MagicMock()
+        first.hostname = 'host'
+        first.metadata.side_effect = lambda user, cancelled: event.wait(5)
+
+        second = mock.MagicMock()
+        second.hostname = 'host'
+
+        context = mock.MagicMock()
+        context.inputs = [first, second]
+
+        try:
+            with self.settings(WORKER_METADATA_TIMEOUT=0,
+                               WORKER_METADATA_HOST_LIMIT=1):
+                with self.assertRaises(WPSError):
+                    preprocess.probe_metadata(context)
+        finally:
+            event.set()
+
+        time.sleep(0.2)
+
+        second.metadata.assert_not_called()
+
+    def test_probe_metadata(self):
+        inputs = []
+
+        for x in range(10):
+            input = mock.MagicMock()
+            input.hostname = 'host{}'.format(x % 3)
+            input.metadata.return_value = x
 
+            inputs.append(input)
+
+        context = mock.MagicMock()
+        context.inputs = inputs
+
+        with self.settings(WORKER_METADATA_THREADS=4,
+                           WORKER_METADATA_HOST_LIMIT=1):
+            metadata = preprocess.probe_metadata(context)
+
+        self.assertEqual(metadata, range(10))
+
+        for input in inputs:
+            input.metadata.assert_called_with(context.user, mock.ANY)
+
+    def test_base_units_no_time(self):
         input = mock.MagicMock()
-        input.open.return_value.__enter__.return_value = var
+        input.metadata.return_value.get_time.return_value = None
         input.units = None
         input.first = None
 
@@ -530,16 +935,58 @@ class PreprocessTestCase(test.TestCase):
         self.assertEqual(new_context.inputs[0].units, None)
         self.assertEqual(new_context.inputs[0].first, None)
 
+    @mock.patch('wps.tasks.preprocess.map_axis')
+    def test_mapped_nbytes(self, map_axis):
+        map_axis.side_effect = [slice(0, 10, 1), slice(0, 180, 2), 360]
+
+        metadata = mock.MagicMock()
+        metadata.axis_list.return_value = self.axes
+        metadata.itemsize = 8
+
+        context = mock.MagicMock()
+        context.domain = None
+
+        nbytes = preprocess.mapped_nbytes(context, metadata)
+
+        self.assertEqual(nbytes, 8 * 10 * 90 * 360)
+
+    @mock.patch('wps.tasks.preprocess.map_axis')
+    def test_mapped_nbytes_not_mapped(self, map_axis):
+        map_axis.side_effect = Exception()
+
+        metadata = mock.MagicMock()
+        metadata.axis_list.return_value = self.axes
+
+        context = mock.MagicMock()
+        context.domain = None
+
+        self.assertEqual(preprocess.mapped_nbytes(context, metadata), 0)
+
+    @mock.patch('wps.tasks.preprocess.mapped_nbytes')
+    def test_base_units_mapped_nbytes(self, mapped_nbytes):
+        mapped_nbytes.return_value = 100
+
+        input = mock.MagicMock()
+        input.metadata.return_value.get_time.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.units = None
+
+        new_context = preprocess.base_units(context)
+
+        mapped_nbytes.assert_called_with(context,
+                                         input.metadata.return_value)
+
+        self.assertEqual(new_context.inputs[0].nbytes, 100)
+
     def test_base_units(self):
         time = mock.MagicMock()
         type(time).units = mock.PropertyMock(return_value='days since 2000')
         time.__getitem__.return_value = 100
 
-        var = mock.MagicMock()
-        var.getTime.return_value = time
-
         input = mock.MagicMock()
-        input.open.return_value.__enter__.return_value = var
+        input.metadata.return_value.get_time.return_value = time
 
         context = mock.MagicMock()
         context.inputs = [input,]
@@ -551,6 +998,168 @@ class PreprocessTestCase(test.TestCase):
         self.assertEqual(new_context.inputs[0].units, 'days since 2000')
         self.assertEqual(new_context.inputs[0].first, 100)
 
+    @mock.patch('wps.tasks.preprocess.enqueue_chunks')
+    @mock.patch('wps.tasks.preprocess.hosts.chunk_size')
+    @mock.patch('wps.tasks.preprocess.check_cache_entries')
+    @mock.patch('wps.tasks.preprocess.map_axis')
+    @mock.patch('wps.tasks.preprocess.merge_dimensions')
+    def test_preprocess_inputs(self, merge_dimensions, map_axis,
+                               check_cache_entries, chunk_size,
+                               enqueue_chunks):
+        chunk_size.return_value = 1e8
+
+        merge_dimensions.return_value = ['time', 'lat']
+
+        map_axis.side_effect = [
+            slice(0, 365, 1),
+            slice(0, 180, 1),
+        ]
+
+        check_cache_entries.return_value = None
+
+        time = mock.MagicMock()
+        type(time).units = mock.PropertyMock(return_value='days since 2000')
+        time.__getitem__.return_value = 100
+
+        input = mock.MagicMock()
+        input.metadata.return_value.get_time.return_value = time
+        input.metadata.return_value.axis_list.return_value = self.axes[:2]
+        input.metadata.return_value.itemsize = 4
+        input.metadata.return_value.chunk_sizes = None
+        input.mapped = {}
+        input.is_cached = False
+
+        op = mock.MagicMock()
+        op.identifier = 'CDAT.subset'
+        op.get_parameter.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.units = None
+        context.is_regrid = False
+        type(context).operation = mock.PropertyMock(return_value=op)
+
+        with self.settings(WORKER_MEMORY=200000000):
+            new_context = preprocess.preprocess_inputs(context)
+
+        input.metadata.assert_called_once_with(context.user, mock.ANY)
+
+        check_cache_entries.assert_called_with(input, context)
+
+        self.assertEqual(new_context.units, 'days since 2000')
+        self.assertEqual(input.first, 100)
+        self.assertEqual(input.mapped_order, ['time', 'lat'])
+        self.assertEqual(input.spatial_axes, ['lat'])
+        self.assertEqual(input.mapped, {
+            'time': slice(0, 365, 1),
+            'lat': slice(0, 180, 1),
+        })
+        self.assertIsNone(input.cache)
+        enqueue_chunks.assert_called_with(context)
+        self.assertEqual(input.chunk.axes, ['time'])
+        self.assertEqual(input.chunk.chunks, [{'time': slice(0, 365, 1)}])
+
+    @mock.patch('wps.tasks.preprocess.enqueue_chunks')
+    @mock.patch('wps.tasks.preprocess.check_cache_entries')
+    def test_preprocess_inputs_not_mapped(self, check_cache_entries,
+                                          enqueue_chunks):
+        input = mock.MagicMock()
+        input.metadata.return_value.get_time.return_value = None
+        input.metadata.return_value.axis_list.return_value = []
+        input.mapped = None
+        input.is_cached = False
+
+        op = mock.MagicMock()
+        op.identifier = 'CDAT.subset'
+        op.get_parameter.return_value = None
+
+        context = mock.MagicMock()
+        context.inputs = [input,]
+        context.units = None
+        context.is_regrid = False
+        type(context).operation = mock.PropertyMock(return_value=op)
+
+        new_context = preprocess.preprocess_inputs(context)
+
+        check_cache_entries.assert_not_called()
+
+        self.assertIsNone(new_context.units)
+        self.assertEqual(input.chunk.chunks, [])
+
+    def test_balance(self):
+        assignment, totals = preprocess.balance([1, 9, 3, 5, 2, 8], 2)
+
+        self.assertEqual(assignment, [1, 0, 0, 1, 0, 1])
+        self.assertEqual(totals, [14, 14])
+
+    def test_assign_chunks(self):
+        large = mock.MagicMock()
+        large.chunk = ChunkPlan(['time'], [{}, {}, {}, {}], 100, [100]*4)
+
+        small = mock.MagicMock()
+        small.chunk = ChunkPlan([], [{}], 10, [10])
+
+        context = mock.MagicMock()
+        context.inputs = [small, large]
+
+        with self.settings(WORKER_PER_USER=3):
+            totals = preprocess.assign_chunks(context)
+
+        self.assertEqual(large.workers, [0, 1, 2, 0])
+        self.assertEqual(small.workers, [1])
+        self.assertEqual(totals, [200, 110, 100])
+
+    @mock.patch('wps.tasks.preprocess.models.JobChunk.enqueue')
+    def test_enqueue_chunks(self, enqueue):
+        ingress = mock.MagicMock(is_cached=False)
+        ingress.chunk = ChunkPlan(['time'], [{}, {}], 100, [100, 50])
+
+        cached = mock.MagicMock(is_cached=True)
+        cached.chunk = ChunkPlan([], [{}], 10, [10])
+
+        unmapped = mock.MagicMock(mapped=None)
+
+        context = mock.MagicMock()
+        context.chunk_queue = False
+        context.is_compute = True
+        context.sorted_inputs.return_value = [ingress, cached, unmapped]
+
+        with self.settings(WORKER_CHUNK_QUEUE=True, INGRESS_ENABLED=True):
+            preprocess.enqueue_chunks(context)
+
+        enqueue.assert_called_with(context.job, [
+            (0, 0, 100, 'ingress'),
+            (0, 1, 50, 'ingress'),
+            (1, 0, 10, 'process'),
+        ])
+
+        self.assertTrue(context.chunk_queue)
+
+    @mock.patch('wps.tasks.preprocess.models.JobChunk.enqueue')
+    def test_enqueue_chunks_disabled(self, enqueue):
+        context = mock.MagicMock()
+        context.chunk_queue = False
+
+        with self.settings(WORKER_CHUNK_QUEUE=False):
+            preprocess.enqueue_chunks(context)
+
+        enqueue.assert_not_called()
+
+        self.assertFalse(context.chunk_queue)
+
+    def test_filter_inputs_size(self):
+        sizes = [10, 100, 20, 90]
+
+        inputs = [mock.MagicMock(nbytes=x) for x in sizes]
+
+        with self.settings(WORKER_PER_USER=2):
+            context = mock.MagicMock()
+            context.inputs = list(inputs)
+
+            new_context = preprocess.filter_inputs(context, 0)
+
+        self.assertEqual([x.nbytes for x in new_context.inputs], [10, 100])
+
     def test_filter_inputs(self):
         expected = [4, 3, 3]
 
@@ -558,7 +1167,8 @@ class PreprocessTestCase(test.TestCase):
             for index, x in enumerate(range(3)):
                 context = mock.MagicMock()        
                
-                context.inputs.__len__.return_value = 10
+                context.inputs = [mock.MagicMock(nbytes=None)
+                                  for _ in range(10)]
 
                 new_context = preprocess.filter_inputs(context, index)
 
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+
+import cdms2
+import mock
+import numpy as np
+from django import test
+
+from wps import weights
+
+class WeightsTestCase(test.TestCase):
+
+    def setUp(self):
+        weights.WEIGHTS.clear()
+
+        self.source = cdms2.createUniformGrid(-80.0, 9, 20.0, 0.0, 18, 20.0)
+
+        self.target = cdms2.createUniformGrid(-60.0, 3, 60.0, -160.0, 9, 40.0)
+
+        time = cdms2.createAxis(np.arange(2.0), id='time')
+
+        time.designateTime()
+
+        data = np.random.random((2, 9, 18))
+
+        self.variable = cdms2.createVariable(
+            data, axes=[time, self.source.getLatitude(),
+                        self.source.getLongitude()], id='tas')
+
+    def tearDown(self):
+        weights.WEIGHTS.clear()
+
+    def assertRegridParity(self, variable, grid, tool='regrid2',
+                           method='linear'):
+        expected = variable.regrid(grid, regridTool=tool, regridMethod=method)
+
+        result = weights.regrid(variable, grid, tool, method)
+
+        self.assertEqual(result.shape, expected.shape)
+        self.assertTrue(np.array_equal(np.ma.getmaskarray(result),
+                                       np.ma.getmaskarray(expected)))
+        self.assertTrue(np.ma.allclose(result, expected))
+
+    def test_supports(self):
+        self.assertTrue(weights.supports(self.variable, self.target,
+                                         'regrid2', None))
+        self.assertTrue(weights.supports(self.variable, self.target,
+                                         'Regrid2', 'linear'))
+        self.assertTrue(weights.supports(self.variable, self.target, 'ESMF',
+                                         'conservative'))
+        self.assertTrue(weights.supports(self.variable, self.target, 'esmf',
+                                         'linear'))
+        self.assertFalse(weights.supports(self.variable, self.target, 'libcf',
+                                          'linear'))
+
+    def test_horizontal_mask(self):
+        self.assertIsNone(weights.horizontal_mask(self.variable))
+
+        self.variable[:, 0, 0] = np.ma.masked
+        self.variable[0, 1, 1] = np.ma.masked
+
+        mask = weights.horizontal_mask(self.variable)
+
+        self.assertEqual(mask.shape, (9, 18))
+        self.assertTrue(mask[0, 0])
+        self.assertFalse(mask[1, 1])
+
+    def test_grid_key(self):
+        key = weights.grid_key(self.source, self.target)
+
+        self.assertEqual(key, weights.grid_key(self.source, self.target))
+        self.assertNotEqual(key, weights.grid_key(self.target, self.source))
+
+        key = weights.grid_key(self.source, self.target, 'esmf',
+                               'conservative')
+
+        self.assertNotEqual(key, weights.grid_key(
+            self.source, self.target, 'esmf', 'conservative',
+            np.ones((9, 18), dtype=bool)))
+        self.assertNotEqual(key, weights.grid_key(
+            self.source, self.target, 'esmf', 'linear'))
+
+    def test_regrid_parity(self):
+        self.assertRegridParity(self.variable, self.target)
+
+    def test_regrid_parity_masked(self):
+        self.variable[0, :, :2] = np.ma.masked
+        self.variable[1, :, :] = np.ma.masked
+
+        self.assertRegridParity(self.variable, self.target)
+
+    def test_regrid_parity_regional(self):
+        regional = self.variable(latitude=(-20, 40), longitude=(60, 180))
+
+        self.assertRegridParity(regional, self.target)
+
+    def test_regrid_parity_esmf(self):
+        self.assertRegridParity(self.variable, self.target, 'esmf',
+                                'conservative')
+
+    def test_regrid_parity_esmf_masked(self):
+        self.variable[:, :, :2] = np.ma.masked
+        self.variable[1, 3, 5] = np.ma.masked
+
+        self.assertRegridParity(self.variable, self.target, 'esmf',
+                                'conservative')
+
+    def test_regrid_parity_esmf_linear(self):
+        self.assertRegridParity(self.variable, self.target, 'esmf', 'linear')
+
+    @mock.patch('wps.weights.CdmsRegrid')
+    def test_regrid_esmf_cached(self, mock_regrid):
+        weights.regrid(self.variable, self.target, 'esmf', 'conservative')
+
+        weights.regrid(self.variable, self.target, 'esmf', 'conservative')
+
+        self.assertEqual(mock_regrid.call_count, 1)
+        self.assertEqual(mock_regrid.return_value.call_count, 2)
+
+        self.variable[:, 0, 0] = np.ma.masked
+
+        weights.regrid(self.variable, self.target, 'esmf', 'conservative')
+
+        self.assertEqual(mock_regrid.call_count, 2)
+
+    @mock.patch('wps.weights.Horizontal')
+    def test_lookup_cached(self, mock_horizontal):
+        key = weights.grid_key(self.source, self.target)
+
+        weights.lookup(key, mock_horizontal, self.source, self.target)
+
+        regridder = weights.lookup(key, mock_horizontal, self.source,
+                                   self.target)
+
+        self.assertEqual(mock_horizontal.call_count, 1)
+        self.assertEqual(regridder, mock_horizontal.return_value)
+
+    @test.override_settings(WORKER_REGRID_CACHE_ENTRIES=1)
+    @mock.patch('wps.weights.Horizontal')
+    def test_lookup_evicts(self, mock_horizontal):
+        weights.lookup('first', mock_horizontal)
+
+        weights.lookup('second', mock_horizontal)
+
+        self.assertEqual(weights.WEIGHTS.keys(), ['second'])
+
+    def test_regrid_unsupported(self):
+        variable = mock.MagicMock()
+
+        with mock.patch('wps.weights.supports', return_value=False):
+            weights.regrid(variable, self.target, 'libcf', 'linear')
+
+        variable.regrid.assert_called_with(self.target, regridTool='libcf',
+                                           regridMethod='linear')
@@ -50,10 +50,10 @@ def describe_axis(axis):
 
     return data
 
-def process_axes(header):
+def process_axes(axes):
     """ Processes the axes of a file.
     Args:
-        header: A cdms2.fvariable.FileVariable.
+        axes: A list of cdms2.axis.TransientAxis.
 
     Returns:
         A dict containing the url, temporal and spatial axes.
@@ -61,7 +61,7 @@ def process_axes(header):
     data = {}
     base_units = None
 
-    for axis in header.getAxisList():
+    for axis in axes:
         logger.info('Processing axis %r', axis.id)
 
         if axis.isTime():
@@ -85,10 +85,14 @@ def process_axes(header):
 
 def process_url(user, prefix_id, context):
     """ Processes a url.
+
+    The axes are read from the axis metadata index and the result is cached
+    for a day.
+
     Args:
+        user: A wps.models.User object.
         prefix_id: A str prefix to build the cache id.
-        url: A str url path.
-        variable: A str variable name.
+        context: A wps.context.VariableContext.
 
     Returns:
         A list of dicts describing each files axes.
@@ -104,8 +108,9 @@ def process_url(user, prefix_id, context):
     if data is None:
         data = { 'url': context.variable.uri }
 
-        with context.open(user) as variable:
-            axes = process_axes(variable)
+        metadata = context.metadata(user)
+
+        axes = process_axes(metadata.axis_list())
 
         data.update(axes)
 
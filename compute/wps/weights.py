@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+
+import collections
+import hashlib
+import logging
+import threading
+
+import numpy as np
+from cdms2.grid import AbstractRectGrid
+from cdms2.mvCdmsRegrid import CdmsRegrid
+from django.conf import settings
+from regrid2 import Horizontal
+
+from wps import metrics
+
+logger = logging.getLogger('wps.weights')
+
+MEMORY = 'memory'
+GENERATED = 'generated'
+
+REGRID2 = 'regrid2'
+ESMF = 'esmf'
+
+# Per process regridders shared by all threads of a worker
+WEIGHTS = collections.OrderedDict()
+
+LOCK = threading.Lock()
+
+# ESMF is not thread safe, cached ESMF regridders are applied one at a time
+ESMF_LOCK = threading.Lock()
+
+def rectilinear(grid):
+    return grid is not None and isinstance(grid, AbstractRectGrid)
+
+def regrid_tool(tool):
+    tool = (tool or '').lower()
+
+    if tool.startswith('regrid'):
+        return REGRID2
+
+    return tool
+
+def supports(data, grid, tool, method):
+    """ Whether a cached regridder can regrid a variable.
+
+    Regridders between rectilinear grids are cached for regrid2 and ESMF.
+    Conservative ESMF regridding needs the bounds of both grids, cdms2
+    falls back to linear regridding without them and is left to do so.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable to regrid.
+        grid (cdms2.grid.AbstractGrid): Target grid.
+        tool (str): Regridding tool.
+        method (str): Regridding method.
+
+    Returns:
+        A bool.
+    """
+    source = data.getGrid()
+
+    if not (rectilinear(grid) and rectilinear(source)):
+        return False
+
+    tool = regrid_tool(tool)
+
+    if tool == REGRID2:
+        return True
+
+    if tool != ESMF:
+        return False
+
+    if (method or '').lower().startswith('conserv'):
+        return source.getBounds() is not None and grid.getBounds() is not None
+
+    return True
+
+def horizontal_mask(data):
+    """ Mask shared by every horizontal slab of a variable.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable to regrid.
+
+    Returns:
+        A numpy.ndarray of the latitude/longitude mask or None if nothing
+        is masked.
+    """
+    mask = np.ma.getmaskarray(data)
+
+    if not mask.any():
+        return None
+
+    return np.logical_and.reduce(mask.reshape((-1,) + mask.shape[-2:]),
+                                 axis=0)
+
+def cell_bounds(axis):
+    bounds = axis.getBounds()
+
+    if bounds is None:
+        bounds = axis.genGenericBounds()
+
+    return np.array(bounds, dtype=np.float64)
+
+def grid_key(source, target, tool=REGRID2, method=None, mask=None,
+             dtype=None):
+    """ Key of the regridder between two grids.
+
+    Args:
+        source (cdms2.grid.AbstractRectGrid): Source grid.
+        target (cdms2.grid.AbstractRectGrid): Target grid.
+        tool (str): Regridding tool.
+        method (str): Regridding method.
+        mask (numpy.ndarray): Mask of the source grid.
+        dtype (numpy.dtype): Type of the regridded data.
+
+    Returns:
+        A str hex digest of the grid coordinates, tool, method, source mask
+        and type.
+    """
+    digest = hashlib.sha1()
+
+    digest.update('{!s}|{!s}|{!s}'.format(regrid_tool(tool), method,
+                                          dtype).lower())
+
+    for grid in (source, target):
+        for axis in (grid.getLatitude(), grid.getLongitude()):
+            digest.update(np.array(axis[:], dtype=np.float64).tostring())
+
+            digest.update(cell_bounds(axis).tostring())
+
+    if mask is not None:
+        digest.update(np.packbits(mask.ravel()).tostring())
+
+    return digest.hexdigest()
+
+def lookup(key, func, *args, **kwargs):
+    """ Looks up a regridder, creating it on a miss.
+
+    Regridders are kept in a per worker LRU of WORKER_REGRID_CACHE_ENTRIES.
+
+    Args:
+        key (str): Key returned by grid_key.
+        func (function): Function creating the regridder.
+        *args: Arguments passed to func.
+        **kwargs: Keyword arguments passed to func.
+
+    Returns:
+        The regridder.
+    """
+    with LOCK:
+        regridder = WEIGHTS.pop(key, None)
+
+        if regridder is not None:
+            WEIGHTS[key] = regridder
+
+    if regridder is not None:
+        metrics.WPS_REGRID_WEIGHTS.labels(MEMORY).inc()
+
+        return regridder
+
+    logger.info('Generating regridder %r', key)
+
+    regridder = func(*args, **kwargs)
+
+    metrics.WPS_REGRID_WEIGHTS.labels(GENERATED).inc()
+
+    with LOCK:
+        WEIGHTS[key] = regridder
+
+        while len(WEIGHTS) > settings.WORKER_REGRID_CACHE_ENTRIES:
+            WEIGHTS.popitem(last=False)
+
+    return regridder
+
+def regrid(data, grid, tool, method):
+    """ Regrids a variable reusing regridders between identical grids.
+
+    Regridders are created with the arguments cdms2 uses when regridding a
+    variable. ESMF weights depend on the mask common to every slab of the
+    variable, ESMF regridders are also keyed by that mask and the data type.
+
+    Args:
+        data (cdms2.tvariable.TransientVariable): Variable to regrid.
+        grid (cdms2.grid.AbstractGrid): Target grid.
+        tool (str): Regridding tool.
+        method (str): Regridding method.
+
+    Returns:
+        A cdms2.tvariable.TransientVariable.
+    """
+    if not supports(data, grid, tool, method):
+        return data.regrid(grid, regridTool=tool, regridMethod=method)
+
+    source = data.getGrid()
+
+    if regrid_tool(tool) == REGRID2:
+        regridder = lookup(grid_key(source, grid), Horizontal, source, grid)
+
+        return regridder(data)
+
+    kwargs = {}
+
+    if data.getAxis(-1).attributes.get('topology') == 'circular':
+        kwargs['periodicity'] = 1
+        kwargs['mkCyclic'] = 1
+
+    mask = horizontal_mask(data)
+
+    key = grid_key(source, grid, tool, method, mask, data.dtype)
+
+    regridder = lookup(key, CdmsRegrid, source, grid, dtype=data.dtype,
+                       regridMethod=method, regridTool=tool,
+                       srcGridMask=mask, **kwargs)
+
+    with ESMF_LOCK:
+        return regridder(data, **kwargs)